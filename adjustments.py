@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import logging
+from typing import List
+
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
+
+
+logger = logging.getLogger(__name__)
+
+def factors_schema() -> dict:
+    """Схема пустой таблицы коэффициентов сплитов (если данных о сплитах еще нет)"""
+    return {'SECID': pl.Utf8, 'date': pl.Date, 'factor': pl.Float64}
+
+
+def renames_schema() -> dict:
+    """Схема пустой таблицы смены кодов (если данных о смене кодов еще нет)"""
+    return {'old_secid': pl.Utf8, 'new_secid': pl.Utf8}
+
+
+def resolve_renames(changeovers: pl.DataFrame) -> pl.DataFrame:
+    """
+    Итоговый код для каждого старого кода бумаги
+
+    Цепочки переименований сворачиваются: A -> B и B -> C дают A -> C и B -> C.
+
+    :param changeovers: DataFrame: date, old_secid, new_secid
+    :return: DataFrame: old_secid, new_secid (актуальный код)
+    """
+
+    renames = (changeovers
+               .sort('date')
+               .filter(pl.col('old_secid') != pl.col('new_secid'))
+               .unique(subset='old_secid', keep='last')
+               .select('old_secid', 'new_secid'))
+
+    # Каждый шаг сокращает цепочки вдвое, циклы останавливаются ограничением на количество шагов
+    for _ in range(renames.height):
+        step = renames.join(renames, left_on='new_secid', right_on='old_secid', how='left', suffix='_next')
+        if step['new_secid_next'].is_null().all():
+            break
+        renames = step.select('old_secid', pl.coalesce('new_secid_next', 'new_secid').alias('new_secid'))
+
+    return renames.filter(pl.col('old_secid') != pl.col('new_secid'))
+
+
+def split_factors(splits: pl.DataFrame, renames: pl.DataFrame) -> pl.DataFrame:
+    """
+    Накопленные коэффициенты сплитов по каждой бумаге
+
+    Для сплита на дату D коэффициент равен произведению (quantity_after / quantity_before)
+    этого и всех более поздних сплитов бумаги. Количество в операции до даты D умножается
+    на коэффициент, цена делится на него - так вся история приводится к текущим единицам.
+
+    :param splits: DataFrame: date, secid, quantity_before, quantity_after
+    :param renames: DataFrame: old_secid, new_secid (см. resolve_renames)
+    :return: DataFrame: SECID, date, factor
+    """
+
+    return (apply_renames(splits.rename({'secid': 'SECID'}), renames)
+            .with_columns(pl.col('date').cast(pl.Date),
+                          (pl.col('quantity_after') / pl.col('quantity_before')).alias('factor'))
+            .sort(['SECID', 'date'], descending=[False, True])
+            .with_columns(pl.col('factor').cum_prod().over('SECID'))
+            .select('SECID', 'date', 'factor')
+            .sort('date'))
+
+
+def apply_renames(df: pl.DataFrame, renames: pl.DataFrame, column: str = 'SECID') -> pl.DataFrame:
+    """
+    Замена старых кодов бумаг на актуальные
+
+    :param df: DataFrame со столбцом кода бумаги
+    :param renames: DataFrame: old_secid, new_secid
+    :param column: str: столбец с кодом бумаги
+    :return: DataFrame с актуальными кодами
+    """
+
+    if renames.is_empty():
+        return df
+
+    return (df
+            .join(renames, left_on=column, right_on='old_secid', how='left')
+            .with_columns(pl.coalesce('new_secid', column).alias(column))
+            .drop('new_secid'))
+
+
+def secid_aliases(secids: List[str], renames: pl.DataFrame) -> List[str]:
+    """
+    Актуальные коды бумаг вместе со всеми их прежними кодами
+
+    :param secids: List[str]: актуальные коды
+    :param renames: DataFrame: old_secid, new_secid
+    :return: List[str]
+    """
+
+    old_secids = renames.filter(pl.col('new_secid').is_in(secids))['old_secid'].to_list()
+    return list(secids) + old_secids
+
+
+def with_factors(df: pl.DataFrame, factors: pl.DataFrame, date_column: str) -> pl.DataFrame:
+    """
+    Присоединение коэффициента сплитов к строкам (одним as-of join'ом)
+
+    Строке с датой d соответствует коэффициент ближайшего сплита строго после d,
+    если такого сплита нет - 1. Порядок строк и типы столбцов сохраняются.
+
+    :param df: DataFrame со столбцами SECID и date_column
+    :param factors: DataFrame: SECID, date, factor (см. split_factors)
+    :param date_column: str: столбец с датой
+    :return: DataFrame со столбцом factor
+    """
+
+    return (df
+            .with_row_index('_row')
+            .with_columns(pl.col(date_column).cast(pl.Date).alias('_date'))
+            .sort('_date')
+            .join_asof(factors.rename({'date': '_date'}), on='_date', by='SECID',
+                       strategy='forward', allow_exact_matches=False, check_sortedness=False)
+            .sort('_row')
+            .drop('_row', '_date')
+            .with_columns(pl.col('factor').fill_null(1.0)))
+
+
+def adjust_operations(data: pl.DataFrame, factors: pl.DataFrame, renames: pl.DataFrame) -> pl.DataFrame:
+    """
+    История операций в актуальных кодах и единицах (с учетом сплитов и смены кодов)
+
+    :param data: DataFrame с историей операций: Date, SECID, Quantity, (Price)
+    :param factors: DataFrame: SECID, date, factor
+    :param renames: DataFrame: old_secid, new_secid
+    :return: DataFrame с теми же столбцами
+    """
+
+    if factors.is_empty() and renames.is_empty():
+        return data
+
+    df = with_factors(apply_renames(data, renames), factors, date_column='Date')
+    df = df.with_columns(pl.col('Quantity') * pl.col('factor'))
+    if 'Price' in df.columns:
+        df = df.with_columns(pl.col('Price') / pl.col('factor'))
+    return df.drop('factor')
+
+
+def adjust_prices(prices: pl.DataFrame, factors: pl.DataFrame, renames: pl.DataFrame,
+                  price_columns: List[str], date_column: str = 'Date') -> pl.DataFrame:
+    """
+    История цен в актуальных кодах и единицах (с учетом сплитов и смены кодов)
+
+    :param prices: DataFrame: SECID, date_column и столбцы цен
+    :param factors: DataFrame: SECID, date, factor
+    :param renames: DataFrame: old_secid, new_secid
+    :param price_columns: List[str]: столбцы цен, которые делятся на коэффициент
+    :param date_column: str: столбец с датой
+    :return: DataFrame с теми же столбцами
+    """
+
+    if factors.is_empty() and renames.is_empty():
+        return prices
+
+    return (with_factors(apply_renames(prices, renames), factors, date_column=date_column)
+            .with_columns([pl.col(col) / pl.col('factor') for col in price_columns])
+            .drop('factor'))
@@ -0,0 +1,338 @@
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import polars as pl
+
+from database import DatabaseManager
+
+
+def make_price_frame(rows: int) -> pl.DataFrame:
+    """
+    Синтетическая таблица цен для замеров: дата, SECID, цена, объем и флаг
+
+    :param rows: int: количество строк
+    :return: pl.DataFrame
+    """
+    start = date(year=2000, month=1, day=1)
+    return pl.DataFrame({
+        'date': pl.date_range(start, start + timedelta(days=rows // 500), eager=True)
+                  .sample(rows, with_replacement=True, seed=1),
+        'SECID': pl.Series([f"SEC{i % 500}" for i in range(rows)]),
+        'close': pl.Series(range(rows), dtype=pl.Float64) / 100,
+        'volume': pl.Series(range(rows), dtype=pl.Int64),
+        'traded': pl.Series([i % 2 == 0 for i in range(rows)]),
+    })
+
+
+def legacy_row_insert(db_path: str, df: pl.DataFrame, table_name: str, batch_size: int = 1000,
+                      columns: dict = None):
+    """
+    Прежний способ вставки (для сравнения): словарь на каждую строку,
+    кортеж на каждую строку и commit после каждого батча
+
+    :param columns: dict: {столбец: тип SQL} создаваемой таблицы (по умолчанию - столбцы make_price_frame)
+    """
+    if columns is None:
+        columns = {'date': 'TEXT', 'SECID': 'TEXT', 'close': 'REAL', 'volume': 'INTEGER', 'traded': 'INTEGER'}
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(f"CREATE TABLE {table_name} ({', '.join(f'{col} {col_type}' for col, col_type in columns.items())})")
+
+        data_to_insert = []
+        for row in df.iter_rows(named=True):
+            processed_row = {}
+            for col, value in row.items():
+                if value is None:
+                    processed_row[col] = None
+                elif isinstance(value, bool):
+                    processed_row[col] = int(value)
+                elif isinstance(value, date):
+                    processed_row[col] = str(value)
+                else:
+                    processed_row[col] = value
+            data_to_insert.append(processed_row)
+
+        columns_list = list(data_to_insert[0].keys())
+        insert_sql = f"INSERT INTO {table_name} ({', '.join(columns_list)}) VALUES ({', '.join(['?'] * len(columns_list))})"
+        cursor = conn.cursor()
+        for i in range(0, len(data_to_insert), batch_size):
+            batch = data_to_insert[i:i + batch_size]
+            cursor.executemany(insert_sql, [tuple(row[col] for col in columns_list) for row in batch])
+            conn.commit()
+
+
+def bench_insert(rows: int):
+    """Сравнение построчной и столбцовой загрузки DataFrame в SQLite"""
+    df = make_price_frame(rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        start = time.perf_counter()
+        legacy_row_insert(legacy_path, df, 'prices')
+        legacy_time = time.perf_counter() - start
+
+        # Столбцовая вставка отдельно от настроек PRAGMA: обычная транзакция и bulk_load
+        db = DatabaseManager(db_path=os.path.join(tmp, 'columnar.db'))
+        start = time.perf_counter()
+        db.add_dataframe_to_table(df=df, table_name='prices', batch_size=100_000)
+        columnar_time = time.perf_counter() - start
+        db.close()
+
+        db = DatabaseManager(db_path=os.path.join(tmp, 'bulk.db'))
+        start = time.perf_counter()
+        db.add_dataframe_to_table(df=df, table_name='prices', batch_size=100_000, bulk_load=True)
+        bulk_time = time.perf_counter() - start
+        db.close()
+
+    print(f"Строк: {rows}")
+    print(f"Построчная вставка: {legacy_time:.2f} c")
+    print(f"Столбцовая вставка: {columnar_time:.2f} c (x{legacy_time / columnar_time:.1f})")
+    print(f"Столбцовая вставка (bulk_load): {bulk_time:.2f} c (x{legacy_time / bulk_time:.1f})")
+
+
+def make_candles_pages(secids: int, years: int, page_size: int = 500) -> dict:
+    """
+    Синтетические ответы candles.json для замеров: дневные свечи по каждой бумаге за каждый год
+
+    :param secids: int: количество бумаг
+    :param years: int: количество лет
+    :param page_size: int: максимальное количество свечей на странице
+    :return: dict: {SECID: [ответы по годам, каждый - список страниц]}
+    """
+    columns = ['open', 'close', 'high', 'low', 'value', 'volume', 'begin', 'end']
+    pages = {}
+    for i in range(secids):
+        secid_pages = []
+        for year in range(2000, 2000 + years):
+            rows = []
+            day = date(year, 1, 1)
+            while day.year == year:
+                if day.weekday() < 5:
+                    price = 100 + (day.toordinal() + i) % 50 / 3
+                    rows.append([price, price + 1, price + 2, price - 1, 1000.0 * price, 1000,
+                                 f"{day} 10:00:00", f"{day} 23:59:59"])
+                day += timedelta(days=1)
+            secid_pages.append([{'candles': {'columns': columns, 'data': rows[start:start + page_size]}}
+                                for start in range(0, len(rows), page_size)])
+        pages[f"SEC{i}"] = secid_pages
+    return pages
+
+
+def legacy_pandas_ingest(pages: dict) -> pl.DataFrame:
+    """
+    Прежний разбор истории цен (для сравнения): словарь дата -> цена и pd.DataFrame на каждый год,
+    pd.concat по годам, pd.merge по бумагам и pl.from_pandas в конце
+    """
+    import pandas as pd
+
+    full_df = pd.DataFrame()
+    for secid, years in pages.items():
+        secid_df = pd.DataFrame()
+        for year_pages in years:
+            prices = {}
+            for page in year_pages:
+                for row in page['candles']['data']:
+                    prices[datetime.strptime(row[7], "%Y-%m-%d %H:%M:%S").date()] = row[1]
+            df = pd.DataFrame(list(prices.items()), columns=['date', secid])
+            secid_df = pd.concat([secid_df, df], ignore_index=True)
+        if not secid_df.empty:
+            full_df = secid_df if full_df.empty else pd.merge(full_df, secid_df, on='date', how='outer')
+    full_df.columns = full_df.columns.str.replace('-', '_')
+    return pl.from_pandas(full_df)
+
+
+def polars_ingest(pages: dict) -> int:
+    """Текущий разбор: один DataFrame Polars на бумагу из столбцов ответов ISS (см. Marketdata.candles_to_df)"""
+    from market import Marketdata
+
+    marketdata = Marketdata.__new__(Marketdata)
+    marketdata.candles_value_columns = ['open', 'high', 'low', 'close', 'volume', 'value']
+    rows = 0
+    for secid, years in pages.items():
+        rows += marketdata.candles_to_df(secid=secid,
+                                         pages=(page for year_pages in years for page in year_pages)).height
+    return rows
+
+
+def run_ingest(variant: str, secids: int, years: int):
+    """
+    Один замер разбора истории цен (запускается в отдельном процессе из bench_ingest,
+    чтобы пиковая память процесса относилась только к этому варианту)
+
+    Печатает время разбора в секундах и пиковую память процесса в МБ
+    """
+    import resource
+
+    pages = make_candles_pages(secids=secids, years=years)
+    # Модули импортируются до замера, чтобы в него не попало время импорта
+    if variant == 'pandas':
+        import pandas  # noqa: F401
+        function = legacy_pandas_ingest
+    else:
+        import market  # noqa: F401
+        function = polars_ingest
+
+    start = time.perf_counter()
+    function(pages)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(elapsed, peak)
+
+
+def run_subprocess(*args: str) -> str:
+    """Запуск python с аргументами в отдельном процессе, возвращает stdout"""
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, check=True).stdout
+
+
+def bench_ingest(secids: int, years: int):
+    """Сравнение разбора истории цен через pandas и напрямую в Polars"""
+    results = {}
+    for variant in ('pandas', 'polars'):
+        output = run_subprocess(os.path.abspath(__file__), 'ingest', '--variant', variant,
+                                '--secids', str(secids), '--years', str(years))
+        results[variant] = [float(value) for value in output.split()[-2:]]
+
+    code = "import time; start = time.perf_counter(); import pandas; print(time.perf_counter() - start)"
+    pandas_import = float(run_subprocess('-c', code))
+
+    (legacy_time, legacy_peak), (polars_time, polars_peak) = results['pandas'], results['polars']
+    print(f"Бумаг: {secids}, лет: {years}")
+    print(f"pandas (по годам, concat и merge): {legacy_time:.2f} c, пик памяти процесса {legacy_peak:.0f} МБ")
+    print(f"Polars (один DataFrame на бумагу): {polars_time:.2f} c, пик памяти процесса {polars_peak:.0f} МБ")
+    print(f"Ускорение: x{legacy_time / polars_time:.1f}")
+    print(f"Импорт pandas: {pandas_import:.2f} c")
+
+
+# Библиотеки, которые не должны импортироваться вместе с модулями проекта (см. lazy_imports)
+heavy_modules = ['polars', 'numpy', 'pandas', 'pyarrow', 'requests', 'tqdm', 'xlsx2csv']
+
+
+def measure_import(module: str) -> tuple:
+    """
+    Замер импорта модуля проекта в отдельном процессе (без кеша уже импортированных модулей)
+
+    :param module: str: имя модуля ('portfolio', 'market')
+    :return: tuple: время импорта в секундах и список импортированных тяжелых библиотек
+    """
+    code = (f"import sys, time; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+            f"start = time.perf_counter(); import {module}; elapsed = time.perf_counter() - start; "
+            f"print(elapsed, *[name for name in {heavy_modules!r} "
+            f"if any(loaded.startswith(name + '.') for loaded in sys.modules)])")
+    output = run_subprocess('-c', code).split()
+    return float(output[0]), output[1:]
+
+
+def bench_startup(budget: float, repeat: int = 5) -> bool:
+    """
+    Время импорта модулей проекта (медиана по repeat запускам) и проверка бюджета
+
+    Импорт не должен делать запросов к сети и базе и подключать тяжелые библиотеки:
+    они импортируются при первом использовании.
+
+    :param budget: float: допустимое время `import portfolio` в секундах
+    :param repeat: int: количество запусков
+    :return: bool: уложился ли импорт в бюджет
+    """
+    ok = True
+    for module in ('portfolio', 'market'):
+        results = [measure_import(module) for _ in range(repeat)]
+        elapsed = sorted(result[0] for result in results)[len(results) // 2]
+        heavy = sorted({name for result in results for name in result[1]})
+        print(f"import {module}: {elapsed * 1000:.0f} мс, тяжелые библиотеки: {', '.join(heavy) or 'нет'}")
+        if module == 'portfolio':
+            ok = elapsed <= budget and not heavy
+
+    print(f"Бюджет import portfolio: {budget * 1000:.0f} мс - {'OK' if ok else 'превышен'}")
+    return ok
+
+
+def bench_concurrency(rows: int, seconds: float):
+    """
+    Чтение во время замены таблицы: режим журнала DELETE (прежний) против WAL
+
+    Писатель в цикле заменяет таблицу цен через add_dataframe_to_table(if_exists='replace'),
+    все строки одной версии таблицы имеют один номер версии. Читатель в снимке
+    (DatabaseManager.snapshot) читает таблицу двумя запросами - обычным и через scan_table -
+    и проверяет, что оба видят одну и ту же версию целиком.
+
+    :param rows: int: количество строк в таблице
+    :param seconds: float: длительность замера для каждого режима
+    """
+    import threading
+
+    prices = make_price_frame(rows)
+    for wal in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DatabaseManager(db_path=os.path.join(tmp, 'concurrency.db'), wal=wal, busy_timeout=30)
+            db.add_dataframe_to_table(df=prices.with_columns(pl.lit(0).alias('version')), table_name='prices')
+
+            stop = threading.Event()
+            swaps = [0]
+
+            def writer():
+                version = 0
+                while not stop.is_set():
+                    version += 1
+                    if db.add_dataframe_to_table(df=prices.with_columns(pl.lit(version).alias('version')),
+                                                 table_name='prices', if_exists='replace'):
+                        swaps[0] += 1
+                db.close()
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+
+            reads, errors, inconsistent, latencies = 0, 0, 0, []
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    with db.snapshot() as conn:
+                        count, low, high = conn.execute("SELECT COUNT(*), MIN(version), MAX(version) "
+                                                        "FROM prices").fetchone()
+                        versions = db.scan_table('prices', columns=['version']).collect()['version']
+                    if count != rows or low != high or versions.len() != rows or versions.n_unique() != 1 \
+                            or versions[0] != low:
+                        inconsistent += 1
+                except sqlite3.Error:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+                reads += 1
+
+            stop.set()
+            thread.join()
+            db.close()
+
+        latencies.sort()
+        print(f"{'WAL' if wal else 'DELETE'}: замен таблицы {swaps[0]}, чтений {reads}, "
+              f"ошибок {errors}, несогласованных {inconsistent}, "
+              f"время чтения медиана {latencies[len(latencies) // 2] * 1000:.0f} мс, "
+              f"максимум {latencies[-1] * 1000:.0f} мс")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замеры производительности')
+    parser.add_argument('name', choices=['insert', 'ingest', 'startup', 'concurrency'], help='Какой замер запустить')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Количество строк')
+    parser.add_argument('--secids', type=int, default=50, help='Количество бумаг (ingest)')
+    parser.add_argument('--years', type=int, default=10, help='Количество лет (ingest)')
+    parser.add_argument('--seconds', type=float, default=10, help='Длительность замера, c (concurrency)')
+    parser.add_argument('--budget', type=float, default=0.1, help='Бюджет import portfolio, c (startup)')
+    parser.add_argument('--variant', choices=['pandas', 'polars'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.name == 'insert':
+        bench_insert(rows=args.rows)
+    elif args.name == 'ingest' and args.variant:
+        run_ingest(variant=args.variant, secids=args.secids, years=args.years)
+    elif args.name == 'ingest':
+        bench_ingest(secids=args.secids, years=args.years)
+    elif args.name == 'startup':
+        sys.exit(0 if bench_startup(budget=args.budget) else 1)
+    elif args.name == 'concurrency':
+        bench_concurrency(rows=args.rows, seconds=args.seconds)
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+from datetime import date
+from typing import Iterable, Optional
+
+import config
+from database import DatabaseManager
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
+
+
+logger = logging.getLogger(__name__)
+
+
+class PriceHistoryStore(object):
+    """
+    Колоночное хранилище истории цен рядом с SQL
+
+    История цен каждого типа актива хранится в Parquet-файлах по годам:
+    {root}/{тип актива}/year={год}/data.parquet. Файлы читаются через pl.scan_parquet
+    (с отображением в память и пропуском групп строк по статистике date), поэтому
+    чтение истории за несколько лет не проходит построчно через sqlite3.
+
+    Источник данных - таблицы SQL (см. Marketdata.get_price_history). Актуальные
+    годы перечислены в таблице config.columnar_state_table: Marketdata удаляет
+    оттуда годы в той же транзакции, в которой меняет историю цен (см. invalidate),
+    и возвращает их после выгрузки в Parquet (см. export). Годы, которых в ней нет,
+    читаются из SQL, поэтому данные в scan всегда совпадают с таблицами SQL.
+    Файлы пишутся без блокировки записи: год отмечается актуальным, только если
+    номер версии таблицы (см. DatabaseManager.touch_tables) не изменился после чтения.
+    """
+
+    def __init__(self, db: DatabaseManager, root: str = config.columnar_dir):
+        self.db = db
+        self.root = root
+        self.state_table = config.columnar_state_table
+        # Таблицы истории цен по типам активов (см. config.urls_settings)
+        self.tables = {active_type: settings[2] for active_type, settings in config.urls_settings.items()}
+
+    def partition_path(self, active_type: str, year: int) -> str:
+        """
+        Путь до файла с историей цен за год
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param year: int: год
+        :return: str
+        """
+        return os.path.join(self.root, active_type, f"year={year}", "data.parquet")
+
+    def ensure_state_table(self):
+        """Создание таблицы актуальных годов (тип актива, год), если ее еще нет"""
+        if not self.db.table_exists(self.state_table):
+            self.db.create_table(table_name=self.state_table,
+                                 columns={'active_type': 'TEXT NOT NULL', 'year': 'INTEGER NOT NULL'},
+                                 constraints=['PRIMARY KEY (active_type, year)'],
+                                 without_rowid=True)
+
+    def invalidate(self, active_type: str, years: Optional[Iterable[int]] = None):
+        """
+        Отметка годов как устаревших: до следующей выгрузки они читаются из SQL
+
+        Вызывается в транзакции, которая меняет историю цен, чтобы отметка
+        и изменение данных сохранялись (или откатывались) вместе. Номер версии таблицы
+        увеличивается: выгрузка, прочитавшая таблицу до изменения, не отметит год актуальным.
+
+        :param active_type: str: тип актива
+        :param years: Iterable[int]: годы (по умолчанию - все)
+        :return:
+        """
+        with self.db.transaction() as conn:
+            self.db.touch_tables(self.tables[active_type])
+            if not self.db.table_exists(self.state_table):
+                return
+
+            if years is None:
+                conn.execute(f"DELETE FROM {self.state_table} WHERE active_type = ?", (active_type,))
+            else:
+                conn.executemany(f"DELETE FROM {self.state_table} WHERE active_type = ? AND year = ?",
+                                 [(active_type, int(year)) for year in set(years)])
+
+    def fresh_years(self, active_type: str) -> set:
+        """
+        Годы, выгруженные в Parquet и не менявшиеся после выгрузки
+
+        :param active_type: str: тип актива
+        :return: set
+        """
+        if not self.db.table_exists(self.state_table):
+            return set()
+
+        rows = self.db.execute_safe(f"SELECT year FROM {self.state_table} WHERE active_type = ?", (active_type,))
+        return {row[0] for row in rows or []}
+
+    def export(self, active_type: str, years: Optional[Iterable[int]] = None) -> int:
+        """
+        Выгрузка истории цен из SQL в Parquet
+
+        Каждый год читается в снимке базы вместе с номером версии таблицы, файл пишется
+        во временный без блокировки записи. Затем в короткой транзакции записи проверяется
+        номер версии: если таблица не менялась, временный файл заменяет прежний и год
+        отмечается актуальным, иначе файл отбрасывается и год остается в SQL до следующей выгрузки.
+
+        :param active_type: str: тип актива
+        :param years: Iterable[int]: годы (по умолчанию - все годы, по которым есть данные
+            или есть файлы)
+        :return: int: количество выгруженных строк
+        """
+        table_name = self.tables[active_type]
+        if not self.db.table_exists(table_name):
+            return 0
+
+        self.ensure_state_table()
+
+        if years is None:
+            years = {int(row[0]) for row in self.db.execute_safe(
+                f"SELECT DISTINCT substr(date, 1, 4) FROM {table_name}") or []}
+            active_dir = os.path.join(self.root, active_type)
+            if os.path.isdir(active_dir):
+                years |= {int(name.split('=')[1]) for name in os.listdir(active_dir) if name.startswith('year=')}
+        years = sorted({int(year) for year in years})
+
+        rows = 0
+        skipped = []
+        for year in years:
+            path = self.partition_path(active_type, year)
+            with self.db.snapshot():
+                version = self.db.table_versions([table_name])
+                df = self.db.read_table_to_dataframe(
+                    table_name=table_name,
+                    where_conditions=[('date', '>=', f"{year}-01-01"), ('date', '<', f"{year + 1}-01-01")]
+                ).sort(['SECID', 'date'])
+            tmp_path = self.write_temporary(path, df)
+
+            with self.db.transaction() as conn:
+                if self.db.table_versions([table_name]) != version:
+                    if tmp_path is not None:
+                        os.remove(tmp_path)
+                    skipped.append(year)
+                    continue
+                self.replace_partition(tmp_path, path)
+                conn.execute(f"INSERT OR IGNORE INTO {self.state_table} (active_type, year) VALUES (?, ?)",
+                             (active_type, year))
+            rows += df.height
+
+        if skipped:
+            logger.info(f"История цен '{active_type}' изменилась во время выгрузки, "
+                        f"годы {skipped} остаются в SQL до следующей выгрузки")
+        logger.info(f"История цен '{active_type}' выгружена в Parquet: {rows} строк "
+                    f"за {len(years) - len(skipped)} лет")
+        return rows
+
+    @staticmethod
+    def write_temporary(path: str, df: pl.DataFrame) -> Optional[str]:
+        """
+        Запись истории цен за год во временный файл рядом с файлом года
+
+        :param path: str: путь до файла года
+        :param df: DataFrame с историей цен за год
+        :return: str: путь до временного файла (None - год пустой)
+        """
+        if df.is_empty():
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        df.write_parquet(tmp_path, statistics=True)
+        return tmp_path
+
+    @staticmethod
+    def replace_partition(tmp_path: Optional[str], path: str):
+        """
+        Замена файла года временным файлом (без временного файла - удаление файла года)
+
+        :param tmp_path: str: путь до временного файла (см. write_temporary)
+        :param path: str: путь до файла года
+        :return:
+        """
+        if tmp_path is not None:
+            os.replace(tmp_path, path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def scan(self, active_type: str, end_date: date = None) -> pl.LazyFrame:
+        """
+        Ленивое чтение истории цен: актуальные годы из Parquet, остальные из SQL
+
+        :param active_type: str: тип актива
+        :param end_date: date: последняя нужная дата (годы после нее не читаются)
+        :return: pl.LazyFrame с теми же столбцами, что и таблица SQL (SECID, date, open, ..., value)
+        """
+        table_name = self.tables[active_type]
+        if not self.db.table_exists(table_name):
+            return pl.LazyFrame(schema={'SECID': pl.Utf8, 'date': pl.Utf8, 'close': pl.Float64})
+
+        # Минимальная и максимальная дата - по покрывающему индексу (date, SECID, close)
+        bounds = self.db.execute_safe(f"SELECT (SELECT MIN(date) FROM {table_name}), "
+                                      f"(SELECT MAX(date) FROM {table_name})")
+        if not bounds or bounds[0][0] is None:
+            return self.db.scan_table(table_name)
+
+        first_year = int(bounds[0][0][:4])
+        last_year = int(bounds[0][1][:4]) if end_date is None else min(end_date.year, int(bounds[0][1][:4]))
+        fresh = self.fresh_years(active_type)
+
+        frames = []
+        files = [self.partition_path(active_type, year) for year in range(first_year, last_year + 1)
+                 if year in fresh and os.path.exists(self.partition_path(active_type, year))]
+        if files:
+            frames.append(pl.scan_parquet(files, hive_partitioning=False))
+
+        # Устаревшие годы читаются из SQL, подряд идущие годы - одним запросом
+        stale_years = [year for year in range(first_year, last_year + 1) if year not in fresh]
+        ranges = []
+        for year in stale_years:
+            if ranges and ranges[-1][1] == year - 1:
+                ranges[-1][1] = year
+            else:
+                ranges.append([year, year])
+        for start_year, end_year in ranges:
+            frames.append(self.db.scan_table(
+                table_name,
+                where_conditions=[('date', '>=', f"{start_year}-01-01"), ('date', '<', f"{end_year + 1}-01-01")]
+            ))
+
+        if not frames:
+            return self.db.scan_table(table_name).head(0)
+        if len(frames) == 1:
+            return frames[0]
+
+        schema = self.db.scan_table(table_name).collect_schema()
+        return pl.concat([frame.select([pl.col(col).cast(dtype) for col, dtype in schema.items()])
+                          for frame in frames])
@@ -1,14 +1,31 @@
+import os
+
 
 # Возможные значения для столбца 'Operation' в operation_history
 available_sell_operations = ['sell', 'продать','продала', 'шорт', 'short', 'продал']
 available_buy_operations = ['buy', 'купить', 'купила', 'лонг', 'long','купил']
 
+# Счет (портфель), к которому относятся операции без явно указанного счета
+default_account = 'main'
+
+# Корневой адрес API Мосбиржи (ISS). Все ссылки ниже строятся от него,
+# поэтому для отладки его можно подменить локальным сервером через переменную окружения ISS_URL
+iss_url = os.environ.get('ISS_URL', 'https://iss.moex.com/iss')
+
 # Ссылка на API Мосбиржи для сбора данных по акциям
-shares_url = 'https://iss.moex.com/iss/engines/stock/markets/shares/securities.json'
+shares_url = f'{iss_url}/engines/stock/markets/shares/securities.json'
 # Ссылка на API Мосбиржи для сбора данных по облигациям
-bonds_url = 'https://iss.moex.com/iss/engines/stock/markets/bonds/securities.json'
+bonds_url = f'{iss_url}/engines/stock/markets/bonds/securities.json'
 # Ссылка на API Мосбиржии для сбора данных по валютам
-currencies_url = 'https://iss.moex.com/iss/engines/currency/markets/index/securities.json'
+currencies_url = f'{iss_url}/engines/currency/markets/index/securities.json'
+
+# Ссылка на свечи (история цен) по бумаге
+candles_url = iss_url + '/engines/{engine}/markets/{market}/securities/{secid}/candles.json'
+# Максимальное количество свечей, которое ISS отдает на одной странице
+candles_page_size = 500
+# Сколько свечей одной бумаги собирается в один DataFrame перед записью в SQL
+# (см. Marketdata.iter_candle_batches): память загрузки не растет с длиной истории бумаги
+candles_batch_rows = 50_000
 
 # Данные для парсинга с маркетдаты. Формат:
 # тип актива: ['engine в маркетдате', 'market в маркетдате', 'название таблицы для sql']
@@ -17,8 +34,117 @@ urls_settings = {'currency' : ['currency', 'index', 'marketdata_currency', 1, 4,
                  'bonds' : ['stock', 'bonds', 'marketdata_bonds', 0, 2, bonds_url]}
 
 # Информцация о дроблении / консолидации фондового рынка
-split_url = 'https://iss.moex.com/iss/statistics/engines/stock/splits.json'
+split_url = f'{iss_url}/statistics/engines/stock/splits.json'
 
 # Информация по техническому изменению торговых кодов
-rename_url = 'https://iss.moex.com/iss/history/engines/stock/markets/shares/securities/changeover.json'
+rename_url = f'{iss_url}/history/engines/stock/markets/shares/securities/changeover.json'
+
+# Снимок текущих торгов (см. Marketdata.update_current_marketdata). Формат:
+# тип актива: ['название таблицы для sql', 'тип бумаг в таблице']
+current_marketdata_settings = {'currency': ['current_marketdata_currency', 'currency'],
+                               'shares': ['current_marketdata_shares', 'share'],
+                               'bonds': ['current_marketdata_bonds', 'bond']}
+# Режимы торгов фондов: бумаги рынка акций в этих режимах записываются в отдельную таблицу
+etf_boards = ['TQTF']
+etf_marketdata_settings = ['current_marketdata_etfs', 'etf']
+
+# Таблицы SQL со сплитами и сменой торговых кодов
+split_table = 'split_info'
+changeover_table = 'changeover_info'
+# Таблицы SQL с рассчитанными корректировками (см. Marketdata.build_adjustments)
+factors_table = 'adjustment_factors'
+renames_table = 'secid_renames'
+
+# Таблица SQL с курсами валют по датам (см. Marketdata.update_currency_rates)
+currency_rates_table = 'currency_rates'
+
+# Таблица SQL с позициями портфеля по датам (см. Portfolio.rebuild_positions)
+positions_table = 'positions_history'
+
+# Инкрементальная синхронизация истории цен: сколько последних дней запрашивать повторно
+# (незакрытая свеча текущего дня и поздние корректировки биржи)
+sync_overlap_days = 7
+
+# Параллельная загрузка данных с Мосбиржи
+# Максимальное количество одновременных запросов
+fetch_max_workers = 8
+# Максимальное количество запросов в секунду к одному хосту
+fetch_requests_per_second = 20
+# Таймауты запроса, секунды: (установка соединения, чтение ответа)
+fetch_timeout = (5, 30)
+# Сколько страниц на поток запрашивать вперед при параллельной загрузке (см. IssFetcher.fetch_many):
+# больше - меньше простоев пула, меньше - меньше загруженных, но еще не разобранных страниц в памяти
+fetch_prefetch_per_worker = 2
+# Количество попыток загрузки страницы
+fetch_retries = 5
+# Пауза между попытками: случайная от 0 до min(fetch_backoff_max, fetch_backoff_base * 2 ** номер попытки)
+fetch_backoff_base = 0.5
+fetch_backoff_max = 30
+
+# Кэш ответов ISS на диске (None - не кэшировать)
+fetch_cache_dir = '.iss_cache'
+# Сколько секунд ответ считается свежим. Свечи за период, закончившийся раньше
+# чем sync_overlap_days дней назад, не меняются и берутся из кэша без срока давности
+fetch_cache_ttl = 60
+
+# Количество строк в одной порции при потоковой загрузке истории операций из файла
+import_chunk_size = 100_000
+# Форматы дат операций в текстовых выгрузках брокеров (.csv, .parquet со строковой датой), в порядке проверки:
+# берется первый формат, по которому разбираются все даты порции (см. Portfolio.typization)
+operation_date_formats = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                          '%d.%m.%Y', '%d.%m.%Y %H:%M:%S', '%d.%m.%y', '%m-%d-%y']
+
+# Журнал SQLite в режиме WAL: чтение не ждет записи и видит последнее зафиксированное состояние базы,
+# запись не ждет завершения чтения (см. DatabaseManager.get_connection и DatabaseManager.snapshot)
+sqlite_wal = True
+# Сколько секунд запрос ждет освобождения блокировки записи, прежде чем завершиться ошибкой
+sqlite_busy_timeout = 30
+
+# Индексы таблиц SQL: {таблица: {название_индекса: [столбцы]}}.
+# Создаются вместе с таблицей и досоздаются в существующих таблицах (см. DatabaseManager.declare_indexes)
+table_indexes = {
+    # Операции по бумаге начиная с даты (пересчет позиций, правка и удаление строк)
+    # и операции за период (operations_history_by_period)
+    'operations_history': {'idx_operations_history_secid_date': ['SECID', 'Date'],
+                           'idx_operations_history_date': ['Date']},
+    # Покрывающий индекс "все цены на дату" для таблиц истории цен (см. Marketdata.ensure_price_history_table)
+    **{settings[2]: {f'idx_{settings[2]}_date': ['date', 'SECID', 'close']}
+       for settings in urls_settings.values()},
+}
+
+# Диагностика запросов: перед выполнением выводить в лог шаги плана с полным просмотром таблицы
+# (EXPLAIN QUERY PLAN, см. DatabaseManager.check_query_plan). Включается переменной окружения SQL_EXPLAIN=1
+explain_queries = os.environ.get('SQL_EXPLAIN') == '1'
+
+# Буфер записи операций (см. Portfolio.operations_buffer): накопленные операции записываются
+# одной транзакцией, когда их стало operations_buffer_size или с первой из них прошло
+# operations_buffer_delay секунд (None - только по количеству и при явном flush)
+operations_buffer_size = 500
+operations_buffer_delay = 1.0
+
+# Колоночное хранилище истории цен: Parquet-файлы по типу актива и году рядом с SQL
+# (см. columnar.PriceHistoryStore). None - история цен читается только из SQL
+columnar_dir = 'columnar'
+# Таблица SQL с годами, выгруженными в Parquet и не менявшимися после выгрузки
+columnar_state_table = 'columnar_partitions'
 
+# Планировщик обновления данных Мосбиржи (см. scheduler.RefreshScheduler)
+# Таблица SQL с результатами последних запусков задач
+scheduler_state_table = 'scheduler_state'
+# Количество задач, выполняемых одновременно
+scheduler_workers = 4
+# Часовой пояс расписания и торговые часы (по будням): снимки торгов обновляются только в них
+scheduler_timezone = 'Europe/Moscow'
+trading_hours = ('09:50', '18:50')
+# Как часто обновлять снимки текущих торгов и курсы валют, секунды
+snapshot_interval = 5 * 60
+fx_interval = 15 * 60
+# Время ночной синхронизации истории цен, сплитов и смены кодов
+nightly_sync_at = '02:00'
+# Случайная задержка запуска, до стольких секунд: задачи не обращаются к ISS в одну и ту же секунду
+snapshot_jitter = 30
+nightly_jitter = 15 * 60
+# Через сколько секунд повторить задачу после ошибки
+scheduler_retry_delay = 60
+# Как часто планировщик проверяет расписание, секунды
+scheduler_poll_interval = 1.0
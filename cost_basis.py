@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import logging
+from typing import List
+
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
+
+
+logger = logging.getLogger(__name__)
+
+# Доступные методы расчета себестоимости позиции
+available_methods = ['average', 'fifo', 'lifo']
+
+
+def position_keys(data: pl.DataFrame) -> List[str]:
+    """
+    Столбцы, определяющие позицию: бумага, а если в данных есть счета - счет и бумага
+
+    :param data: DataFrame с историей операций или позициями
+    :return: List[str]
+    """
+
+    return ['Account', 'SECID'] if 'Account' in data.columns else ['SECID']
+
+
+def prepare_operations(data: pl.DataFrame) -> pl.DataFrame:
+    """
+    Подготовка истории операций: сортировка по бумаге и дате (с сохранением порядка
+    операций внутри дня) и разметка каждой операции относительно позиции
+
+    Позиция бумаги делится на эпизоды: эпизод начинается, когда позиция открывается
+    из нуля или переходит через ноль (лонг -> шорт и наоборот). Операция, переходящая
+    через ноль, закрывает старую позицию (Close Quantity) и открывает новую (Open Quantity).
+
+    :param data: DataFrame: Date, (Account), SECID, Quantity (со знаком: продажа < 0), Price
+    :return: DataFrame с добавленными столбцами:
+        - Position: позиция после операции
+        - Previous Position: позиция до операции
+        - Episode: номер эпизода позиции внутри бумаги (счета и бумаги)
+        - Open Quantity: часть операции, открывающая / наращивающая позицию (со знаком)
+        - Close Quantity: часть операции, закрывающая позицию (по модулю)
+    """
+
+    keys = position_keys(data)
+    position = pl.col('Position')
+    previous = pl.col('Previous Position')
+    flip = previous.sign() * position.sign() < 0
+    increase = (previous == 0) | (pl.col('Quantity').sign() == previous.sign())
+
+    return (
+        data
+        .select(pl.col('Date').cast(pl.Date), *keys,
+                pl.col('Quantity').cast(pl.Float64), pl.col('Price').cast(pl.Float64))
+        # Номер операции (Seq) дается после сортировки: ноги операций в FIFO / LIFO
+        # упорядочиваются по нему, поэтому он должен идти по датам, а не по порядку хранения
+        .sort([*keys, 'Date'], maintain_order=True)
+        .with_row_index('Seq')
+        .with_columns(pl.col('Quantity').cum_sum().over(keys).alias('Position'))
+        .with_columns(position.shift(1, fill_value=0).over(keys).alias('Previous Position'))
+        .with_columns(
+            ((previous == 0) | flip).cum_sum().over(keys).alias('Episode'),
+            pl.when(flip).then(position)
+            .when(increase).then(pl.col('Quantity'))
+            .otherwise(0.0).alias('Open Quantity'),
+            pl.when(flip).then(previous.abs())
+            .when(increase).then(0.0)
+            .otherwise(pl.col('Quantity').abs()).alias('Close Quantity'),
+        )
+    )
+
+
+def average_cost(data: pl.DataFrame) -> pl.DataFrame:
+    """
+    Средневзвешенная цена позиции и реализованный результат по каждой операции
+
+    Стоимость позиции C меняется по рекуррентной формуле C_n = a_n * C_(n-1) + b_n:
+    наращивание позиции добавляет b_n = количество * цена, сокращение умножает
+    стоимость на долю оставшейся позиции a_n. Внутри эпизода это решается без цикла:
+    C_n = P_n * cum_sum(b_k / P_k), где P_n = cum_prod(a_n).
+
+    :param data: DataFrame после prepare_operations
+    :return: DataFrame с добавленными столбцами Average Price (после операции)
+        и Realized P&L (результат закрытой части операции)
+    """
+
+    keys = position_keys(data)
+    group = [*keys, 'Episode']
+    reduce = (pl.col('Close Quantity') > 0) & (pl.col('Open Quantity') == 0)
+    cost_added = pl.col('Open Quantity') * pl.col('Price')
+
+    return (
+        data
+        .with_columns(
+            pl.when(reduce).then(pl.col('Position') / pl.col('Previous Position'))
+            .otherwise(1.0).cum_prod().over(group).alias('_factor')
+        )
+        .with_columns(
+            pl.when(cost_added == 0).then(0.0)
+            .otherwise(cost_added / pl.col('_factor')).cum_sum().over(group).alias('_scaled_cost')
+        )
+        .with_columns(
+            pl.when(pl.col('Position') != 0)
+            .then(pl.col('_factor') * pl.col('_scaled_cost') / pl.col('Position'))
+            .alias('Average Price')
+        )
+        .with_columns(
+            (pl.col('Close Quantity')
+             * (pl.col('Price') - pl.col('Average Price').shift(1).over(keys))
+             * pl.col('Previous Position').sign()).fill_null(0.0).alias('Realized P&L')
+        )
+        .drop('_factor', '_scaled_cost')
+    )
+
+
+def operation_legs(data: pl.DataFrame) -> pl.DataFrame:
+    """
+    Разбиение операций на ноги открытия и закрытия позиции
+
+    Операция, переходящая через ноль, дает две ноги: закрытие в старом эпизоде
+    и открытие в новом. Количество в ногах - по модулю.
+
+    :param data: DataFrame после prepare_operations
+    :return: DataFrame: Seq, (Account), SECID, Episode, Side (+1 лонг / -1 шорт), Kind ('open' / 'close'),
+        Leg Quantity, Price
+    """
+
+    keys = position_keys(data)
+
+    closes = (data
+              .filter(pl.col('Close Quantity') > 0)
+              .select('Seq', *keys,
+                      # Закрывающая часть перехода через ноль относится к предыдущему эпизоду
+                      pl.when(pl.col('Open Quantity') != 0).then(pl.col('Episode') - 1)
+                      .otherwise(pl.col('Episode')).alias('Episode'),
+                      pl.col('Previous Position').sign().alias('Side'),
+                      pl.lit('close').alias('Kind'),
+                      pl.col('Close Quantity').alias('Leg Quantity'),
+                      'Price'))
+    opens = (data
+             .filter(pl.col('Open Quantity') != 0)
+             .select('Seq', *keys, 'Episode',
+                     pl.col('Open Quantity').sign().alias('Side'),
+                     pl.lit('open').alias('Kind'),
+                     pl.col('Open Quantity').abs().alias('Leg Quantity'),
+                     'Price'))
+
+    # Внутри одной операции закрытие идет раньше открытия
+    return pl.concat([closes, opens]).sort([*keys, 'Episode', 'Seq', 'Kind'])
+
+
+def fifo_cost(legs: pl.DataFrame) -> pl.DataFrame:
+    """
+    Себестоимость закрытий по FIFO
+
+    Открытия внутри эпизода выкладываются на ось накопленного количества
+    (лот k занимает отрезок [O_(k-1), O_k)), закрытия - на свою ось [S_(j-1), S_j).
+    Себестоимость первых X единиц F(X) находится as-of join'ом X с началом лота,
+    себестоимость закрытия j равна F(S_j) - F(S_(j-1)).
+
+    :param legs: DataFrame после operation_legs
+    :return: DataFrame закрытий: Seq, (Account), SECID, Episode, Side, Leg Quantity, Price, Cost
+    """
+
+    group = [*position_keys(legs), 'Episode']
+
+    lots = (legs
+            .filter(pl.col('Kind') == 'open')
+            .with_columns(
+                (pl.col('Leg Quantity').cum_sum().over(group) - pl.col('Leg Quantity')).alias('Lot Start'),
+                ((pl.col('Leg Quantity') * pl.col('Price')).cum_sum().over(group)
+                 - pl.col('Leg Quantity') * pl.col('Price')).alias('Cost Before'))
+            .select(*group, 'Lot Start', 'Cost Before', pl.col('Price').alias('Lot Price'))
+            .sort('Lot Start'))
+
+    closes = (legs
+              .filter(pl.col('Kind') == 'close')
+              .with_columns(pl.col('Leg Quantity').cum_sum().over(group).alias('Closed To'))
+              .with_columns((pl.col('Closed To') - pl.col('Leg Quantity')).alias('Closed From')))
+
+    def cost_of_first(column: str) -> pl.DataFrame:
+        # Себестоимость первых X единиц эпизода, X = column
+        return (closes
+                .select('Seq', *group, column)
+                .sort(column)
+                .join_asof(lots, left_on=column, right_on='Lot Start', by=group,
+                           strategy='backward', check_sortedness=False)
+                .select('Seq', (pl.col('Cost Before')
+                                + (pl.col(column) - pl.col('Lot Start')) * pl.col('Lot Price')).alias(column)))
+
+    return (closes
+            .drop('Closed To', 'Closed From')
+            .join(cost_of_first('Closed To'), on='Seq')
+            .join(cost_of_first('Closed From'), on='Seq')
+            .with_columns((pl.col('Closed To') - pl.col('Closed From')).alias('Cost'))
+            .drop('Closed To', 'Closed From', 'Kind'))
+
+
+def lifo_cost(legs: pl.DataFrame) -> pl.DataFrame:
+    """
+    Себестоимость закрытий по LIFO
+
+    LIFO - это стек лотов: закрытие забирает последние открытые лоты, и лот,
+    открытый после частичного закрытия, ложится поверх остатков старых. Такое
+    состояние не выражается накопленными суммами, поэтому ноги обходятся одним
+    линейным проходом по массивам numpy (без группировки по бумагам в Python).
+
+    :param legs: DataFrame после operation_legs
+    :return: DataFrame закрытий: Seq, (Account), SECID, Episode, Side, Leg Quantity, Price, Cost
+    """
+    import numpy as np
+
+    group_id = legs.select(pl.struct(*position_keys(legs), 'Episode').rank('dense')).to_series().to_numpy()
+    is_open = (legs['Kind'] == 'open').to_numpy()
+    quantities = legs['Leg Quantity'].to_numpy()
+    prices = legs['Price'].to_numpy()
+    costs = np.zeros(legs.height)
+
+    stack_quantity: List[float] = []
+    stack_price: List[float] = []
+    current_group = None
+
+    for i in range(legs.height):
+        if group_id[i] != current_group:
+            current_group = group_id[i]
+            stack_quantity.clear()
+            stack_price.clear()
+
+        if is_open[i]:
+            stack_quantity.append(quantities[i])
+            stack_price.append(prices[i])
+            continue
+
+        remaining = quantities[i]
+        cost = 0.0
+        while remaining > 1e-12 and stack_quantity:
+            taken = min(remaining, stack_quantity[-1])
+            cost += taken * stack_price[-1]
+            remaining -= taken
+            stack_quantity[-1] -= taken
+            if stack_quantity[-1] <= 1e-12:
+                stack_quantity.pop()
+                stack_price.pop()
+        costs[i] = cost
+
+    return (legs
+            .with_columns(pl.Series('Cost', costs))
+            .filter(pl.col('Kind') == 'close')
+            .drop('Kind'))
+
+
+def cost_basis(data: pl.DataFrame, method: str = 'average', prices: pl.DataFrame = None) -> pl.DataFrame:
+    """
+    Себестоимость позиций и финансовый результат по каждой бумаге
+
+    Если в истории есть столбец Account, результат считается по каждому счету
+    и бумаге за один проход по всем счетам.
+
+    :param data: DataFrame с историей операций: Date, (Account), SECID, Quantity (со знаком), Price
+    :param method: метод расчета себестоимости: 'average' (средневзвешенная), 'fifo', 'lifo'
+    :param prices: DataFrame с текущими ценами: SECID, MARKETPRICE (для нереализованного результата)
+    :return: DataFrame: (Account), SECID, Quantity, Average Price, Realized P&L, MARKETPRICE, Unrealized P&L
+    """
+
+    if method not in available_methods:
+        logger.error(f"Неизвестный метод расчета себестоимости {method}")
+        raise ValueError(f"Неизвестный метод расчета себестоимости {method}. Доступны: {available_methods}")
+
+    keys = position_keys(data)
+    group = [*keys, 'Episode']
+    operations = prepare_operations(data=data)
+
+    if method == 'average':
+        result = (average_cost(operations)
+                  .group_by(keys)
+                  .agg(pl.col('Position').last().alias('Quantity'),
+                       pl.col('Average Price').last(),
+                       pl.col('Realized P&L').sum()))
+    else:
+        legs = operation_legs(operations)
+        closes = fifo_cost(legs) if method == 'fifo' else lifo_cost(legs)
+
+        realized = (closes
+                    .with_columns((pl.col('Side') * (pl.col('Leg Quantity') * pl.col('Price') - pl.col('Cost')))
+                                  .alias('Realized P&L'))
+                    .group_by(keys)
+                    .agg(pl.col('Realized P&L').sum()))
+
+        # Себестоимость остатка в последнем эпизоде = открыто - закрыто
+        last_episode = (operations
+                        .group_by(keys)
+                        .agg(pl.col('Episode').last(), pl.col('Position').last().alias('Quantity')))
+        opened = (legs
+                  .filter(pl.col('Kind') == 'open')
+                  .group_by(group)
+                  .agg((pl.col('Leg Quantity') * pl.col('Price')).sum().alias('Opened Cost')))
+        closed = (closes
+                  .group_by(group)
+                  .agg(pl.col('Cost').sum().alias('Closed Cost')))
+
+        result = (last_episode
+                  .join(opened, on=group, how='left')
+                  .join(closed, on=group, how='left')
+                  .join(realized, on=keys, how='left')
+                  .with_columns(
+                      pl.when(pl.col('Quantity') != 0)
+                      .then((pl.col('Opened Cost').fill_null(0) - pl.col('Closed Cost').fill_null(0))
+                            / pl.col('Quantity').abs())
+                      .alias('Average Price'),
+                      pl.col('Realized P&L').fill_null(0.0))
+                  .select(*keys, 'Quantity', 'Average Price', 'Realized P&L'))
+
+    if prices is None:
+        prices = pl.DataFrame(schema={'SECID': pl.Utf8, 'MARKETPRICE': pl.Float64})
+
+    return (result
+            .join(prices.select('SECID', pl.col('MARKETPRICE').cast(pl.Float64)), on='SECID', how='left')
+            .with_columns(((pl.col('MARKETPRICE') - pl.col('Average Price')) * pl.col('Quantity'))
+                          .alias('Unrealized P&L'))
+            .sort(keys))
@@ -1,21 +1,305 @@
+from __future__ import annotations
+
 import sqlite3
+import json
 import logging
-from typing import Optional, List, Dict, Any
-import polars as pl
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
+from typing import Optional, List, Dict, Any, Iterator, Tuple
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
 
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Операторы сравнения Polars, которые переносятся в SQL (см. DatabaseManager.scan_table)
+_SQL_OPERATORS = {'Eq': '=', 'NotEq': '!=', 'Lt': '<', 'LtEq': '<=', 'Gt': '>', 'GtEq': '>='}
+# Тот же оператор, если столбец и значение в выражении стоят в обратном порядке (5 < col -> col > 5)
+_SWAPPED_OPERATORS = {'=': '=', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+# Версии Polars, для которых проверен JSON-формат Expr.meta.serialize (он не документирован и
+# меняется между версиями). На других версиях фильтры scan_table не переносятся в SQL,
+# а целиком применяются в Polars (см. requirements.txt и tests/test_database.py)
+_PUSHDOWN_POLARS_VERSIONS = ('1.33.',)
+
+
+def _literal_value(node: dict):
+    """Значение литерала из сериализованного выражения Polars (или KeyError, если тип не поддерживается)"""
+    scalar = node['Literal']
+    scalar = scalar.get('Scalar', scalar.get('Dyn'))
+    (kind, value), = scalar.items()
+    if kind in ('String', 'Int', 'Float', 'Int64', 'Int32', 'Float64', 'Boolean'):
+        return value
+    if kind == 'Date':
+        return str(date(1970, 1, 1) + timedelta(days=value))
+    raise KeyError(kind)
+
+
+def _predicate_to_conditions(predicate: pl.Expr) -> Tuple[List[Tuple[str, str, Any]], bool]:
+    """
+    Перевод фильтра Polars в условия SQL
+
+    Переводятся сравнения столбца с литералом, соединенные через & (остальное
+    фильтруется уже в Polars). На непроверенных версиях Polars (см. _PUSHDOWN_POLARS_VERSIONS)
+    фильтр не переводится.
+
+    Returns:
+        (список условий (столбец, оператор, значение), переведен ли фильтр целиком)
+    """
+    if not pl.__version__.startswith(_PUSHDOWN_POLARS_VERSIONS):
+        return [], False
+    try:
+        tree = json.loads(predicate.meta.serialize(format='json'))
+    except Exception:
+        return [], False
+
+    conditions = []
+    complete = True
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        binary = node.get('BinaryExpr') if isinstance(node, dict) else None
+        if binary is None:
+            complete = False
+            continue
+        if binary['op'] == 'And':
+            stack += [binary['left'], binary['right']]
+            continue
+
+        operator = _SQL_OPERATORS.get(binary['op'])
+        left, right = binary['left'], binary['right']
+        try:
+            if operator and 'Column' in left and 'Literal' in right:
+                conditions.append((left['Column'], operator, _literal_value(right)))
+            elif operator and 'Literal' in left and 'Column' in right:
+                conditions.append((right['Column'], _SWAPPED_OPERATORS[operator], _literal_value(left)))
+            else:
+                complete = False
+        except (KeyError, TypeError, ValueError):
+            complete = False
+
+    return conditions, complete
+
 
 class DatabaseManager(object):
-    def __init__(self, db_path: str):
+    # Таблица номеров версий таблиц (см. touch_tables)
+    versions_table = 'table_versions'
+
+    def __init__(self, db_path: str, indexes: Dict[str, Dict[str, List[str]]] = None,
+                 explain_queries: bool = False, wal: bool = False, busy_timeout: float = 5.0):
         self.db_path = db_path
+        # Журнал в режиме WAL (см. get_connection) и ожидание блокировки записи, секунды
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        # Одно долгоживущее соединение на поток (sqlite3 не разрешает делить соединение между потоками)
+        self._local = threading.local()
+        # Объявленные индексы: {таблица: {название_индекса: [столбцы]}} (см. declare_indexes)
+        self.indexes = {}
+        for table_name, table_indexes in (indexes or {}).items():
+            self.indexes[table_name] = dict(table_indexes)
+        # Диагностика: проверять план каждого запроса и предупреждать о полном просмотре таблиц
+        self.explain_queries = explain_queries
+        # Кэш схемы базы (см. get_schema): {таблица: [(столбец, тип, notnull, default, pk)]},
+        # типы Polars столбцов и PRAGMA schema_version, на которой кэш построен
+        self._schema = None
+        self._schema_dtypes = None
+        self._schema_version = None
+        self._schema_lock = threading.Lock()
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Возвращает соединение текущего потока, при первом обращении открывает его
+
+        Соединение открывается в режиме autocommit (isolation_level=None),
+        границы транзакций задаются явно через transaction(). При wal=True база
+        переводится в режим WAL (режим хранится в файле базы) с synchronous = NORMAL:
+        читатели не блокируют запись и не ждут ее, а видят последнее зафиксированное состояние.
+
+        Returns:
+            sqlite3.Connection: Соединение с базой данных
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False: ленивые запросы scan_table внутри snapshot выполняются
+            # потоком Polars на соединении снимка, пока поток-владелец ждет collect()
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=self.busy_timeout,
+                                   check_same_thread=False)
+            if self.wal:
+                try:
+                    conn.execute("PRAGMA journal_mode = WAL")
+                    conn.execute("PRAGMA synchronous = NORMAL")
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"Не удалось включить режим WAL: {e}")
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.snapshot = None
+            self._local.integer_checks = (None, {})
+        return conn
+
+    def close(self) -> None:
+        """Закрывает соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            self._local.depth = 0
+            self._local.snapshot = None
+            self._local.integer_checks = (None, {})
+
+    @contextmanager
+    def transaction(self, write: bool = True) -> Iterator[sqlite3.Connection]:
+        """
+        Контекст транзакции: все операции внутри используют одно соединение и один commit
+
+        Вложенные вызовы не открывают новую транзакцию, а создают SAVEPOINT,
+        поэтому ошибка во вложенном блоке откатывает только его изменения.
+
+        В режиме WAL транзакция записи сразу берет блокировку записи (BEGIN IMMEDIATE)
+        и при занятой базе ждет busy_timeout. Отложенная транзакция, начавшая с чтения,
+        при переходе к записи получила бы "database is locked" без ожидания.
+
+        Пример:
+            with db.transaction():
+                db.drop_table('a')
+                db.add_dataframe_to_table(df, 'a')
+
+        Args:
+            write (bool): Транзакция будет писать в базу (False - только чтение, см. snapshot)
+
+        Yields:
+            sqlite3.Connection: Соединение текущего потока
+        """
+        conn = self.get_connection()
+        depth = self._local.depth
+        savepoint = f"sp_{depth}"
+
+        if depth == 0:
+            conn.execute("BEGIN IMMEDIATE" if write and self.wal else "BEGIN")
+        else:
+            conn.execute(f"SAVEPOINT {savepoint}")
+        self._local.depth = depth + 1
+
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                conn.execute("ROLLBACK")
+            else:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+            # Откат мог отменить изменения схемы, которые уже попали в кэш
+            self.invalidate_schema()
+            raise
+        else:
+            self._local.depth = depth
+            if depth == 0:
+                conn.execute("COMMIT")
+            else:
+                conn.execute(f"RELEASE {savepoint}")
+
+    @contextmanager
+    def snapshot(self) -> Iterator[sqlite3.Connection]:
+        """
+        Согласованное чтение: все запросы внутри видят базу на один и тот же момент
+
+        Открывается транзакция чтения, снимок фиксируется первым чтением. Изменения,
+        зафиксированные другими соединениями после этого (например, замена таблицы
+        через add_dataframe_to_table), внутри снимка не видны. В режиме WAL снимок
+        не блокирует запись и не ждет ее. Ленивые запросы scan_table, созданные
+        внутри снимка, тоже читают из него.
+
+        Запись внутри снимка возможна, только если после его начала в базу никто
+        не записывал, поэтому подготовительные записи выполняются до snapshot.
+
+        Пример:
+            with db.snapshot():
+                positions = db.read_table_to_dataframe('positions_history')
+                prices = db.scan_table('marketdata_shares').collect()
+
+        Yields:
+            sqlite3.Connection: Соединение текущего потока
+        """
+        with self.transaction(write=False) as conn:
+            if self._local.snapshot is not None:
+                yield conn
+                return
+
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            self._local.snapshot = conn
+            try:
+                yield conn
+            finally:
+                self._local.snapshot = None
+
+    @contextmanager
+    def bulk_load(self) -> Iterator[sqlite3.Connection]:
+        """
+        Транзакция для массовой загрузки данных
+
+        На время загрузки отключается fsync (synchronous = OFF), временные структуры
+        держатся в памяти и увеличивается кэш страниц. После завершения прежние
+        значения PRAGMA восстанавливаются. Внутри уже открытой транзакции
+        PRAGMA не меняются и работает как обычный transaction().
+
+        Yields:
+            sqlite3.Connection: Соединение текущего потока
+        """
+        conn = self.get_connection()
+
+        if self._local.depth > 0:
+            with self.transaction() as conn:
+                yield conn
+            return
+
+        pragmas = {'synchronous': 'OFF', 'temp_store': 'MEMORY', 'cache_size': '-200000'}
+        previous = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in pragmas}
+
+        for name, value in pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        try:
+            with self.transaction() as conn:
+                yield conn
+        finally:
+            for name, value in previous.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+
+    @staticmethod
+    def to_sqlite_types(df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Приводит столбцы DataFrame к типам, которые sqlite3 принимает без адаптеров
+
+        Конвертация выполняется целыми столбцами:
+            - Date -> текст 'YYYY-MM-DD'
+            - Datetime -> текст 'YYYY-MM-DD HH:MM:SS'
+            - Time -> текст 'HH:MM:SS'
+            - Boolean -> 0 / 1
+
+        Args:
+            df (pl.DataFrame): Исходный DataFrame
+
+        Returns:
+            pl.DataFrame: DataFrame с конвертированными столбцами
+        """
+        conversions = []
+        for col, col_type in df.schema.items():
+            if col_type == pl.Date:
+                conversions.append(pl.col(col).dt.strftime('%Y-%m-%d'))
+            elif col_type == pl.Datetime:
+                conversions.append(pl.col(col).dt.strftime('%Y-%m-%d %H:%M:%S'))
+            elif col_type == pl.Time:
+                conversions.append(pl.col(col).dt.strftime('%H:%M:%S'))
+            elif col_type == pl.Boolean:
+                conversions.append(pl.col(col).cast(pl.Int8))
+
+        if conversions:
+            df = df.with_columns(conversions)
+        return df
 
     def create_table(self, table_name: str, columns: Dict[str, str],
                      primary_key: str = None, foreign_keys: List[Dict] = None,
-                     constraints: List[str] = None) -> bool:
+                     constraints: List[str] = None, without_rowid: bool = False) -> bool:
         """
         Функция для создания таблицы
 
@@ -25,6 +309,8 @@ class DatabaseManager(object):
             primary_key (str, optional): Название столбца первичного ключа
             foreign_keys (List[Dict], optional): Список внешних ключей
             constraints (List[str], optional): Дополнительные ограничения
+            without_rowid (bool, optional): Создать таблицу WITHOUT ROWID (строки хранятся
+                                            упорядоченными по составному первичному ключу)
 
         Returns:
             bool: Успешно ли создана таблица
@@ -36,7 +322,7 @@ class DatabaseManager(object):
 
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
 
                 # Формируем SQL запрос
@@ -64,10 +350,13 @@ class DatabaseManager(object):
                         sql_parts.append(f", {constraint}")
 
                 sql_parts.append(")")
+                if without_rowid:
+                    sql_parts.append(" WITHOUT ROWID")
                 sql = "".join(sql_parts)
 
                 cursor.execute(sql)
-                conn.commit()
+                self.invalidate_schema()
+                self.ensure_indexes(table_name)
 
                 logger.info(f"Таблица '{table_name}' успешно создана")
                 return True
@@ -76,43 +365,387 @@ class DatabaseManager(object):
             logger.error(f"Ошибка создания таблицы '{table_name}': {e}")
             return False
 
+    def declare_indexes(self, table_name: str, indexes: Dict[str, List[str]]) -> None:
+        """
+        Объявляет индексы таблицы
+
+        Объявленные индексы создаются вместе с таблицей (в том числе при пересоздании
+        через add_dataframe_to_table(if_exists="replace")), для существующей таблицы -
+        сразу же.
+
+        Args:
+            table_name (str): Название таблицы
+            indexes (Dict[str, List[str]]): Индексы в виде {название_индекса: [столбцы]}
+        """
+        self.indexes.setdefault(table_name, {}).update(indexes)
+        if self.table_exists(table_name):
+            self.ensure_indexes(table_name)
+
+    def create_index(self, table_name: str, columns: List[str],
+                     index_name: str = None, unique: bool = False) -> bool:
+        """
+        Создает индекс, если его еще нет
+
+        Args:
+            table_name (str): Название таблицы
+            columns (List[str]): Столбцы индекса (порядок важен для составного индекса)
+            index_name (str, optional): Название индекса (по умолчанию idx_таблица_столбцы)
+            unique (bool, optional): Уникальный индекс
+
+        Returns:
+            bool: Успешно ли создан индекс
+        """
+        if index_name is None:
+            index_name = f"idx_{table_name}_{'_'.join(columns)}".lower()
+
+        try:
+            with self.transaction() as conn:
+                conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} "
+                             f"ON {table_name} ({', '.join(columns)})")
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка создания индекса '{index_name}' таблицы '{table_name}': {e}")
+            return False
+
+    def ensure_indexes(self, table_name: str) -> None:
+        """
+        Создает недостающие объявленные индексы таблицы (см. declare_indexes)
+
+        Индекс по столбцам, которых в таблице нет (таблица старого формата), пропускается.
+
+        Args:
+            table_name (str): Название таблицы
+        """
+        declared = self.indexes.get(table_name)
+        if not declared:
+            return
+
+        table_columns = set(self.get_table_columns(table_name))
+        existing = self.get_indexes(table_name)
+        for index_name, columns in declared.items():
+            if index_name in existing:
+                continue
+            if not set(columns) <= table_columns:
+                logger.warning(f"Индекс '{index_name}' не создан: в таблице '{table_name}' "
+                               f"нет столбцов {set(columns) - table_columns}")
+                continue
+            if self.create_index(table_name, columns, index_name=index_name):
+                logger.info(f"Создан индекс '{index_name}' ({', '.join(columns)}) таблицы '{table_name}'")
+
+    def get_indexes(self, table_name: str) -> Dict[str, List[str]]:
+        """
+        Индексы таблицы
+
+        Args:
+            table_name (str): Название таблицы
+
+        Returns:
+            Dict[str, List[str]]: {название_индекса: [столбцы]}, включая автоматические
+                                  индексы первичного ключа и ограничений UNIQUE
+        """
+        try:
+            with self.transaction(write=False) as conn:
+                return {row[1]: [col[2] for col in conn.execute(f"PRAGMA index_info({row[1]})")]
+                        for row in conn.execute(f"PRAGMA index_list({table_name})").fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка получения индексов таблицы '{table_name}': {e}")
+            return {}
+
+    def explain_query_plan(self, sql: str, params: tuple = ()) -> List[str]:
+        """
+        План выполнения запроса (EXPLAIN QUERY PLAN)
+
+        Args:
+            sql (str): SQL запрос
+            params (tuple, optional): Параметры для плейсхолдеров '?'
+
+        Returns:
+            List[str]: Шаги плана, например "SEARCH operations_history USING INDEX ..."
+                       или "SCAN operations_history"
+        """
+        conn = self.get_connection()
+        return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", tuple(params)).fetchall()]
+
+    def check_query_plan(self, sql: str, params: tuple = ()) -> List[str]:
+        """
+        Проверка запроса на полный просмотр таблиц
+
+        Шаг плана SCAN означает чтение всей таблицы (или всего индекса; просмотр табличных
+        функций вроде json_each не учитывается) - для запросов
+        с условиями по дате или бумаге это признак недостающего индекса. Такие шаги
+        выводятся в лог предупреждением. В режиме explain_queries проверка выполняется
+        перед каждым запросом read_table_to_dataframe, execute_safe, delete_row и update_row.
+
+        Args:
+            sql (str): SQL запрос
+            params (tuple, optional): Параметры для плейсхолдеров '?'
+
+        Returns:
+            List[str]: Шаги плана с полным просмотром
+        """
+        try:
+            scans = [step for step in self.explain_query_plan(sql, params)
+                     if step.startswith('SCAN') and 'VIRTUAL TABLE' not in step and 'CONSTANT ROW' not in step]
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка получения плана запроса: {e}")
+            return []
+
+        for step in scans:
+            logger.warning(f"Полный просмотр в плане запроса: {step}. Запрос: {' '.join(sql.split())}")
+        return scans
+
+    def invalidate_schema(self) -> None:
+        """Сбрасывает кэш схемы базы (следующее обращение перечитает схему)"""
+        with self._schema_lock:
+            self._schema = None
+            self._schema_dtypes = None
+            self._schema_version = None
+
+    def _load_schema(self) -> Tuple[dict, dict]:
+        """
+        Кэш схемы базы, перечитывается при изменении PRAGMA schema_version
+
+        SQLite увеличивает schema_version при любом изменении схемы (CREATE, DROP, ALTER),
+        в том числе сделанном другим соединением или процессом, поэтому проверка версии
+        (одно чтение заголовка базы) заменяет запросы к sqlite_master и PRAGMA table_info.
+        Вся схема читается одним запросом.
+
+        Returns:
+            Tuple[dict, dict]: ({таблица: [(столбец, тип, notnull, default, pk)]},
+                                {таблица: {столбец: тип Polars}})
+        """
+        conn = self.get_connection()
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+
+        with self._schema_lock:
+            if self._schema is not None and self._schema_version == version:
+                return self._schema, self._schema_dtypes
+
+        schema = {}
+        for table_name, *column in conn.execute("""
+            SELECT m.name, p.name, p.type, p."notnull", p.dflt_value, p.pk
+            FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+            WHERE m.type = 'table'
+            ORDER BY m.name, p.cid
+        """):
+            schema.setdefault(table_name, []).append(tuple(column))
+
+        dtypes = {table_name: {name: self.polars_type(sql_type)
+                               for name, sql_type, *_ in columns
+                               if self.affinity(sql_type) in ('INTEGER', 'TEXT', 'REAL')}
+                  for table_name, columns in schema.items()}
+
+        with self._schema_lock:
+            self._schema, self._schema_dtypes, self._schema_version = schema, dtypes, version
+        return schema, dtypes
+
+    def get_schema(self) -> Dict[str, Dict[str, str]]:
+        """
+        Схема базы из кэша (см. _load_schema)
+
+        Returns:
+            Dict[str, Dict[str, str]]: {таблица: {столбец: объявленный тип}}
+        """
+        try:
+            schema, _ = self._load_schema()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения схемы базы: {e}")
+            return {}
+        return {table_name: {name: sql_type for name, sql_type, *_ in columns}
+                for table_name, columns in schema.items()}
+
+    def get_table_dtypes(self, table_name: str) -> Dict[str, Any]:
+        """
+        Типы Polars столбцов таблицы по объявленным типам (из кэша схемы)
+
+        Столбцы без объявленного типа и с типом NUMERIC (в них могут лежать и числа,
+        и текст) не включаются - их тип определяется по данным.
+
+        Args:
+            table_name (str): Название таблицы
+
+        Returns:
+            Dict[str, Any]: {столбец: тип Polars}
+        """
+        try:
+            _, dtypes = self._load_schema()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения схемы базы: {e}")
+            return {}
+        return dict(dtypes.get(table_name, {}))
+
+    def get_auto_columns(self, table_name: str) -> set:
+        """
+        Столбцы таблицы, которые заполняются автоматически (INTEGER PRIMARY KEY, DEFAULT)
+
+        Args:
+            table_name (str): Название таблицы
+
+        Returns:
+            set: Названия столбцов
+        """
+        schema, _ = self._load_schema()
+        return {name for name, sql_type, _, default, pk in schema.get(table_name, [])
+                if default is not None or (pk and sql_type.upper() == 'INTEGER')}
+
     def table_exists(self, table_name: str) -> bool:
-        """Проверяет, существует ли таблица"""
+        """Проверяет, существует ли таблица (по кэшу схемы, см. _load_schema)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT name FROM sqlite_master 
-                    WHERE type='table' AND name=?
-                """, (table_name,))
-                return cursor.fetchone() is not None
+            schema, _ = self._load_schema()
+            return table_name in schema
         except sqlite3.Error as e:
             logger.error(f"Ошибка проверки существования таблицы: {e}")
             return False
 
+    @staticmethod
+    def build_where_clause(where_conditions) -> Tuple[str, tuple]:
+        """
+        Условия WHERE для параметризованного запроса
+
+        Args:
+            where_conditions: Условия в виде словаря:
+                - {столбец: значение} - равенство
+                - {столбец: (оператор, значение)} - сравнение, например ('>=', '2024-01-01')
+                - {столбец: ('IN', [значения])} - вхождение в список
+                - {столбец: [(оператор, значение), ...]} - несколько условий на один столбец
+                или списком кортежей (столбец, оператор, значение)
+
+        Returns:
+            Tuple[str, tuple]: условия без слова WHERE (соединены AND) и значения параметров
+        """
+        if isinstance(where_conditions, dict):
+            conditions = []
+            for col, value in where_conditions.items():
+                # Если значение - кортеж, то первый элемент оператор, второй - значение
+                if isinstance(value, tuple) and len(value) == 2:
+                    conditions.append((col, *value))
+                elif isinstance(value, list):
+                    conditions += [(col, *condition) for condition in value]
+                else:
+                    # По умолчанию используем =
+                    conditions.append((col, '=', value))
+        else:
+            conditions = list(where_conditions or [])
+
+        where_clauses = []
+        where_values = []
+        for col, operator, value in conditions:
+            if operator.strip().upper() == 'IN':
+                values = list(value)
+                where_clauses.append(f"{col} IN ({', '.join(['?'] * len(values))})")
+                where_values += values
+            else:
+                where_clauses.append(f"{col} {operator} ?")
+                where_values.append(value)
+
+        return " AND ".join(where_clauses), tuple(where_values)
+
+    @staticmethod
+    def polars_type(sql_type: str):
+        """
+        Тип Polars для объявленного типа столбца SQLite (по правилам type affinity SQLite)
+
+        Args:
+            sql_type (str): объявленный тип столбца, например 'TEXT NOT NULL'
+
+        Returns:
+            тип Polars
+        """
+        affinity = DatabaseManager.affinity(sql_type)
+        if affinity == 'INTEGER':
+            return pl.Int64
+        if affinity == 'REAL':
+            return pl.Float64
+        return pl.Utf8
+
+    @staticmethod
+    def affinity(sql_type: str) -> str:
+        """
+        Type affinity SQLite для объявленного типа столбца
+
+        Args:
+            sql_type (str): объявленный тип столбца, например 'TEXT NOT NULL'
+
+        Returns:
+            str: 'INTEGER', 'TEXT', 'BLOB', 'REAL' или 'NUMERIC'
+        """
+        sql_type = (sql_type or '').upper()
+        if 'INT' in sql_type:
+            return 'INTEGER'
+        if any(name in sql_type for name in ('CHAR', 'CLOB', 'TEXT')):
+            return 'TEXT'
+        if not sql_type or 'BLOB' in sql_type:
+            return 'BLOB'
+        if any(name in sql_type for name in ('REAL', 'FLOA', 'DOUB')):
+            return 'REAL'
+        return 'NUMERIC'
+
+    def touch_tables(self, *table_names: str) -> None:
+        """
+        Отметка изменения таблиц: номер версии каждой таблицы увеличивается на 1
+
+        Номера хранятся в самой базе (таблица versions_table), поэтому их видят все
+        соединения и потоки, а отметка фиксируется в той же транзакции, что и изменение.
+        Методы записи DatabaseManager (add_dataframe_to_table, insert_row, delete_row,
+        update_row, drop_table, swap_table) отмечают таблицы сами, запись в таблицу
+        напрямую через соединение нужно отметить этим методом.
+
+        Args:
+            *table_names (str): Измененные таблицы
+        """
+        with self.transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.versions_table} "
+                         f"(table_name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID")
+            conn.executemany(f"INSERT INTO {self.versions_table} (table_name, version) VALUES (?, 1) "
+                             f"ON CONFLICT (table_name) DO UPDATE SET version = version + 1",
+                             [(table_name,) for table_name in table_names])
+
+    def table_versions(self, table_names: List[str]) -> tuple:
+        """
+        Номера версий таблиц для проверки актуальности кэшей (см. touch_tables)
+
+        Значение одинаково для всех соединений, поэтому кэш, построенный в одном потоке,
+        корректно проверяется в другом.
+
+        Args:
+            table_names (List[str]): Таблицы
+
+        Returns:
+            tuple: Номер версии каждой таблицы (0 - таблица не менялась)
+        """
+        if not self.table_exists(self.versions_table):
+            return (0,) * len(table_names)
+
+        conn = self.get_connection()
+        versions = dict(conn.execute(
+            f"SELECT table_name, version FROM {self.versions_table} "
+            f"WHERE table_name IN ({', '.join(['?'] * len(table_names))})", tuple(table_names)
+        ).fetchall())
+        return tuple(versions.get(table_name, 0) for table_name in table_names)
+
     def get_table_columns(self, table_name: str) -> List[str]:
-        """Возвращает список столбцов таблицы"""
+        """Возвращает список столбцов таблицы (по кэшу схемы, см. _load_schema)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = [column[1] for column in cursor.fetchall()]
-                return columns
+            schema, _ = self._load_schema()
+            return [column[0] for column in schema.get(table_name, [])]
         except sqlite3.Error as e:
             logger.error(f"Ошибка получения столбцов таблицы: {e}")
             return []
 
     def execute_safe(self, sql: str, params: tuple = ()) -> Optional[List]:
         """Безопасное выполнение SQL запроса"""
+        is_select = sql.strip().upper().startswith('SELECT')
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction(write=not is_select) as conn:
+                if self.explain_queries:
+                    self.check_query_plan(sql, params)
+
                 cursor = conn.cursor()
                 cursor.execute(sql, params)
 
-                if sql.strip().upper().startswith('SELECT'):
+                if is_select:
                     return cursor.fetchall()
                 else:
-                    conn.commit()
                     return None
 
         except sqlite3.Error as e:
@@ -135,13 +768,14 @@ class DatabaseManager(object):
             return False
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
 
                 sql = f"DROP TABLE {table_name}"
 
                 cursor.execute(sql)
-                conn.commit()
+                self.invalidate_schema()
+                self.touch_tables(table_name)
 
                 logger.info(f"Таблица '{table_name}' успешно удалена")
                 return True
@@ -150,9 +784,43 @@ class DatabaseManager(object):
             logger.error(f"Ошибка удаления таблицы '{table_name}': {e}")
             return False
 
+    def swap_table(self, shadow_table: str, table_name: str) -> bool:
+        """
+        Атомарная замена таблицы заранее построенной теневой таблицей
+
+        В одной транзакции старая таблица удаляется, теневая переименовывается
+        в ее имя и получает объявленные индексы (см. declare_indexes). Читатели
+        видят либо старую таблицу, либо новую целиком: таблица не пропадает
+        и не бывает загружена наполовину.
+
+        Args:
+            shadow_table (str): Таблица с новыми данными
+            table_name (str): Заменяемая таблица (может не существовать)
+
+        Returns:
+            bool: Успешно ли заменена таблица
+        """
+
+        try:
+            with self.transaction() as conn:
+                if self.table_exists(table_name):
+                    conn.execute(f"DROP TABLE {table_name}")
+                conn.execute(f"ALTER TABLE {shadow_table} RENAME TO {table_name}")
+                self.invalidate_schema()
+                self.ensure_indexes(table_name)
+                self.touch_tables(table_name)
+
+                logger.info(f"Таблица '{table_name}' заменена таблицей '{shadow_table}'")
+                return True
+
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка замены таблицы '{table_name}': {e}")
+            return False
+
     def add_dataframe_to_table(self, df: pl.DataFrame, table_name: str,
                                if_exists: str = "append",
-                               batch_size: int = 1000) -> bool:
+                               batch_size: int = 1000,
+                               bulk_load: bool = False) -> bool:
         """
         Добавляет DataFrame Polars в таблицу SQL
 
@@ -161,8 +829,13 @@ class DatabaseManager(object):
             table_name (str): Название таблицы в базе данных
             if_exists (str): Действие при существующей таблице:
                             - "append": добавить данные (по умолчанию)
-                            - "replace": удалить и пересоздать таблицу
+                            - "replace": заменить таблицу: данные загружаются в теневую
+                              таблицу, которая затем подменяет старую (см. swap_table)
+                            - "upsert": добавить данные, заменяя строки с совпадающим
+                              первичным ключом (INSERT OR REPLACE)
             batch_size (int): Размер батча для вставки данных
+            bulk_load (bool): Загрузка больших объемов: PRAGMA на время загрузки
+                            настраиваются под массовую вставку (см. bulk_load)
 
         Returns:
             bool: Успешно ли выполнена операция
@@ -172,14 +845,18 @@ class DatabaseManager(object):
             logger.warning("DataFrame пустой, нечего добавлять")
             return True
 
+        # При замене данные загружаются в теневую таблицу, старая остается доступной до подмены
+        target_table = table_name
+        if if_exists == "replace":
+            table_name = f"{target_table}__shadow"
+
         # Проверяем существование таблицы
         table_exists = self.table_exists(table_name)
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # Если таблица существует и нужно заменить
+            with (self.bulk_load() if bulk_load else self.transaction()) as conn:
+                # Теневая таблица могла остаться от прерванной загрузки
                 if table_exists and if_exists == "replace":
-                    logger.info(f"Пересоздание таблицы '{table_name}'")
                     self.drop_table(table_name)
                     table_exists = False
 
@@ -216,11 +893,13 @@ class DatabaseManager(object):
 
                 # Получаем список столбцов существующей таблицы
                 table_columns = self.get_table_columns(table_name)
+                # Столбцы, которые заполняются автоматически (INTEGER PRIMARY KEY, DEFAULT)
+                auto_columns = self.get_auto_columns(table_name)
 
                 # Проверяем соответствие столбцов
                 df_columns = df.columns
                 missing_columns = set(df_columns) - set(table_columns)
-                extra_columns = set(table_columns) - set(df_columns)
+                extra_columns = set(table_columns) - set(df_columns) - auto_columns
 
                 if missing_columns:
                     logger.warning(f"В таблице отсутствуют столбцы: {missing_columns}")
@@ -230,52 +909,44 @@ class DatabaseManager(object):
                 elif extra_columns:
                     logger.warning(f"В таблице есть лишние столбцы: {extra_columns}")
 
-                # Подготавливаем данные для вставки
-                data_to_insert = []
-                for row in df.iter_rows(named=True):
-                    # Конвертируем специальные типы данных
-                    processed_row = {}
-                    for col, value in row.items():
-                        if value is None:
-                            processed_row[col] = None
-                        elif isinstance(value, (pl.Date, pl.Datetime)):
-                            processed_row[col] = str(value)
-                        elif isinstance(value, bool):
-                            processed_row[col] = int(value)
-                        else:
-                            processed_row[col] = value
-                    data_to_insert.append(processed_row)
-
-                # Вставляем данные батчами
-                if data_to_insert:
-                    columns_list = list(data_to_insert[0].keys())
-                    placeholders = ", ".join(["?"] * len(columns_list))
-                    columns_str = ", ".join(columns_list)
-
-                    insert_sql = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders})"
-
-                    cursor = conn.cursor()
-
-                    # Вставка батчами для больших DataFrame
-                    for i in range(0, len(data_to_insert), batch_size):
-                        batch = data_to_insert[i:i + batch_size]
-                        batch_values = [tuple(row[col] for col in columns_list) for row in batch]
-
-                        try:
-                            cursor.executemany(insert_sql, batch_values)
-                            conn.commit()
-                            logger.info(
-                                f"Успешно добавлено {len(batch)} записей в таблицу '{table_name}' (батч {i // batch_size + 1})")
-                        except sqlite3.Error as e:
-                            conn.rollback()
-                            logger.error(f"Ошибка при вставке батча {i // batch_size + 1}: {e}")
-                            return False
-
-                logger.info(f"Успешно добавлено {len(data_to_insert)} записей в таблицу '{table_name}'")
+                # Подготавливаем данные для вставки: специальные типы конвертируются
+                # целыми столбцами, без промежуточных словарей на каждую строку
+                df = self.to_sqlite_types(df)
+
+                columns_list = df.columns
+                placeholders = ", ".join(["?"] * len(columns_list))
+                columns_str = ", ".join(columns_list)
+
+                insert_mode = "INSERT OR REPLACE" if if_exists == "upsert" else "INSERT"
+                insert_sql = f"{insert_mode} INTO {table_name} ({columns_str}) VALUES ({placeholders})"
+
+                cursor = conn.cursor()
+
+                # Вставка батчами для больших DataFrame, commit один на всю загрузку.
+                # Кортежи строк создаются только для текущего батча
+                for i, batch in enumerate(df.iter_slices(n_rows=batch_size)):
+                    try:
+                        cursor.executemany(insert_sql, batch.iter_rows())
+                        logger.debug(
+                            f"Успешно добавлено {batch.height} записей в таблицу '{table_name}' (батч {i + 1})")
+                    except sqlite3.Error as e:
+                        # Исключение откатывает всю загрузку целиком (см. transaction)
+                        logger.error(f"Ошибка при вставке батча {i + 1}: {e}")
+                        raise
+
+                if table_name != target_table:
+                    logger.info(f"Пересоздание таблицы '{target_table}'")
+                    if not self.swap_table(table_name, target_table):
+                        # Исключение откатывает загрузку, старая таблица остается
+                        raise sqlite3.OperationalError(f"не удалось заменить таблицу '{target_table}'")
+                else:
+                    self.touch_tables(table_name)
+
+                logger.info(f"Успешно добавлено {df.height} записей в таблицу '{target_table}'")
                 return True
 
         except Exception as e:
-            logger.error(f"Ошибка при добавлении DataFrame в таблицу '{table_name}': {e}")
+            logger.error(f"Ошибка при добавлении DataFrame в таблицу '{target_table}': {e}")
             return False
 
     def read_table_to_dataframe(self,
@@ -283,7 +954,8 @@ class DatabaseManager(object):
                                 sql_query: str = None,
                                 columns: List[str] = None,
                                 where_conditions: Dict[str, Any] = None,
-                                limit: int = None) -> pl.DataFrame:
+                                limit: int = None,
+                                params: tuple = ()) -> pl.DataFrame:
         """
         Выгружает данные из SQL таблицы в DataFrame Polars
 
@@ -292,7 +964,9 @@ class DatabaseManager(object):
             sql_query (str, optional): Произвольный SQL запрос для выполнения
             columns (List[str], optional): Список столбцов для выбора (если None - все столбцы)
             where_conditions (Dict[str, Any], optional): Условия WHERE в виде {столбец: значение}
+                или {столбец: (оператор, значение)} (см. build_where_clause)
             limit (int, optional): Ограничение количества строк
+            params (tuple, optional): Параметры для плейсхолдеров '?' в sql_query
 
         Returns:
             pl.DataFrame: DataFrame с данными из базы данных
@@ -305,10 +979,12 @@ class DatabaseManager(object):
             raise ValueError("Необходимо указать либо table_name, либо sql_query")
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction(write=False) as conn:
+                # Типы столбцов таблицы известны из кэша схемы: явная схема вместо
+                # определения типов по всем строкам результата
+                schema_overrides = None
                 if sql_query:
                     final_sql = sql_query
-                    params = ()
                 else:
                     if columns:
                         columns_str = ", ".join(columns)
@@ -318,27 +994,32 @@ class DatabaseManager(object):
                     final_sql = f"SELECT {columns_str} FROM {table_name}"
                     params = ()
 
+                    dtypes = self.get_table_dtypes(table_name)
+                    selected = columns or self.get_table_columns(table_name)
+                    if selected and all(col in dtypes for col in selected):
+                        schema_overrides = {col: dtypes[col] for col in selected}
+
+                    where_sql = None
                     if where_conditions:
-                        where_clauses = []
-                        where_values = []
-                        for col, value in where_conditions.items():
-                            # Если значение - кортеж, то первый элемент оператор, второй - значение
-                            if isinstance(value, tuple) and len(value) == 2:
-                                operator, actual_value = value
-                                where_clauses.append(f"{col} {operator} ?")
-                                where_values.append(actual_value)
-                            else:
-                                # По умолчанию используем =
-                                where_clauses.append(f"{col} = ?")
-                                where_values.append(value)
-
-                        final_sql += " WHERE " + " AND ".join(where_clauses)
-                        params = tuple(where_values)
+                        where_sql, params = self.build_where_clause(where_conditions)
+                        final_sql += " WHERE " + where_sql
+
+                    if schema_overrides and self.has_non_integer_values(
+                            conn, table_name, [col for col, dtype in schema_overrides.items() if dtype == pl.Int64],
+                            where_sql, params, limit):
+                        logger.warning(f"В целочисленных столбцах таблицы {table_name} есть нецелые значения, "
+                                       f"типы столбцов определяются по данным")
+                        schema_overrides = None
 
                     if limit:
                         final_sql += f" LIMIT {limit}"
 
-                df = pl.read_database(final_sql, conn, execute_options={"parameters": params}, infer_schema_length=None)
+                if self.explain_queries:
+                    self.check_query_plan(final_sql, params)
+
+                df = pl.read_database(final_sql, conn, execute_options={"parameters": params},
+                                      schema_overrides=schema_overrides,
+                                      infer_schema_length=0 if schema_overrides else None)
                 logger.info(f"Успешно загружено {len(df)} строк в DataFrame")
                 return df
 
@@ -346,6 +1027,179 @@ class DatabaseManager(object):
             logger.error(f"Ошибка при выгрузке данных в DataFrame: {e}")
             return pl.DataFrame()
 
+    def has_non_integer_values(self, conn, table_name: str, columns: List[str],
+                               where_sql: str = None, params: tuple = (), limit: int = None) -> bool:
+        """
+        Есть ли в столбцах с объявленным типом INTEGER значения других типов
+
+        SQLite хранит в таком столбце и дробные числа, и текст, которые не приводятся к целым
+        (1.5, 'abc'). По объявленному типу такой столбец читается как pl.Int64, и Polars
+        молча отбрасывает дробную часть, поэтому перед чтением по схеме
+        (см. read_table_to_dataframe) типы хранения проверяются одним запросом.
+
+        Результат запоминается для соединения до следующей записи в базу: пока никто
+        не пишет, не меняются PRAGMA data_version (записи других соединений), total_changes
+        (записи этого соединения) и PRAGMA schema_version. Номера версий таблиц
+        (см. touch_tables) для этого не подходят: запись напрямую через соединение их не меняет.
+
+        Args:
+            conn: Соединение SQLite
+            table_name (str): Название таблицы
+            columns (List[str]): Целочисленные столбцы
+            where_sql (str, optional): Условие WHERE читаемых строк (см. build_where_clause)
+            params (tuple): Параметры условия
+            limit (int, optional): Ограничение количества читаемых строк
+
+        Returns:
+            bool
+        """
+        if not columns:
+            return False
+
+        stamp = (*conn.execute("SELECT * FROM pragma_data_version, pragma_schema_version").fetchone(),
+                 conn.total_changes)
+        checked_stamp, checks = self._local.integer_checks
+        if checked_stamp != stamp:
+            checks = {}
+            self._local.integer_checks = (stamp, checks)
+
+        key = (table_name, tuple(columns), where_sql, tuple(params), limit)
+        if key not in checks:
+            # Проверяются только читаемые строки: те же условие и ограничение, что и у основного запроса
+            sql = f"SELECT {', '.join(columns)} FROM {table_name}"
+            if where_sql:
+                sql += f" WHERE {where_sql}"
+            if limit:
+                sql += f" LIMIT {int(limit)}"
+            condition = " OR ".join(f"typeof({col}) NOT IN ('integer', 'null')" for col in columns)
+            checks[key] = conn.execute(f"SELECT 1 FROM ({sql}) WHERE {condition} LIMIT 1",
+                                       params).fetchone() is not None
+        return checks[key]
+
+    def scan_table(self, table_name: str,
+                   columns: List[str] = None,
+                   where_conditions: Dict[str, Any] = None,
+                   batch_size: int = 100_000,
+                   date_columns: List[str] = None) -> pl.LazyFrame:
+        """
+        Ленивое чтение таблицы SQL в LazyFrame Polars
+
+        Запрос к базе выполняется только при collect(). В сгенерированный SQL переносятся:
+            - выбранные столбцы (select / with_columns по выбранным столбцам)
+            - условия where_conditions (в формате read_table_to_dataframe)
+            - фильтры Polars вида pl.col(...) <оператор> значение, соединенные через &
+              (например pl.col('SECID') == 'SBER'), остальные фильтры применяются в Polars
+            - head(n), если фильтр перенесен в SQL целиком (Polars 1.33 передает head только
+              в запрос без фильтра)
+        Строки читаются порциями по batch_size, вся таблица в память не выгружается.
+
+        Даты хранятся в SQLite текстом ('YYYY-MM-DD') и по умолчанию выдаются как pl.Utf8.
+        Столбцы из date_columns выдаются как pl.Date: их можно фильтровать датами Python
+        (pl.col('Date') <= date(2024, 1, 1)), такой фильтр тоже переносится в SQL.
+
+        Пример:
+            db.scan_table('operations_history').filter(pl.col('SECID') == 'SBER').select('Date', 'Quantity')
+
+        Args:
+            table_name (str): Название таблицы
+            columns (List[str], optional): Столбцы (если None - все столбцы)
+            where_conditions (Dict[str, Any], optional): Условия WHERE (см. build_where_clause)
+            batch_size (int): Размер порции строк
+            date_columns (List[str], optional): Текстовые столбцы с датами, которые выдаются как pl.Date
+
+        Returns:
+            pl.LazyFrame
+        """
+        from polars.io.plugins import register_io_source
+
+        table_schema = self.get_schema().get(table_name)
+        if not table_schema:
+            raise ValueError(f"Таблица '{table_name}' не существует")
+
+        schema = {name: self.polars_type(sql_type) for name, sql_type in table_schema.items()}
+        for col in date_columns or []:
+            if schema.get(col) != pl.Utf8:
+                raise ValueError(f"Столбец '{col}' таблицы '{table_name}' не текстовый и не может быть датой")
+            schema[col] = pl.Date
+        if columns:
+            schema = {col: schema[col] for col in columns}
+
+        base_sql, base_params = self.build_where_clause(where_conditions)
+        # Внутри snapshot запрос выполняется на соединении снимка (см. snapshot)
+        self.get_connection()
+        snapshot_conn = self._local.snapshot
+
+        def source(with_columns, predicate, n_rows, batch_size_hint):
+            select = list(with_columns) if with_columns else list(schema)
+            where_sql, params = base_sql, base_params
+            complete = True
+
+            if predicate is not None:
+                conditions, complete = _predicate_to_conditions(predicate)
+                pushed_sql, pushed_params = self.build_where_clause(conditions)
+                if pushed_sql:
+                    where_sql = f"{where_sql} AND {pushed_sql}" if where_sql else pushed_sql
+                    params = params + pushed_params
+                # Для фильтра в Polars нужны столбцы, на которые он ссылается
+                select_with_filter = select + [col for col in predicate.meta.root_names() if col not in select]
+            else:
+                select_with_filter = select
+
+            sql = f"SELECT {', '.join(select_with_filter)} FROM {table_name}"
+            if where_sql:
+                sql += f" WHERE {where_sql}"
+            if n_rows is not None and complete:
+                sql += f" LIMIT {int(n_rows)}"
+
+            # Даты читаются текстом и разбираются в Polars
+            batch_schema = {col: pl.Utf8 if schema[col] == pl.Date else schema[col] for col in select_with_filter}
+            dates = [pl.col(col).str.to_date(format='%Y-%m-%d') for col in select_with_filter
+                     if schema[col] == pl.Date]
+            # Генератор выполняется в потоке Polars: соединение берется для этого потока
+            conn = snapshot_conn if snapshot_conn is not None else self.get_connection()
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size_hint or batch_size)
+                    if not rows:
+                        return
+                    df = pl.DataFrame(rows, schema=batch_schema, orient='row')
+                    if dates:
+                        df = df.with_columns(dates)
+                    if predicate is not None and not complete:
+                        df = df.filter(predicate)
+                    yield df.select(select)
+            finally:
+                cursor.close()
+
+        return register_io_source(source, schema=schema)
+
+    def insert_row(self, table_name: str, data: Dict[str, Any]) -> Optional[int]:
+        """
+        Добавляет одну строку в таблицу
+
+        Args:
+            table_name (str): Название таблицы
+            data (Dict[str, Any]): Данные в виде {столбец: значение}
+
+        Returns:
+            Optional[int]: rowid добавленной строки (для таблицы с INTEGER PRIMARY KEY -
+                           значение первичного ключа), None при ошибке
+        """
+
+        try:
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"INSERT INTO {table_name} ({', '.join(data)}) "
+                               f"VALUES ({', '.join(['?'] * len(data))})", tuple(data.values()))
+                self.touch_tables(table_name)
+                logger.debug(f"Добавлена строка {cursor.lastrowid} в таблицу '{table_name}'")
+                return cursor.lastrowid
+
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка добавления строки в таблицу '{table_name}': {e}")
+            return None
+
     def delete_row(self, table_name: str, where_conditions: Dict[str, Any]) -> bool:
         """
         Удаляет строки из таблицы по условиям
@@ -367,29 +1221,18 @@ class DatabaseManager(object):
             return False
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
 
                 # Формируем условия WHERE
-                where_clauses = []
-                where_values = []
-
-                for col, value in where_conditions.items():
-                    # Поддержка различных операторов сравнения
-                    if isinstance(value, tuple) and len(value) == 2:
-                        operator, actual_value = value
-                        where_clauses.append(f"{col} {operator} ?")
-                        where_values.append(actual_value)
-                    else:
-                        # По умолчанию используем =
-                        where_clauses.append(f"{col} = ?")
-                        where_values.append(value)
-
-                where_sql = " AND ".join(where_clauses)
+                where_sql, where_values = self.build_where_clause(where_conditions)
                 sql = f"DELETE FROM {table_name} WHERE {where_sql}"
 
-                cursor.execute(sql, tuple(where_values))
-                conn.commit()
+                if self.explain_queries:
+                    self.check_query_plan(sql, where_values)
+
+                cursor.execute(sql, where_values)
+                self.touch_tables(table_name)
 
                 rows_affected = cursor.rowcount
                 logger.info(f"Удалено {rows_affected} строк из таблицы '{table_name}'")
@@ -426,7 +1269,7 @@ class DatabaseManager(object):
             return False
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
 
                 # Формируем часть SET для обновления
@@ -440,24 +1283,12 @@ class DatabaseManager(object):
                 set_sql = ", ".join(set_clauses)
 
                 # Формируем условия WHERE
-                where_clauses = []
-                where_values = []
-
-                for col, value in where_conditions.items():
-                    # Поддержка различных операторов сравнения
-                    if isinstance(value, tuple) and len(value) == 2:
-                        operator, actual_value = value
-                        where_clauses.append(f"{col} {operator} ?")
-                        where_values.append(actual_value)
-                    else:
-                        # По умолчанию используем =
-                        where_clauses.append(f"{col} = ?")
-                        where_values.append(value)
-
-                where_sql = " AND ".join(where_clauses)
+                where_sql, where_values = self.build_where_clause(where_conditions)
 
                 # Объединяем все значения для параметризованного запроса
                 find_rowid_sql = f"SELECT rowid FROM {table_name} WHERE {where_sql} LIMIT 1"
+                if self.explain_queries:
+                    self.check_query_plan(find_rowid_sql, where_values)
                 cursor.execute(find_rowid_sql, tuple(where_values))
                 result = cursor.fetchone()
 
@@ -472,7 +1303,7 @@ class DatabaseManager(object):
                 all_values = set_values + [rowid]
 
                 cursor.execute(sql, tuple(all_values))
-                conn.commit()
+                self.touch_tables(table_name)
 
                 rows_affected = cursor.rowcount
                 logger.info(f"Обновлено {rows_affected} строк в таблице '{table_name}'")
@@ -484,6 +1315,7 @@ class DatabaseManager(object):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     test = DatabaseManager(db_path="database.db")
     # test.create_table(table_name='tes',
     #                   columns={'id': 'INTEGER',
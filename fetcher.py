@@ -0,0 +1,280 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+from urllib.parse import urlparse, parse_qs
+
+import config
+from lazy_imports import lazy_import
+
+requests = lazy_import('requests')
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """
+    Ограничение частоты запросов отдельно для каждого хоста
+
+    Запросы к одному хосту разносятся по времени не чаще чем requests_per_second в секунду,
+    запросы к разным хостам друг друга не ждут.
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._lock = threading.Lock()
+        # хост: время, раньше которого нельзя отправить следующий запрос
+        self._next_slot = {}
+
+    def wait(self, url: str):
+        """
+        Блокирует поток до момента, когда к хосту из url можно обратиться
+
+        :param url: str: адрес запроса
+        """
+        if not self.interval:
+            return
+
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class IssFetchError(Exception):
+    """Страницу ISS не удалось загрузить за все попытки"""
+
+
+class ResponseCache(object):
+    """
+    Кэш ответов ISS на диске: один json-файл на url
+
+    Кроме тела ответа хранятся ETag / Last-Modified (для условного запроса,
+    когда срок свежести истек) и время загрузки.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, url: str) -> str:
+        """Файл кэша для url"""
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        Запись кэша по url
+
+        :param url: str: адрес запроса
+        :return: dict: body, etag, last_modified, fetched_at или None, если записи нет
+        """
+        try:
+            with open(self.path(url), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, body, etag: str = None, last_modified: str = None):
+        """
+        Сохранение ответа (через временный файл, чтобы параллельные чтения не видели половину записи)
+
+        :param url: str: адрес запроса
+        :param body: json ответа
+        :param etag: str: заголовок ETag
+        :param last_modified: str: заголовок Last-Modified
+        """
+        entry = {'url': url, 'body': body, 'etag': etag, 'last_modified': last_modified,
+                 'fetched_at': time.time()}
+        path = self.path(url)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def is_fresh(entry: dict, ttl: Optional[float]) -> bool:
+        """
+        Можно ли отдать запись без запроса к серверу
+
+        :param entry: dict: запись кэша
+        :param ttl: float: срок свежести в секундах, None - без срока давности
+        """
+        return ttl is None or time.time() - entry['fetched_at'] < ttl
+
+
+class IssFetcher(object):
+    """
+    Загрузка страниц ISS Мосбиржи: общая HTTP-сессия с keep-alive,
+    пул потоков для параллельных запросов, ограничение частоты по хосту,
+    таймауты, повторы с экспоненциальной паузой и кэш ответов на диске
+    """
+
+    # Ответы, после которых запрос имеет смысл повторить
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_workers: int = config.fetch_max_workers,
+                 requests_per_second: float = config.fetch_requests_per_second,
+                 timeout: tuple = config.fetch_timeout,
+                 backoff_base: float = config.fetch_backoff_base,
+                 backoff_max: float = config.fetch_backoff_max,
+                 cache_dir: Optional[str] = config.fetch_cache_dir,
+                 cache_ttl: float = config.fetch_cache_ttl,
+                 prefetch_per_worker: int = config.fetch_prefetch_per_worker):
+        self.max_workers = max_workers
+        # Сколько страниц на поток fetch_many запрашивает вперед, пока потребитель их не забрал
+        self.prefetch_per_worker = prefetch_per_worker
+        self.rate_limiter = RateLimiter(requests_per_second=requests_per_second)
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.cache_ttl = cache_ttl
+        # Подменяется в тестах, чтобы не ждать пауз между попытками
+        self.sleep = time.sleep
+
+        # Одна сессия на все потоки: соединения переиспользуются из пула adapter'а
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Пауза перед повтором: экспоненциальная с полным случайным разбросом,
+        чтобы параллельные потоки не повторяли запросы одновременно
+
+        :param attempt: int: номер неудачной попытки (с 0)
+        :return: float: пауза в секундах
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def ttl_for(self, url: str) -> Optional[float]:
+        """
+        Срок свежести ответа в кэше
+
+        Свечи за период, закончившийся раньше чем config.sync_overlap_days дней назад,
+        уже не меняются - для них срока давности нет. Остальные ответы свежи cache_ttl секунд.
+
+        :param url: str: адрес запроса
+        :return: float или None (без срока давности)
+        """
+        till = parse_qs(urlparse(url).query).get('till')
+        if till:
+            try:
+                if date.fromisoformat(till[0]) < date.today() - timedelta(days=config.sync_overlap_days):
+                    return None
+            except ValueError:
+                pass
+        return self.cache_ttl
+
+    def get_json(self, url: str, try_count: int = config.fetch_retries):
+        """
+        Загрузка одной страницы
+
+        Свежий ответ берется из кэша без запроса. Если в кэше есть устаревший ответ,
+        запрос отправляется с If-None-Match / If-Modified-Since, и на 304 отдается кэш.
+        Ошибки соединения, таймауты, 429 и 5xx повторяются с паузой (см. backoff),
+        остальные ошибки HTTP не повторяются.
+
+        :param url: str: url-адресс для подлкючения
+        :param try_count: int: количество попыток подключения
+        :return: dict: json формат страницы
+        :raises IssFetchError: если страницу не удалось загрузить
+        """
+
+        cached = self.cache.get(url) if self.cache else None
+        if cached is not None and self.cache.is_fresh(cached, self.ttl_for(url)):
+            return cached['body']
+
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        last_error = None
+        for attempt in range(try_count):
+            delay = None
+            try:
+                self.rate_limiter.wait(url)
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+                if response.status_code == 304 and cached is not None:
+                    self.cache.put(url, cached['body'], etag=cached.get('etag'),
+                                   last_modified=cached.get('last_modified'))
+                    return cached['body']
+
+                if response.status_code in self.retry_statuses:
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else None
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+
+                response.raise_for_status()
+                data = response.json()
+
+                if self.cache is not None:
+                    self.cache.put(url, data, etag=response.headers.get('ETag'),
+                                   last_modified=response.headers.get('Last-Modified'))
+                return data
+
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code not in self.retry_statuses:
+                    raise IssFetchError(f"Ошибка {e.response.status_code} при загрузке {url}") from e
+                last_error = e
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                last_error = e
+
+            logger.warning(f"Попытка {attempt + 1} из {try_count} загрузить {url} не удалась: {last_error}")
+            if attempt < try_count - 1:
+                self.sleep(max(delay or 0, self.backoff(attempt)))
+
+        logger.error(f"Не удалось подключиться к API мосбиржи по ссылке {url}")
+        raise IssFetchError(f"Не удалось загрузить {url}: {last_error}")
+
+    def fetch_many(self, urls: Iterable[str]) -> Iterator:
+        """
+        Параллельная загрузка нескольких страниц
+
+        Запросы выполняются в пуле из max_workers потоков, результаты отдаются
+        в том же порядке, в котором переданы url. Вперед запрашивается не больше
+        max_workers * prefetch_per_worker страниц: следующий url отправляется, когда
+        потребитель забирает очередной результат, поэтому в памяти не копятся
+        все загруженные страницы, если потребитель медленнее сети.
+
+        :param urls: Iterable[str]: адреса страниц
+        :return: Iterator: json каждой страницы (см. get_json)
+        :raises IssFetchError: при получении результата страницы, которую не удалось загрузить
+        """
+
+        urls = iter(urls)
+        window = self.max_workers * self.prefetch_per_worker
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            pending = deque(executor.submit(self.get_json, url) for url in islice(urls, window))
+            while pending:
+                future = pending.popleft()
+                for url in islice(urls, 1):
+                    pending.append(executor.submit(self.get_json, url))
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        """Закрывает HTTP-сессию"""
+        self.session.close()
@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import Counter
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs
+
+
+class IssStub(object):
+    """
+    Локальная замена ISS Мосбиржи для отладки загрузки данных и планировщика
+
+    Отдает те же блоки, что и ISS, для ссылок из config: списки бумаг со снимком торгов
+    (securities.json), дневные свечи по страницам (candles.json), сплиты и смену кодов.
+    Данные детерминированы: цена свечи зависит только от бумаги и даты. Запросы
+    считаются по путям (requests), ответы - по кодам (statuses). Ответ 200 содержит ETag,
+    запрос с тем же If-None-Match получает 304. Сбои задаются через fail: адрес отвечает
+    заданным кодом (503, 429, ...) все время или первые несколько раз.
+
+    Вместо сгенерированных данных можно отдавать записанные ответы ISS (fixtures_dir):
+    файл ищется по пути запроса без /iss, например
+    {fixtures_dir}/engines/stock/markets/shares/securities/SBER/candles.json. Свечи из такого
+    файла отбираются по from / till и отдаются страницами по page_size, как это делает ISS.
+
+    Использование:
+        with IssStub() as stub:
+            os.environ['ISS_URL'] = stub.url  # до импорта config и market
+    или из командной строки: python iss_stub.py --port 8765
+    """
+
+    # Бумаги по (engine, market): столбцы и строки блока securities, столбцы блока marketdata
+    securities = {
+        ('stock', 'shares'): {
+            'columns': ['SECID', 'BOARDID', 'SHORTNAME'],
+            'data': [['SBER', 'TQBR', 'Сбербанк'], ['GAZP', 'TQBR', 'ГАЗПРОМ ао'], ['TMOS', 'TQTF', 'БПИФ iMOEX']],
+            'marketdata': ['SECID', 'BOARDID', 'LAST', 'MARKETPRICE'],
+        },
+        ('stock', 'bonds'): {
+            'columns': ['SECID', 'BOARDID', 'SHORTNAME', 'FACEUNIT'],
+            'data': [['SU26238RMFS4', 'TQOB', 'ОФЗ 26238', 'SUR'], ['RU000A105A95', 'TQCB', 'Евр 2027', 'USD']],
+            'marketdata': ['SECID', 'BOARDID', 'LAST', 'MARKETPRICE'],
+        },
+        ('currency', 'index'): {
+            'columns': ['BOARDID', 'SECID', 'NAME', 'DECIMALS', 'SHORTNAME'],
+            'data': [['FIXI', 'USD', 'Курс доллара', 4, 'USD'], ['FIXI', 'CNY', 'Курс юаня', 4, 'CNY']],
+            'marketdata': ['SECID', 'BOARDID', 'LASTVALUE', 'CURRENTVALUE'],
+        },
+    }
+    candles_columns = ['open', 'close', 'high', 'low', 'value', 'volume', 'begin', 'end']
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, page_size: int = 500,
+                 splits: Optional[List[list]] = None, changeovers: Optional[List[list]] = None,
+                 fixtures_dir: Optional[str] = None):
+        # Размер страницы свечей, как у ISS (см. config.candles_page_size)
+        self.page_size = page_size
+        # Каталог с записанными ответами ISS и уже прочитанные из него файлы
+        self.fixtures_dir = fixtures_dir
+        self._fixtures = {}
+        # Строки блоков splits (tradedate, secid, before, after) и changeover (action_date, old_secid, new_secid)
+        self.splits = splits or []
+        self.changeovers = changeovers or []
+        self.requests = Counter()
+        # Все адреса запросов (с параметрами) в порядке поступления
+        self.urls = []
+        self.statuses = Counter()
+        # Сбои: {часть пути: [код ответа, сколько раз еще отвечать им (None - всегда)]}, см. fail
+        self.failures = {}
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят отдельными пакетами: без этого keep-alive ждет подтверждения ~40 мс
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Корневой адрес (значение для ISS_URL)"""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/iss"
+
+    def start(self) -> 'IssStub':
+        """Запуск сервера в фоновом потоке"""
+        self._thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Остановка сервера"""
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def fail(self, path: str, status: int = 503, times: Optional[int] = None):
+        """
+        Сбой адреса: запросы, путь которых содержит path, получают код status
+
+        :param path: str: часть пути запроса ('/securities/SBER/candles.json')
+        :param status: int: код ответа (503, 429, 500, ...)
+        :param times: int: сколько запросов получат сбой (None - все, пока не вызван recover)
+        """
+        with self._lock:
+            self.failures[path] = [status, times]
+
+    def recover(self, path: str = None):
+        """Отмена сбоя адреса (по умолчанию - всех сбоев)"""
+        with self._lock:
+            if path is None:
+                self.failures.clear()
+            else:
+                self.failures.pop(path, None)
+
+    def failure_status(self, path: str) -> Optional[int]:
+        """Код сбоя для пути запроса (вызывается под блокировкой) или None"""
+        for fail_path, failure in self.failures.items():
+            if fail_path in path:
+                status, times = failure
+                if times is not None:
+                    if times <= 0:
+                        continue
+                    failure[1] = times - 1
+                return status
+        return None
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        """Ответ на запрос: json-блоки как у ISS, 404 для неизвестных адресов"""
+        parsed = urlparse(request.path)
+        path = parsed.path
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        with self._lock:
+            self.requests[path] += 1
+            self.urls.append(request.path)
+            fail_status = self.failure_status(path)
+
+        body = None if fail_status else self.route(path, query)
+        headers = {}
+        if body is None:
+            status, payload = fail_status or 404, b''
+        else:
+            status, payload = 200, json.dumps(body).encode()
+            headers['ETag'] = f'"{hashlib.sha1(payload).hexdigest()}"'
+            if request.headers.get('If-None-Match') == headers['ETag']:
+                status, payload = 304, b''
+
+        with self._lock:
+            self.statuses[status] += 1
+
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def route(self, path: str, query: dict) -> Optional[dict]:
+        """
+        Тело ответа по пути запроса
+
+        :param path: str: путь запроса
+        :param query: dict: параметры запроса
+        :return: dict или None, если адрес неизвестен
+        """
+        fixture = self.fixture(path)
+        if fixture is not None:
+            if 'candles' in fixture:
+                return {'candles': {**fixture['candles'],
+                                    'data': self.recorded_candles(fixture['candles'], query)}}
+            return fixture
+
+        match = re.fullmatch(r'/iss/engines/(\w+)/markets/(\w+)/securities\.json', path)
+        if match:
+            return self.securities_page(engine=match.group(1), market=match.group(2))
+
+        match = re.fullmatch(r'/iss/engines/\w+/markets/\w+/securities/([\w-]+)/candles\.json', path)
+        if match:
+            date_from = self.query_date(query['from'], date.today())
+            date_till = self.query_date(query.get('till'), date.today())
+            return {'candles': {'columns': self.candles_columns,
+                                'data': self.candles(secid=match.group(1), date_from=date_from,
+                                                     date_till=date_till, start=int(query.get('start', 0)))}}
+
+        if path.endswith('/statistics/engines/stock/splits.json'):
+            return {'splits': {'columns': ['tradedate', 'secid', 'before', 'after'], 'data': self.splits}}
+
+        if path.endswith('/securities/changeover.json'):
+            return {'changeover': {'columns': ['action_date', 'old_secid', 'new_secid'], 'data': self.changeovers}}
+
+        return None
+
+    def fixture(self, path: str) -> Optional[dict]:
+        """
+        Записанный ответ ISS для пути запроса
+
+        :param path: str: путь запроса (/iss/engines/...)
+        :return: dict или None, если файла нет
+        """
+        if self.fixtures_dir is None or not path.startswith('/iss/'):
+            return None
+
+        with self._lock:
+            if path not in self._fixtures:
+                file_path = os.path.join(self.fixtures_dir, *path[len('/iss/'):].split('/'))
+                fixture = None
+                if os.path.isfile(file_path):
+                    with open(file_path, encoding='utf-8') as f:
+                        fixture = json.load(f)
+                self._fixtures[path] = fixture
+            return self._fixtures[path]
+
+    def recorded_candles(self, block: dict, query: dict) -> List[list]:
+        """
+        Страница записанных свечей: свечи с началом в периоде from - till, с позиции start
+
+        :param block: dict: блок candles записанного ответа
+        :param query: dict: параметры запроса
+        :return: List[list]: строки блока candles
+        """
+        begin = block['columns'].index('begin')
+        date_from = self.query_date(query.get('from'), date.min)
+        date_till = self.query_date(query.get('till'), date.max)
+        rows = [row for row in block['data'] if date_from <= date.fromisoformat(row[begin][:10]) <= date_till]
+        start = int(query.get('start', 0))
+        return rows[start:start + self.page_size]
+
+    @staticmethod
+    def query_date(value: Optional[str], default: date) -> date:
+        """Дата из параметра запроса (в ссылках бывает без ведущих нулей: 2023-1-5)"""
+        return date(*map(int, value.split('-'))) if value else default
+
+    def securities_page(self, engine: str, market: str) -> Optional[dict]:
+        """Блоки securities и marketdata списка бумаг рынка"""
+        settings = self.securities.get((engine, market))
+        if settings is None:
+            return None
+
+        secid_position = settings['columns'].index('SECID')
+        board_position = settings['columns'].index('BOARDID')
+        marketdata = []
+        for row in settings['data']:
+            price = self.price(row[secid_position], date.today())
+            marketdata.append([row[secid_position], row[board_position], price, price])
+
+        return {'securities': {'columns': settings['columns'], 'data': settings['data']},
+                'marketdata': {'columns': settings['marketdata'], 'data': marketdata}}
+
+    @staticmethod
+    def price(secid: str, day: date) -> float:
+        """Детерминированная цена бумаги на дату"""
+        return round(50 + sum(map(ord, secid)) % 200 + (day.toordinal() % 30) / 3, 2)
+
+    def candles(self, secid: str, date_from: date, date_till: date, start: int = 0) -> List[list]:
+        """Дневные свечи по будням за период, страница с позиции start"""
+        rows = []
+        day = date_from
+        while day <= date_till and len(rows) < start + self.page_size:
+            if day.weekday() < 5:
+                price = self.price(secid, day)
+                rows.append([price, price, price + 1, price - 1, price * 1000, 1000,
+                             f"{day} 00:00:00", f"{day} 23:59:59"])
+            day += timedelta(days=1)
+        return rows[start:start + self.page_size]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная замена ISS Мосбиржи')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    stub = IssStub(host=args.host, port=args.port)
+    print(f"ISS_URL={stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
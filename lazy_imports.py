@@ -0,0 +1,39 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Модуль, который импортируется при первом обращении к его атрибуту
+
+    Тяжелые библиотеки (polars, requests) подключаются так, чтобы `import portfolio`
+    и другие модули проекта не тратили время на их импорт, пока они не нужны.
+    Аннотации типов с ними не вычисляются (см. `from __future__ import annotations`
+    в модулях проекта), поэтому импорт происходит только при реальном использовании.
+    Найденный атрибут запоминается, повторные обращения идут напрямую.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        value = getattr(self._module, attr)
+        setattr(self, attr, value)
+        return value
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Отложенный импорт модуля
+
+    :param name: str: имя модуля ('polars', 'requests')
+    :return: модуль (уже импортированный) или LazyModule
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
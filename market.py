@@ -1,80 +1,170 @@
-import requests
-import polars as pl
+from __future__ import annotations
+
 from database import DatabaseManager
+from fetcher import IssFetcher, IssFetchError
+from columnar import PriceHistoryStore
 import logging
 import config
-from datetime import datetime, date
-from tqdm import tqdm
-import pandas as pd
+import adjustments
+from datetime import datetime, date, timedelta
+from typing import Dict, Iterable, Iterator
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
 
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class Marketdata(object):
-    def __init__(self):
+    def __init__(self, db_path: str = 'database.db'):
         # Пока что сделал все в одной базе данных, потом нужно подумать как лучше
-        self.DBS = DatabaseManager(db_path='database.db')
+        self.DBS = DatabaseManager(db_path=db_path, indexes=config.table_indexes,
+                                   explain_queries=config.explain_queries, wal=config.sqlite_wal,
+                                   busy_timeout=config.sqlite_busy_timeout)
         self.urls_settings = config.urls_settings
         self.split_url = config.split_url
         self.rename_url = config.rename_url
+        self.candles_url = config.candles_url
+        # Таблица с точками инкрементальной синхронизации истории цен
+        self.sync_state_table = 'price_sync_state'
+        # Столбцы таблиц истории цен (длинный формат)
+        self.candles_value_columns = ['open', 'high', 'low', 'close', 'volume', 'value']
+        self.price_history_columns = {'SECID': 'TEXT NOT NULL', 'date': 'TEXT NOT NULL',
+                                      **{col: 'REAL' for col in self.candles_value_columns}}
+        self.candles_page_size = config.candles_page_size
+        self.candles_batch_rows = config.candles_batch_rows
+        # Таблица курсов валют (currency, date) -> rate, см. update_currency_rates
+        self.currency_rates_table = config.currency_rates_table
+        # Таблицы снимка текущих торгов по типам активов, см. update_current_marketdata
+        self.current_marketdata_settings = config.current_marketdata_settings
+        # Общая HTTP-сессия и пул потоков для запросов к Мосбирже
+        self.fetcher = IssFetcher()
+        # Колоночная копия истории цен в Parquet (None - не используется)
+        self.price_store = PriceHistoryStore(self.DBS) if config.columnar_dir else None
 
 
     def translate_to_rub(self):
         """
-        Добавление в SQL столбца с валютой для каждой облигации
+        Обновление курсов валют для пересчета облигаций в рубли
+
+        Таблица current_marketdata_bonds больше не перезаписывается: курс присоединяется
+        к облигациям по FACEUNIT при чтении (см. Portfolio.market_snapshot и Portfolio.currency_rates),
+        поэтому обновление облигаций и обновление курсов не зависят друг от друга.
         :return:
         """
 
-        currency_df = self.DBS.read_table_to_dataframe(
-            table_name='current_marketdata_currency',
-            columns=['SECID', 'LASTVALUE']
-        )
-        currency_df = currency_df.rename({'LASTVALUE' : 'CURRENCY'})
+        self.update_currency_rates()
 
+    def ensure_currency_rates_table(self):
+        """
+        Создание таблицы курсов валют, если ее нет
 
-        bonds_df = self.DBS.read_table_to_dataframe(
-            table_name='current_marketdata_bonds'
-        )
+        Первичный ключ (currency, date): курс на дату - поиск по ключу.
+        :return:
+        """
 
-        # Соединение
-        try:
-            merged = bonds_df.join(
-                other=currency_df,
-                left_on='FACEUNIT',
-                right_on='SECID',
-                how='left'
-            )
-        except Exception as e:
-            logger.error('Ошибка при добавлении столбца с курсом валют в DataFrame')
-            raise e
+        if not self.DBS.table_exists(self.currency_rates_table):
+            self.DBS.create_table(table_name=self.currency_rates_table,
+                                  columns={'currency': 'TEXT NOT NULL', 'date': 'TEXT NOT NULL', 'rate': 'REAL'},
+                                  constraints=['PRIMARY KEY (currency, date)'],
+                                  without_rowid=True)
+
+    def update_currency_rates(self, start_date:date = None):
+        """
+        Инкрементальное обновление таблицы курсов валют
+
+        Из истории цен валют (см. get_price_history) копируются цены закрытия начиная
+        с start_date (по умолчанию - с последней сохраненной даты минус config.sync_overlap_days), текущие курсы
+        (LASTVALUE из current_marketdata_currency) записываются на сегодняшнюю дату.
+        Копирование выполняется внутри SQLite, без выгрузки в DataFrame.
+
+        :param start_date: date: с какой даты скопировать историю курсов
+        :return:
+        """
 
-        self.DBS.add_dataframe_to_table(df=merged,
-                                        table_name='current_marketdata_bonds',
-                                        if_exists='replace')
+        history_table = self.urls_settings['currency'][2]
+        today = str(date.today())
 
-        logger.info('Курсы валют успешно добавлены в базу данных')
+        with self.DBS.transaction() as conn:
+            self.ensure_currency_rates_table()
 
-    @staticmethod
-    def get_conn(url:str, try_count:int=5):
+            if self.DBS.table_exists(history_table):
+                if start_date is None:
+                    # Сегодняшний курс мог быть записан из текущих данных, он перезапишется закрытием.
+                    # Последние дни копируются повторно, как и при синхронизации истории цен
+                    last_date = conn.execute(f"SELECT MAX(date) FROM {self.currency_rates_table} WHERE date < ?",
+                                             (today,)).fetchone()[0]
+                    start_date = (date.fromisoformat(last_date) - timedelta(days=config.sync_overlap_days)
+                                  if last_date else '')
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO {self.currency_rates_table} (currency, date, rate)
+                    SELECT SECID, date, close FROM {history_table} WHERE date >= ? AND close IS NOT NULL
+                """, (str(start_date),))
+
+            if self.DBS.table_exists('current_marketdata_currency'):
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO {self.currency_rates_table} (currency, date, rate)
+                    SELECT SECID, ?, LASTVALUE FROM current_marketdata_currency WHERE LASTVALUE IS NOT NULL
+                """, (today,))
+
+            self.DBS.touch_tables(self.currency_rates_table)
+
+        logger.info('Курсы валют успешно обновлены')
+
+    def update_current_marketdata(self, active_type:str):
+        """
+        Обновление снимка текущих торгов (таблицы current_marketdata_*, см. Portfolio.market_snapshot)
+
+        Блоки securities и marketdata ответа ISS объединяются по (SECID, BOARDID).
+        Бумага, торгующаяся в нескольких режимах, остается одной строкой - с ценой, если она есть.
+        Бумаги режимов config.etf_boards записываются в отдельную таблицу фондов.
+        Таблицы заменяются целиком в одной транзакции.
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :return: bool: успешно ли обновлен снимок
+        """
+
+        try:
+            data = self.get_conn(url=self.urls_settings[active_type][5])
+        except IssFetchError as e:
+            logger.error(f"Не удалось подключиться к API Мосбиржи: {e}")
+            return False
+
+        securities = self.iss_block_to_df(data['securities'])
+        marketdata = self.iss_block_to_df(data['marketdata'])
+        df = securities.join(marketdata, on=['SECID', 'BOARDID'], how='left', suffix='_marketdata')
+        # Цена: у валют - значение индекса, у остальных - рыночная цена
+        price_column = 'LASTVALUE' if 'LASTVALUE' in df.columns else 'MARKETPRICE'
+        if price_column in df.columns:
+            df = df.sort(pl.col(price_column).is_null(), maintain_order=True)
+
+        table_name, securities_type = self.current_marketdata_settings[active_type]
+        tables = {table_name: df.filter(~pl.col('BOARDID').is_in(config.etf_boards))
+                                .with_columns(pl.lit(securities_type).alias('securities_type'))}
+        if active_type == 'shares':
+            etf_table, etf_type = config.etf_marketdata_settings
+            tables[etf_table] = (df.filter(pl.col('BOARDID').is_in(config.etf_boards))
+                                 .with_columns(pl.lit(etf_type).alias('securities_type')))
+
+        with self.DBS.transaction():
+            for table_name, table in tables.items():
+                table = table.unique(subset='SECID', keep='first', maintain_order=True)
+                self.DBS.add_dataframe_to_table(df=table, table_name=table_name, if_exists='replace')
+
+        logger.info(f"Снимок торгов '{active_type}' обновлен: {df['SECID'].n_unique()} бумаг")
+        return True
+
+    def get_conn(self, url:str, try_count:int=config.fetch_retries):
         """
         Установление подключения
 
         :param url: str: url-адресс для подлкючения
         :param try_count: int: количество попыток подключения
         :return: str: json формат страницы
+        :raises IssFetchError: если страницу не удалось загрузить (см. IssFetcher.get_json)
         """
 
-        for i in range(try_count):
-            try:
-                response = requests.get(url)
-                data = response.json()
-                return data
-            except:
-                continue
-        logger.error(f"Не удалось подключиться к API мосбиржи по ссылке {url}")
-        return False
+        return self.fetcher.get_json(url=url, try_count=try_count)
 
     @staticmethod
     def str_to_datetime(date_string: str, format_code: str):
@@ -113,145 +203,598 @@ class Marketdata(object):
         return False
 
 
+    def get_secids(self, active_type:str):
+        """
+        Список бумаг выбранного типа актива, торгующихся на Мосбирже
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :return: list: список SECID или False, если не удалось подключиться
+        """
+
+        first_ind = self.urls_settings[active_type][3]
+        second_ind = self.urls_settings[active_type][4]
+        active_url = self.urls_settings[active_type][5]
+
+        try:
+            data = self.get_conn(active_url)
+        except IssFetchError as e:
+            logger.error(f"Не удалось подключиться к API Мосбиржи: {e}")
+            return False
+
+        cur_data = data['securities']['data']
+        currencies = self.marketdata_proccesing(data=cur_data, first_ind=first_ind, second_ind=second_ind)
+        return list(currencies.keys()) if currencies else []
+
+    def get_candles_urls(self, active_type:str, secid:str, start_date:date, end_date:date):
+        """
+        Ссылки на дневные свечи по бумаге за период, по одной ссылке на каждый год
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param secid: str: код бумаги
+        :param start_date: date: дата начала периода
+        :param end_date: date: дата окончания периода
+        :return: list: список ссылок
+        """
+
+        engine = self.urls_settings[active_type][0]
+        market = self.urls_settings[active_type][1]
+        url = self.candles_url.format(engine=engine, market=market, secid=secid)
+
+        urls = []
+        for year in range(start_date.year, end_date.year+1):
+            # 1 год парсим с определенной даты, а все последующие годы с 1 января
+            if year == start_date.year:
+                date_from = f'{year}-{start_date.month}-{start_date.day}'
+            else:
+                date_from = f'{year}-01-01'
+
+            # Последний год парсим до определенной даты, а все предыдущие до 31 декабря
+            if year == end_date.year:
+                date_till = f'{year}-{end_date.month:02d}-{end_date.day:02d}'
+            else:
+                date_till = f'{year}-12-31'
+
+            urls.append(f'{url}?from={date_from}&till={date_till}&interval=24')
+        return urls
+
+    @staticmethod
+    def iss_to_df(blocks: Iterable[dict], columns: Dict[str, str], schema: Dict[str, pl.DataType]) -> pl.DataFrame:
+        """
+        DataFrame из блоков ответа ISS вида {'columns': [...], 'data': [[...], ...]}
+
+        Значения нужных столбцов всех блоков (например страниц свечей одной порции, см.
+        iter_candle_batches) собираются в списки по столбцам, DataFrame строится один раз,
+        без промежуточных DataFrame и concat. Сами ответы после разбора не хранятся, но
+        значения всех переданных блоков держатся в памяти до построения DataFrame, поэтому
+        количество блоков в одном вызове должно быть ограничено.
+
+        :param blocks: Iterable[dict]: блоки ответа ISS
+        :param columns: Dict[str, str]: {столбец ISS: столбец DataFrame}
+        :param schema: Dict[str, pl.DataType]: типы столбцов DataFrame
+        :return: pl.DataFrame
+        """
+
+        data = {name: [] for name in columns.values()}
+        for block in blocks:
+            positions = [block['columns'].index(iss_column) for iss_column in columns]
+            for name, position in zip(columns.values(), positions):
+                data[name].extend([row[position] for row in block['data']])
+
+        return pl.DataFrame(data, schema=schema, strict=False)
+
+    @staticmethod
+    def iss_block_to_df(block: dict) -> pl.DataFrame:
+        """
+        DataFrame из блока ответа ISS со всеми его столбцами
+
+        Типы столбцов определяются по данным, пустые столбцы считаются текстовыми.
+
+        :param block: dict: блок ответа ISS вида {'columns': [...], 'data': [[...], ...]}
+        :return: pl.DataFrame
+        """
+
+        df = pl.DataFrame(block['data'], schema=block['columns'], orient='row',
+                          infer_schema_length=None, strict=False)
+        return df.with_columns(pl.col(pl.Null).cast(pl.Utf8))
+
+    def candles_to_df(self, secid:str, pages: Iterable[dict]) -> pl.DataFrame:
+        """
+        Преобразование страниц candles.json одной бумаги в DataFrame длинного формата
+
+        Столбцы берутся по названиям из блока columns ответа, датой свечи считается
+        дата ее окончания (end). Все переданные страницы попадают в один DataFrame,
+        для длинной истории страницы передаются порциями (см. iter_candle_batches).
+
+        :param secid: str: код бумаги
+        :param pages: Iterable[dict]: json-ответы со свечами (см. iter_candle_pages)
+        :return: pl.DataFrame: столбцы SECID, date, open, high, low, close, volume, value
+        """
+
+        df = self.iss_to_df(blocks=(page['candles'] for page in pages),
+                            columns={'end': 'date', **{col: col for col in self.candles_value_columns}},
+                            schema={'date': pl.Utf8, **{col: pl.Float64 for col in self.candles_value_columns}})
+
+        return df.select(
+            pl.lit(secid, dtype=pl.Utf8).alias('SECID'),
+            pl.col('date').str.slice(0, 10).str.to_date(format='%Y-%m-%d'),
+            *self.candles_value_columns,
+        )
+
+    def iter_candle_pages(self, url:str, first_page=None) -> Iterator[dict]:
+        """
+        Постраничное чтение свечей
+
+        ISS отдает свечи страницами не больше config.candles_page_size строк. Следующая
+        страница запрашивается параметром start= только когда предыдущая прочитана.
+        Если страницу загрузить не удалось, выбрасывается IssFetchError (а не обрезается история):
+        get_price_history не трогает основную таблицу, sync_price_history не сдвигает
+        точку синхронизации бумаги.
+
+        :param url: str: ссылка на свечи (см. get_candles_urls)
+        :param first_page: json первой страницы, если она уже загружена
+        :return: Iterator[dict]: непустые страницы (json-ответы)
+        """
+
+        start = 0
+        page = first_page if first_page is not None else self.get_conn(url=f'{url}&start={start}')
+
+        while True:
+            data = page['candles']['data']
+            if data:
+                yield page
+
+            if len(data) < self.candles_page_size:
+                return
+
+            start += len(data)
+            page = self.get_conn(url=f'{url}&start={start}')
+
+    def iter_candle_batches(self, secid:str, pages: Iterable[dict], batch_rows:int = None) -> Iterator[pl.DataFrame]:
+        """
+        Свечи одной бумаги порциями: страницы копятся, пока в них не наберется
+        batch_rows свечей, и превращаются в один DataFrame (см. candles_to_df)
+
+        В памяти одновременно только одна порция, поэтому память загрузки не растет
+        с длиной истории, а DataFrame и вставка в SQL приходятся на порцию, а не на страницу.
+
+        :param secid: str: код бумаги
+        :param pages: Iterable[dict]: json-ответы со свечами по возрастанию дат (см. iter_candle_pages)
+        :param batch_rows: int: свечей в порции (по умолчанию config.candles_batch_rows)
+        :return: Iterator[pl.DataFrame]: непустые порции свечей
+        """
+
+        batch_rows = batch_rows or self.candles_batch_rows
+        batch, rows = [], 0
+        for page in pages:
+            batch.append(page)
+            rows += len(page['candles']['data'])
+            if rows >= batch_rows:
+                yield self.candles_to_df(secid=secid, pages=batch)
+                batch, rows = [], 0
+
+        if rows:
+            yield self.candles_to_df(secid=secid, pages=batch)
+
+    def ensure_price_history_table(self, active_type:str):
+        """
+        Создание таблицы истории цен в длинном формате (одна строка на бумагу и дату)
+
+        Хранятся цены open / high / low / close, объем в штуках (volume) и в деньгах (value).
+        Первичный ключ (SECID, date), таблица WITHOUT ROWID, поэтому строки хранятся
+        упорядоченными по бумаге и дате: цена бумаги на дату и история одной бумаги
+        читаются по ключу. Покрывающий индекс (date, SECID, close) отвечает на запрос
+        "все цены на дату" без обращения к таблице.
+        Таблица в прежнем широком формате (столбец на каждую бумагу) переводится в длинный.
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :return:
+        """
+
+        table_name = self.urls_settings[active_type][2]
+
+        with self.DBS.transaction() as conn:
+            legacy_df = None
+            if self.DBS.table_exists(table_name):
+                table_columns = self.DBS.get_table_columns(table_name)
+                if 'SECID' in table_columns:
+                    # Таблица в длинном формате, но без части столбцов свечей
+                    for col, col_type in self.price_history_columns.items():
+                        if col not in table_columns:
+                            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {col} {col_type}")
+                    self.DBS.ensure_indexes(table_name)
+                    return
+                logger.info(f"Перевод таблицы '{table_name}' из широкого формата в длинный")
+                legacy_df = self.DBS.read_table_to_dataframe(table_name=table_name)
+                self.DBS.drop_table(table_name)
+
+            self.DBS.create_table(table_name=table_name,
+                                  columns=self.price_history_columns,
+                                  constraints=['PRIMARY KEY (SECID, date)'],
+                                  without_rowid=True)
+
+            if legacy_df is not None and not legacy_df.is_empty():
+                long_df = (legacy_df
+                           .unpivot(index='date', variable_name='SECID', value_name='close')
+                           .drop_nulls('close'))
+                self.DBS.add_dataframe_to_table(df=long_df, table_name=table_name, if_exists='upsert')
+                if self.price_store is not None:
+                    self.price_store.invalidate(active_type)
+
     def get_price_history(self, active_type:str, operation:str,
                          start_date:date = date(year=2000, month=1, day=1),
-                         end_year = datetime.now().year):
+                         end_year = None):
         """
-        Парсинг валютных курсов
+        Парсинг истории цен
+
+        Свечи сохраняются в длинном формате (SECID, date, open, ..., value), см. ensure_price_history_table.
+        Широкая таблица (столбец на каждую бумагу) строится по запросу в get_price_history_wide.
+
+        Загрузка идет в теневую таблицу вне транзакции основной таблицы, поэтому на время
+        запросов к ISS блокировка записи не держится. В конце одной транзакцией таблица
+        заменяется теневой (replace, см. DatabaseManager.swap_table) или свечи переносятся
+        в нее (append). Если загрузка прервалась, основная таблица остается прежней.
 
         :param active_type: str: тип актива ('currency', 'shares', 'bonds', 'index')
         :param start_date: int: год начала сбора данных (по умолчанию 2000 год)
-        :param end_year: int: год окончания сбора данных + 1 (по умолчанию текущий год + 1)
-        :param operation: str: тип операции - замена ('replace') или добавление ('append')
+        :param end_year: int: год окончания сбора данных, включительно (по умолчанию текущий год)
+        :param operation: str: тип операции - замена ('replace'), добавление ('append')
+            или инкрементальная синхронизация ('sync', см. sync_price_history)
         :return:
         """
+        from tqdm import tqdm
 
-        try:
-            start_year = start_date.year
-            start_month = start_date.month
-            start_day = start_date.day
+        if operation == 'sync':
+            return self.sync_price_history(active_type=active_type, start_date=start_date)
+
+        if end_year is None:
+            end_year = date.today().year
 
-            engine = self.urls_settings[active_type][0]
-            market = self.urls_settings[active_type][1]
+        try:
             table_name = self.urls_settings[active_type][2]
-            first_ind = self.urls_settings[active_type][3]
-            second_ind = self.urls_settings[active_type][4]
-            active_url = self.urls_settings[active_type][5]
 
-            data = self.get_conn(active_url)
-            if not data:
+            currencies_secids = self.get_secids(active_type=active_type)
+            if currencies_secids is False:
                 print("Не удалось подключиться к API Мосбиржи")
                 return False
 
-            cur_data = data['securities']['data']
-            currencies = self.marketdata_proccesing(data=cur_data, first_ind=first_ind, second_ind=second_ind)
-            currencies_secids = list(currencies.keys())
-
-            full_df = pd.DataFrame()
+            end_date = date(year=end_year, month=12, day=31)
+            candles_urls = []
+            for secid in currencies_secids:
+                candles_urls += self.get_candles_urls(active_type=active_type, secid=secid,
+                                                      start_date=start_date, end_date=end_date)
+
+            # Первые страницы запрашиваются параллельно, ответы приходят в порядке candles_urls
+            responses = zip(candles_urls, self.fetcher.fetch_many(candles_urls))
+
+            # Свечи загружаются в теневую таблицу: запросы к ISS идут вне транзакции записи,
+            # каждая бумага записывается своей короткой транзакцией, основная таблица не блокируется
+            shadow_table = f"{table_name}__shadow"
+            if self.DBS.table_exists(shadow_table):
+                self.DBS.drop_table(shadow_table)
+            self.DBS.create_table(table_name=shadow_table,
+                                  columns=self.price_history_columns,
+                                  constraints=['PRIMARY KEY (SECID, date)'],
+                                  without_rowid=True)
 
             for secid in tqdm(currencies_secids):
                 logger.info(f"Начат сбор данных по {secid}")
-                secid_df = pd.DataFrame()
 
-                for year in range(start_year, end_year+1):
+                # Страницы бумаги за все годы записываются в SQL порциями по candles_batch_rows свечей
+                pages = (page
+                         for url, first_page in (next(responses) for _ in range(start_date.year, end_year+1))
+                         for page in self.iter_candle_pages(url=url, first_page=first_page))
+                candles_count = 0
+                for candles_df in self.iter_candle_batches(secid=secid, pages=pages):
+                    if not self.DBS.add_dataframe_to_table(df=candles_df,
+                                                           table_name=shadow_table,
+                                                           if_exists='upsert'):
+                        raise RuntimeError(f"Не удалось записать свечи {secid}")
+                    candles_count += candles_df.height
+                logger.info(f"Собраны данные по {secid}: {candles_count} свечей")
+
+            # Загруженная история переносится в основную таблицу одной транзакцией без обращений к сети
+            with self.DBS.transaction() as conn:
+                if operation == 'replace':
+                    if not self.DBS.swap_table(shadow_table, table_name):
+                        raise RuntimeError(f"Не удалось заменить таблицу '{table_name}'")
+                else:
+                    self.ensure_price_history_table(active_type=active_type)
+                    columns = ", ".join(self.price_history_columns)
+                    conn.execute(f"INSERT OR REPLACE INTO {table_name} ({columns}) "
+                                 f"SELECT {columns} FROM {shadow_table}")
+                    self.DBS.drop_table(shadow_table)
+
+                # Таблица перезаписана целиком: точки синхронизации определяются заново по данным таблицы
+                if operation == 'replace' and self.DBS.table_exists(self.sync_state_table):
+                    self.DBS.delete_row(table_name=self.sync_state_table,
+                                        where_conditions={'active_type': active_type})
+
+                if active_type == 'currency':
+                    self.update_currency_rates(start_date=start_date)
+
+                if self.price_store is not None:
+                    self.price_store.invalidate(active_type, None if operation == 'replace'
+                                                else range(start_date.year, end_year + 1))
+
+            # Parquet обновляется после commit: до этого измененные годы читаются из SQL
+            if self.price_store is not None:
+                self.price_store.export(active_type, None if operation == 'replace'
+                                        else range(start_date.year, end_year + 1))
+
+        except Exception as Ex:
+            logger.error(f"Возникла ошибка {Ex}")
+            raise Ex
+
+    def get_sync_watermarks(self, active_type:str):
+        """
+        Точки синхронизации истории цен: по каждой бумаге последняя сохраненная дата
+        и дата, до которой данные уже были запрошены
+
+        Если по бумаге нет записи в таблице состояния синхронизации, последняя дата
+        определяется по самой таблице с историей цен.
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :return: dict: {SECID: (последняя дата с ценой, дата окончания запроса)}
+        """
+
+        table_name = self.urls_settings[active_type][2]
+        watermarks = {}
 
-                    # 1 год парсим с определенной даты, а все последующие годы с 1 января
-                    if year == start_year:
-                        date_prices_json = self.get_conn(
-                            url=f'https://iss.moex.com/iss/engines/{engine}/markets/{market}/securities/{secid}/candles.json?from={year}-{start_month}-{start_day}&till={year}-12-31&interval=24'
-                        )
-                    else:
-                        date_prices_json = self.get_conn(
-                            url=f'https://iss.moex.com/iss/engines/{engine}/markets/{market}/securities/{secid}/candles.json?from={year}-01-01&till={year}-12-31&interval=24'
-                        )
+        if self.DBS.table_exists(table_name):
+            last_dates = self.DBS.execute_safe(f"SELECT SECID, MAX(date) FROM {table_name} GROUP BY SECID")
+            for secid, last_date in last_dates:
+                watermarks[secid] = (date.fromisoformat(last_date), None)
 
-                    date_prices_json = date_prices_json['candles']['data']
-                    date_prices_dict_old = self.marketdata_proccesing(data=date_prices_json, first_ind=7, second_ind=1)
+        if self.DBS.table_exists(self.sync_state_table):
+            state = self.DBS.execute_safe(
+                f"SELECT SECID, last_date, synced_till FROM {self.sync_state_table} WHERE active_type = ?",
+                (active_type,)
+            )
+            for secid, last_date, synced_till in state:
+                watermarks[secid] = (date.fromisoformat(last_date) if last_date else None,
+                                     date.fromisoformat(synced_till) if synced_till else None)
 
-                    if not date_prices_dict_old:
-                        continue
+        return watermarks
 
-                    date_prices_dict_new = {}
+    def sync_price_history(self, active_type:str,
+                           start_date:date = date(year=2000, month=1, day=1)):
+        """
+        Инкрементальная синхронизация истории цен
+
+        По каждой бумаге запрашиваются только свечи после последней сохраненной даты
+        (с перекрытием в config.sync_overlap_days дней, чтобы перезаписать незакрытую
+        свечу текущего дня) и записываются в таблицу с заменой существующих значений.
+        Свечи записываются порциями (см. iter_candle_batches), каждая порция - вместе
+        с последней сохраненной датой бумаги в одной транзакции. Дата окончания запроса
+        (synced_till) сдвигается только после последней порции бумаги, поэтому
+        прерванный запуск продолжается с последней записанной свечи.
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param start_date: date: дата начала для бумаг, по которым данных еще нет
+        :return: bool: успешно ли прошла синхронизация
+        """
+        from tqdm import tqdm
 
-                    # Каждый ключ преобразуем из формата str "%Y-%m-%d %H:%M:%S" в datetime "%Y-%m-%d"
-                    for key, value in date_prices_dict_old.items():
-                        new_key = self.str_to_datetime(key,
-                                                       format_code="%Y-%m-%d %H:%M:%S")
-                        date_prices_dict_new[new_key] = value
+        try:
+            currencies_secids = self.get_secids(active_type=active_type)
+            if currencies_secids is False:
+                return False
 
-                    df = pd.DataFrame(list(date_prices_dict_new.items()), columns=['date', secid])
+            self.ensure_price_history_table(active_type=active_type)
 
-                    # Присоединение данных за год
-                    secid_df = pd.concat([secid_df, df], ignore_index=True)
-                    logger.info(f"Собраны данные по {secid} за год {year}")
+            end_date = date.today()
+            overlap = timedelta(days=config.sync_overlap_days)
+            watermarks = self.get_sync_watermarks(active_type=active_type)
 
-                # Объединение данных по валюте в датафрейм
-                if not secid_df.empty:
-                    if full_df.empty:
-                        full_df = secid_df
-                    else:
-                        full_df = pd.merge(full_df, secid_df, on='date', how='outer')
+            secids_urls = {}
+            secids_start = {}
+            for secid in currencies_secids:
+                last_date, synced_till = watermarks.get(secid, (None, None))
 
-            full_df.columns = full_df.columns.str.replace('-', '_')
+                secid_start = start_date
+                if last_date is not None:
+                    secid_start = last_date
+                if synced_till is not None:
+                    secid_start = max(secid_start, synced_till - overlap)
 
-            # Перевод в датафрейм поларс
-            polars_dataframe = pl.from_pandas(full_df)
+                secids_start[secid] = secid_start
+                secids_urls[secid] = self.get_candles_urls(active_type=active_type, secid=secid,
+                                                           start_date=secid_start, end_date=end_date)
 
-            # Сохранение в SQL
-            self.DBS.add_dataframe_to_table(df=polars_dataframe,
-                                            table_name=table_name,
-                                            if_exists=operation)
+            # Первые страницы запрашиваются параллельно, ответы приходят в порядке бумаг
+            responses = self.fetcher.fetch_many(url for urls in secids_urls.values() for url in urls)
+
+            for secid, urls in tqdm(secids_urls.items()):
+                pages = (page
+                         for url in urls
+                         for page in self.iter_candle_pages(url=url, first_page=next(responses)))
+
+                # Порция загружается до начала транзакции записи (см. upsert_secid_prices)
+                candles_count = 0
+                for candles_df in self.iter_candle_batches(secid=secid, pages=pages):
+                    candles_count += self.upsert_secid_prices(active_type=active_type, secid=secid,
+                                                              candles=[candles_df])
+                self.upsert_secid_prices(active_type=active_type, secid=secid, candles=[], synced_till=end_date)
+                logger.info(f"Синхронизирована история цен по {secid}: {candles_count} свечей")
+
+            if active_type == 'currency':
+                self.update_currency_rates()
+
+            if self.price_store is not None and secids_urls:
+                first_year = min(secid_start.year for secid_start in secids_start.values())
+                self.price_store.export(active_type, range(first_year, end_date.year + 1))
+
+            return True
 
         except Exception as Ex:
-            logger.error(f"Возникла ошибка {Ex}")
+            logger.error(f"Возникла ошибка при синхронизации истории цен {Ex}")
             raise Ex
 
+    def upsert_secid_prices(self, active_type:str, secid:str, candles:Iterable[pl.DataFrame],
+                            synced_till:date = None):
+        """
+        Запись свечей одной бумаги в таблицу истории цен с заменой существующих значений
+        и обновление точки синхронизации (в одной транзакции)
+
+        Свечи должны быть уже загружены: candles перебирается внутри транзакции записи.
 
-    def get_splits_history(self):
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param secid: str: код бумаги
+        :param candles: Iterable[pl.DataFrame]: свечи (см. candles_to_df)
+        :param synced_till: date: дата, до которой запрашивались данные (None - не менять,
+            например для промежуточной порции свечей)
+        :return: int: количество записанных свечей
         """
-        Получение информации о дроблении / консолидации бумаг фондового рынка
 
-        :return
+        table_name = self.urls_settings[active_type][2]
+
+        with self.DBS.transaction() as conn:
+            if not self.DBS.table_exists(self.sync_state_table):
+                self.DBS.create_table(table_name=self.sync_state_table,
+                                      columns={'active_type': 'TEXT', 'SECID': 'TEXT',
+                                               'last_date': 'TEXT', 'synced_till': 'TEXT'},
+                                      constraints=['PRIMARY KEY (active_type, SECID)'])
+
+            candles_count = 0
+            last_date = None
+            for candles_df in candles:
+                if candles_df.is_empty():
+                    continue
+                self.DBS.add_dataframe_to_table(df=candles_df,
+                                                table_name=table_name,
+                                                if_exists='upsert')
+                if self.price_store is not None:
+                    self.price_store.invalidate(active_type, candles_df['date'].cast(pl.Date).dt.year().unique())
+                candles_count += candles_df.height
+                batch_last_date = candles_df['date'].max()
+                last_date = batch_last_date if last_date is None else max(last_date, batch_last_date)
+
+            # Последняя дата с ценой не должна откатываться назад, если свечей не пришло
+            conn.execute(f"""
+                INSERT INTO {self.sync_state_table} (active_type, SECID, last_date, synced_till)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (active_type, SECID) DO UPDATE SET
+                    last_date = COALESCE(MAX(excluded.last_date, last_date), excluded.last_date, last_date),
+                    synced_till = COALESCE(excluded.synced_till, synced_till)
+            """, (active_type, secid, str(last_date) if last_date else None,
+                  str(synced_till) if synced_till else None))
+
+        return candles_count
+
+    def get_price(self, active_type:str, secid:str, target_date:date = None):
         """
+        Цена бумаги на дату (последняя известная цена закрытия не позже target_date)
 
-        try:
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param secid: str: код бумаги
+        :param target_date: date: дата (по умолчанию - сегодня)
+        :return: float: цена или None, если данных нет
+        """
 
-            split_data_json = self.get_conn(url=self.split_url)
+        if target_date is None:
+            target_date = date.today()
 
-            if split_data_json == False:
-                logger.error('Не удалось подключиться к API Мосбиржи для парсинга информации по сплитам')
-                return False
+        table_name = self.urls_settings[active_type][2]
+        result = self.DBS.execute_safe(
+            f"SELECT close FROM {table_name} WHERE SECID = ? AND date <= ? ORDER BY date DESC LIMIT 1",
+            (secid, str(target_date))
+        )
+        return result[0][0] if result else None
+
+    def get_prices_on_date(self, active_type:str, target_date:date) -> pl.DataFrame:
+        """
+        Цены закрытия всех бумаг на дату
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param target_date: date: дата
+        :return: pl.DataFrame: столбцы SECID, close
+        """
+
+        table_name = self.urls_settings[active_type][2]
+        return self.DBS.read_table_to_dataframe(table_name=table_name,
+                                                columns=['SECID', 'close'],
+                                                where_conditions={'date': str(target_date)})
+
+    def get_price_history_wide(self, active_type:str,
+                               start_date:date = None, end_date:date = None) -> pl.DataFrame:
+        """
+        История цен в широком формате: столбец date и по столбцу на каждую бумагу
+        (в названиях столбцов '-' заменяется на '_', как в прежней широкой таблице)
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :param start_date: date: начало периода (по умолчанию - вся история)
+        :param end_date: date: конец периода (по умолчанию - вся история)
+        :return: pl.DataFrame
+        """
+
+        table_name = self.urls_settings[active_type][2]
 
-            split_data_json_cutted = split_data_json['splits']['data']
+        if self.price_store is not None:
+            # Актуальные годы читаются из Parquet (см. PriceHistoryStore.scan)
+            long_df = self.price_store.scan(active_type, end_date=end_date).select('SECID', 'date', 'close')
+            if start_date is not None:
+                long_df = long_df.filter(pl.col('date') >= str(start_date))
+            long_df = long_df.collect()
+        else:
+            where_conditions = {}
+            if start_date is not None:
+                where_conditions['date'] = ('>=', str(start_date))
+            long_df = self.DBS.read_table_to_dataframe(table_name=table_name,
+                                                       columns=['SECID', 'date', 'close'],
+                                                       where_conditions=where_conditions)
+        if end_date is not None:
+            long_df = long_df.filter(pl.col('date') <= str(end_date))
 
-            data = {}
+        if long_df.is_empty():
+            return pl.DataFrame()
+
+        wide_df = long_df.pivot(on='SECID', index='date', values='close').sort('date')
+        return wide_df.rename({col: col.replace('-', '_') for col in wide_df.columns})
+
+
+    def export_price_history(self, active_type:str):
+        """
+        Полная выгрузка истории цен в колоночное хранилище (см. PriceHistoryStore.export)
+
+        Нужна, если таблицу истории цен меняли в обход Marketdata: до выгрузки
+        измененные годы все равно читаются из SQL, но медленнее.
+
+        :param active_type: str: тип актива ('currency', 'shares', 'bonds')
+        :return: int: количество выгруженных строк
+        """
+
+        if self.price_store is None:
+            return 0
+        return self.price_store.export(active_type)
+
+    def get_splits_history(self):
+        """
+        Получение информации о дроблении / консолидации бумаг фондового рынка
 
-            for i in range(len(split_data_json_cutted)):
-                tradedate = self.str_to_datetime(split_data_json_cutted[i][0],
-                                                 format_code="%Y-%m-%d")
-                secid = split_data_json_cutted[i][1]
-                quantity_before = split_data_json_cutted[i][2]
-                quantity_after = split_data_json_cutted[i][3]
+        :return
+        """
 
-                data[secid] = [tradedate, quantity_before, quantity_after]
+        try:
 
-            df = pd.DataFrame([
-                {
-                    'date': values[0],
-                    'secid': secid,
-                    'quantity_before': values[1],
-                    'quantity_after': values[2]
-                }
-                for secid, values in data.items()
-            ])
+            try:
+                split_data_json = self.get_conn(url=self.split_url)
+            except IssFetchError:
+                logger.error('Не удалось подключиться к API Мосбиржи для парсинга информации по сплитам')
+                return False
 
-            # Перевод в датафрейм поларс
-            polars_dataframe = pl.from_pandas(df)
+            # У одной бумаги может быть несколько сплитов, сохраняются все
+            polars_dataframe = self.iss_to_df(
+                blocks=[split_data_json['splits']],
+                columns={'tradedate': 'date', 'secid': 'secid', 'before': 'quantity_before', 'after': 'quantity_after'},
+                schema={'date': pl.Utf8, 'secid': pl.Utf8, 'quantity_before': pl.Int64, 'quantity_after': pl.Int64}
+            ).with_columns(pl.col('date').str.to_date(format='%Y-%m-%d'))
 
             # Сохранение в SQL
-            self.DBS.add_dataframe_to_table(df=polars_dataframe,
-                                            table_name='split_info',
-                                            if_exists='replace')
+            with self.DBS.transaction():
+                self.DBS.add_dataframe_to_table(df=polars_dataframe,
+                                                table_name=config.split_table,
+                                                if_exists='replace')
+                self.build_adjustments()
 
             logger.info("Информация о дроблении / консолидации бумаг фондового рынка обновлена")
             return True
@@ -265,30 +808,93 @@ class Marketdata(object):
         """
         Получение информации по техническому изменению торговых кодов
 
-        :return:
+        :return: bool: успешно ли обновлена информация
         """
 
         try:
-            changeover_json = self.get_conn(url=self.rename_url)
+            rows = []
+            start = 0
+
+            while True:
+                try:
+                    changeover_json = self.get_conn(url=f'{self.rename_url}?start={start}')
+                except IssFetchError:
+                    logger.error('Не удалось подключиться к API Мосбиржи для парсинга информации по смене торговых кодов')
+                    return False
+
+                columns = changeover_json['changeover']['columns']
+                data = changeover_json['changeover']['data']
+                rows += [dict(zip(columns, row)) for row in data]
+
+                # Ответ разбит на страницы, если в нем есть блок cursor: [INDEX, TOTAL, PAGESIZE]
+                cursor = changeover_json.get('changeover.cursor', {}).get('data')
+                if not data or not cursor or start + len(data) >= cursor[0][1]:
+                    break
+                start += len(data)
+
+            df = pl.DataFrame({
+                'date': [self.str_to_datetime(row['action_date'], format_code="%Y-%m-%d") for row in rows],
+                'old_secid': [row['old_secid'] for row in rows],
+                'new_secid': [row['new_secid'] for row in rows],
+            }, schema={'date': pl.Date, 'old_secid': pl.Utf8, 'new_secid': pl.Utf8})
 
-            if changeover_json == False:
-                logger.error('Не удалось подключиться к API Мосбиржи для парсинга информации по сплитам')
-                return False
+            # Сохранение в SQL
+            with self.DBS.transaction():
+                self.DBS.add_dataframe_to_table(df=df,
+                                                table_name=config.changeover_table,
+                                                if_exists='replace')
+                self.build_adjustments()
 
-            # TODO: тут остановился
+            logger.info("Информация по смене торговых кодов обновлена")
+            return True
 
         except Exception as ex:
-            logger.error(f'Возникла ошибка при получении информации о дроблении / консолидации \n {ex}')
+            logger.error(f'Возникла ошибка при получении информации по смене торговых кодов \n {ex}')
             return False
 
+    def build_adjustments(self):
+        """
+        Пересчет таблиц корректировок истории по сплитам и смене торговых кодов
+
+        Сохраняются итоговые переименования (старый код -> актуальный) и накопленные
+        коэффициенты сплитов по каждой бумаге (см. adjustments.split_factors), поэтому
+        скорректированные операции и цены получаются одним join'ом без пересчета.
+        Таблица позиций строится в старых единицах, поэтому удаляется и будет
+        пересчитана при следующем обращении.
+
+        :return:
+        """
+
+        splits = pl.DataFrame(schema={'date': pl.Date, 'secid': pl.Utf8,
+                                      'quantity_before': pl.Float64, 'quantity_after': pl.Float64})
+        if self.DBS.table_exists(config.split_table):
+            splits = self.DBS.read_table_to_dataframe(table_name=config.split_table)
+
+        changeovers = pl.DataFrame(schema={'date': pl.Date, **adjustments.renames_schema()})
+        if self.DBS.table_exists(config.changeover_table):
+            changeovers = self.DBS.read_table_to_dataframe(table_name=config.changeover_table)
+
+        renames = adjustments.resolve_renames(changeovers)
+        factors = adjustments.split_factors(splits, renames)
+
+        with self.DBS.transaction():
+            for df, table_name in ((renames, config.renames_table), (factors, config.factors_table)):
+                if self.DBS.table_exists(table_name):
+                    self.DBS.drop_table(table_name)
+                self.DBS.add_dataframe_to_table(df=df, table_name=table_name)
 
+            if self.DBS.table_exists(config.positions_table):
+                self.DBS.drop_table(config.positions_table)
 
+        logger.info(f"Пересчитаны корректировки: {factors.height} сплитов, {renames.height} смен кодов")
 
-t = Marketdata()
-# t.get_current_info_shares_and_etfs()
-# t.get_current_info_bonds()
-# t.get_currencies()
-# t.translate_to_rub()
-# t.get_price_history(operation='replace', active_type='shares')
-t.get_splits_history()
 
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    t = Marketdata()
+    # t.update_current_marketdata(active_type='shares')
+    # t.update_current_marketdata(active_type='bonds')
+    # t.update_current_marketdata(active_type='currency')
+    # t.translate_to_rub()
+    # t.get_price_history(operation='replace', active_type='shares')
+    t.get_splits_history()
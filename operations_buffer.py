@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationsBuffer(object):
+    """
+    Буфер записи операций в историю операций
+
+    Операции проверяются сразу при добавлении (см. Portfolio.operation_record), а в SQL
+    записываются пачкой одной транзакцией (см. Portfolio.add_operations): когда в буфере
+    накопилось max_size операций или с момента добавления первой из них прошло max_delay
+    секунд. Запись по времени выполняет фоновый поток, поэтому операции не задерживаются
+    в буфере, даже если новых больше не поступает. При ошибке записи операции остаются
+    в буфере до следующей попытки.
+
+    Использование:
+        with portfolio.operations_buffer() as buffer:
+            buffer.add({'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 300.0})
+    """
+
+    def __init__(self, portfolio, max_size: int = config.operations_buffer_size,
+                 max_delay: Optional[float] = config.operations_buffer_delay):
+        self.portfolio = portfolio
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._records = []
+        # Время добавления первой операции в буфер (time.monotonic)
+        self._first_added = None
+        self._lock = threading.Lock()
+        # Записи выполняются по очереди, даже если их запускают разные потоки
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        if max_delay:
+            self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def add(self, record: dict):
+        """
+        Добавление операции в буфер
+
+        :param record: dict: операция (см. Portfolio.operation_record)
+        :return:
+        """
+        if self._closed.is_set():
+            raise RuntimeError("Буфер операций закрыт")
+
+        record = self.portfolio.operation_record(record)
+        with self._lock:
+            if not self._records:
+                self._first_added = time.monotonic()
+            self._records.append(record)
+            full = len(self._records) >= self.max_size
+
+        if full:
+            self.flush()
+
+    def flush(self) -> List[int]:
+        """
+        Запись накопленных операций одной транзакцией
+
+        :return: List[int]: id записанных операций
+        """
+        with self._flush_lock:
+            with self._lock:
+                records, self._records = self._records, []
+                first_added, self._first_added = self._first_added, None
+
+            if not records:
+                return []
+
+            try:
+                return self.portfolio.add_operations(records)
+            except Exception:
+                # Операции возвращаются в начало буфера, порядок сохраняется
+                with self._lock:
+                    self._records = records + self._records
+                    self._first_added = first_added
+                raise
+
+    def close(self):
+        """Запись оставшихся операций и остановка фонового потока"""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _flush_periodically(self):
+        """Фоновый поток: запись операций, пролежавших в буфере max_delay секунд"""
+        try:
+            while not self._closed.wait(self.max_delay / 4):
+                with self._lock:
+                    due = (self._first_added is not None
+                           and time.monotonic() - self._first_added >= self.max_delay)
+                if due:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logger.error(f"Ошибка записи операций из буфера: {e}")
+        finally:
+            # Соединение с базой у каждого потока свое (см. DatabaseManager.get_connection)
+            self.portfolio.DatabaseManager.close()
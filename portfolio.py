@@ -1,21 +1,56 @@
-import polars as pl
+from __future__ import annotations
+
 import logging
+import math
+import numbers
+import os
+import json
+import tempfile
 from database import DatabaseManager
 from datetime import date
-from typing import List
+from typing import List, Iterator, Dict, Optional
 import config
+from cost_basis import cost_basis, position_keys
+import adjustments
+from operations_buffer import OperationsBuffer
+from columnar import PriceHistoryStore
+from lazy_imports import lazy_import
+
+pl = lazy_import('polars')
 
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class Portfolio(object):
-    def __init__(self):
-        self.DatabaseManager = DatabaseManager(db_path="database.db")
+    def __init__(self, db_path: str = "database.db"):
+        self.DatabaseManager = DatabaseManager(db_path=db_path, indexes=config.table_indexes,
+                                               explain_queries=config.explain_queries, wal=config.sqlite_wal,
+                                               busy_timeout=config.sqlite_busy_timeout)
         # Возможные значения для столбца 'Operation'
         self.available_sell_operations = config.available_sell_operations
         self.available_buy_operations = config.available_buy_operations
+        # Счет, к которому относятся операции без явно указанного счета
+        self.default_account = config.default_account
+        # Столбцы истории операций: id - постоянный номер операции (см. ensure_schema)
+        self.operations_columns = {'id': 'INTEGER', 'Date': 'TEXT', 'SECID': 'TEXT', 'Operation': 'TEXT',
+                                   'Quantity': 'INTEGER', 'Price': 'REAL',
+                                   'Account': f"TEXT NOT NULL DEFAULT '{self.default_account}'"}
+        # Проверена ли структура таблиц (см. ensure_schema)
+        self._schema_checked = False
+        # Таблица позиций: количество каждой бумаги после операций каждой даты
+        self.positions_table = config.positions_table
+        # Таблицы истории цен (см. Marketdata.get_price_history)
+        self.price_history_tables = [config.urls_settings['shares'][2], config.urls_settings['bonds'][2]]
+        self.currency_rates_table = config.currency_rates_table
+        # Колоночная копия истории цен в Parquet (см. columnar.PriceHistoryStore), None - не используется
+        self.price_store = PriceHistoryStore(self.DatabaseManager) if config.columnar_dir else None
+        # Тип актива по таблице истории цен
+        self.price_history_types = {settings[2]: active_type for active_type, settings in config.urls_settings.items()}
+        # Таблицы текущих данных рынка в порядке приоритета (бумага берется из первой, где она есть)
+        self.current_marketdata_tables = ['current_marketdata_shares', 'current_marketdata_etfs',
+                                          'current_marketdata_bonds']
+        # Кэш снимка текущих данных рынка: (версии таблиц, на которых он построен, снимок), см. market_snapshot
+        self._market_snapshot = None
         # Валюты для представления
         # self.target_currencies = config.target_currencies
 
@@ -34,28 +69,74 @@ class Portfolio(object):
             logger.error(f"Файл не пути {path} не найден")
             raise e
 
-    def excel_check(self, df: pl.DataFrame):
+    @staticmethod
+    def iter_operation_chunks(path: str, chunk_size: int = config.import_chunk_size) -> Iterator[pl.DataFrame]:
+        """
+        Постраничное чтение выгрузки брокера (.xlsx, .csv, .parquet)
+
+        В памяти одновременно находится не больше chunk_size строк:
+            - .csv читается пакетами (все столбцы - строки, типы задает excel_check)
+            - .xlsx построчно конвертируется во временный .csv на диске и читается так же
+            - .parquet читается через pl.scan_parquet по срезам (читаются только нужные row group)
+
+        :param path: путь до файла
+        :param chunk_size: количество строк в одной порции
+        :return: Iterator[pl.DataFrame]: порции файла в исходном виде (без проверки)
+        """
+
+        extension = os.path.splitext(path)[1].lower()
+
+        if extension == '.parquet':
+            lazy_df = pl.scan_parquet(path)
+            rows = lazy_df.select(pl.len()).collect().item()
+            for offset in range(0, rows, chunk_size):
+                yield lazy_df.slice(offset, chunk_size).collect()
+            return
+
+        if extension in ('.xlsx', '.xlsm'):
+            from xlsx2csv import Xlsx2csv
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                csv_path = os.path.join(tmp_dir, 'operations.csv')
+                # Используем первый лист из файла, как и excel_to_df
+                Xlsx2csv(path, outputencoding='utf-8', dateformat='%Y-%m-%d').convert(csv_path, sheetid=1)
+                yield from Portfolio.iter_operation_chunks(path=csv_path, chunk_size=chunk_size)
+            return
+
+        if extension != '.csv':
+            logger.error(f"Неподдерживаемый формат файла {path}")
+            raise ValueError(f"Неподдерживаемый формат файла {extension}. Доступны: .xlsx, .csv, .parquet")
+
+        reader = pl.read_csv_batched(path, infer_schema_length=0, batch_size=chunk_size)
+        while True:
+            batches = reader.next_batches(1)
+            if not batches:
+                return
+            yield batches[0]
+
+    def excel_check(self, df: pl.DataFrame, date_format: str = None):
         """
         Проверка файла Excel на соответствие нужной структуре
         Нужная структура:
-            - 1 столбец: дата операции
+            - 1 столбец: дата операции (текстовая дата - в одном из форматов config.operation_date_formats
+              или в формате date_format)
             - 2 столбец: тикер / ISIN
             - 3 столбец: операция с бумагой (buy / sell / купить / продать)
             - 4 столбец: количество бумаг (в штуках, НЕ в лотах)
             - 5 столбец: цена по которой была операция
+            - 6 столбец (необязательный): счет / портфель (если его нет - счет по умолчанию)
 
+        :param date_format: str: формат текстовой даты (например '%d/%m/%Y'), по умолчанию определяется сам
         :return: DataFrame Polars с унифицированными столбцами и правильными типами данных
         """
 
         # Проверка количества столбцов
-        if len(df.get_columns()) != 5:
-            logger.error("В передаваемом Excel-файле количество столбцов не соответствует 5")
+        if len(df.get_columns()) not in (5, 6):
+            logger.error("В передаваемом Excel-файле количество столбцов не соответствует 5 или 6")
             raise ValueError ("Количество столбцов не соответствует нужному!")
 
-        w_df = df.clone()
-
         # Удаление пустых строк
-        w_df = w_df.drop_nulls()
+        w_df = df.drop_nulls()
 
         if df.height != w_df.height:
             logger.warning("Были удалены пустые строки")
@@ -64,28 +145,30 @@ class Portfolio(object):
 
 
         # Переименовывание столбцов в нужные
-        new_columns = ['Date', 'SECID', 'Operation', 'Quantity', 'Price']
-        old_columns = w_df.columns
-
-        for i in range(len(new_columns)):
-            w_df = w_df.rename({old_columns[i] : new_columns[i]})
+        new_columns = ['Date', 'SECID', 'Operation', 'Quantity', 'Price', 'Account']
+        w_df = w_df.rename(dict(zip(w_df.columns, new_columns)))
 
 
         # Проверка файла на соотвествие типам данных
-        w_df = self.typization(df = w_df, types=['Date', 'String', 'String', 'Int64', 'Float64'])
+        w_df = self.typization(df = w_df, types=['Date', 'String', 'String', 'Int64', 'Float64', 'String'][:w_df.width],
+                               date_format=date_format)
+
+        if 'Account' not in w_df.columns:
+            w_df = w_df.with_columns(pl.lit(self.default_account).alias('Account'))
 
 
 
         # Проверка, что в стоблце 'Operation' нет неопознанных значений
         self.operation_check(w_df)
+        w_df = w_df.with_columns(pl.col('Operation').str.strip_chars().str.to_lowercase())
 
 
-        # Изменение значений количества на отрицательные где есть sell
-        # Если sell, то в Quantity ставится минус, если buy, то плюс
+        # Знак количества задается операцией (как в signed_quantity):
+        # если sell, то в Quantity ставится минус, если buy, то плюс
         w_df = w_df.with_columns(
             pl.when(pl.col('Operation').is_in(self.available_sell_operations))
-            .then(pl.col('Quantity') * -1)  # делаем отрицательным
-            .otherwise(pl.col('Quantity'))  # оставляем как есть
+            .then(-pl.col('Quantity').abs())  # делаем отрицательным
+            .otherwise(pl.col('Quantity').abs())
             .alias('Quantity')
         )
 
@@ -114,11 +197,13 @@ class Portfolio(object):
         return True
 
     @staticmethod
-    def typization(df: pl.DataFrame, types: List[str]):
+    def typization(df: pl.DataFrame, types: List[str], date_format: str = None):
         """
         Изменяет типы данных в DataFrame
         :param df: DateFrame в котром нужно изменить типы
         :param types: Список типов на которые необходимо изменить
+        :param date_format: str: формат текстового столбца Date (по умолчанию - первый подходящий
+            из config.operation_date_formats, см. parse_dates)
         :return: DateFrame с измененными типами данных
         """
 
@@ -137,8 +222,17 @@ class Portfolio(object):
         # Конвертация типов
         for t in range(len(types)):
             try:
-                if types[t] == 'Date':
-                    df = df.with_columns(pl.col('Date').str.to_date(format='%m-%d-%y'))
+                if types[t] == 'Date' and df.schema['Date'] == pl.Utf8:
+                    formats = [date_format] if date_format else config.operation_date_formats
+                    df = df.with_columns(Portfolio.parse_dates(df['Date'], formats=formats))
+                elif types[t] == 'Date':
+                    df = df.with_columns(pl.col('Date').cast(pl.Date))
+                elif types[t].startswith('Int') and df.schema[df_columns[t]].is_float():
+                    # Приведение дробных чисел к целым отбрасывает дробную часть: 2.5 не должно стать 2
+                    fractional = df.filter(pl.col(df_columns[t]) != pl.col(df_columns[t]).round())
+                    if not fractional.is_empty():
+                        raise ValueError(f"Дробные значения {fractional[df_columns[t]].head(3).to_list()}")
+                    df = df.cast({df_columns[t]: getattr(pl, types[t])})
                 else:
                     df = df.cast({df_columns[t] : getattr(pl, types[t])})
             except Exception as e:
@@ -147,6 +241,32 @@ class Portfolio(object):
 
         return df
 
+    @staticmethod
+    def parse_dates(dates: pl.Series, formats: List[str]) -> pl.Series:
+        """
+        Разбор текстовых дат по первому формату, которым разбираются все значения
+
+        Формат выбирается для всего столбца, а не для каждой строки, поэтому
+        даты вида 01.02.2024 не читаются то как 1 февраля, то как 2 января.
+        Формат подходит, только если разобранные даты записываются в нем обратно
+        в исходный текст: иначе '%Y-%m-%d' принял бы 01-05-24 за 24 мая 1 года.
+
+        :param dates: pl.Series: текстовые даты
+        :param formats: List[str]: форматы в порядке проверки (strftime, например '%Y-%m-%d')
+        :return: pl.Series типа Date
+        :raises ValueError: если ни один формат не подходит ко всем значениям
+        """
+
+        stripped = dates.str.strip_chars()
+        for date_format in formats:
+            parsed = stripped.str.to_datetime(format=date_format, strict=False)
+            exact = (parsed.dt.strftime(date_format) == stripped).fill_null(False)
+            if exact.sum() == stripped.len() - stripped.null_count():
+                return parsed.dt.date()
+
+        example = stripped.drop_nulls().head(3).to_list()
+        raise ValueError(f"Даты {example} не подходят ни к одному из форматов {formats}")
+
     def operations_history_to_sql(self, operation : str, path: str = None, df : pl.DataFrame = None):
         """
         Запись данных из DataFrame в SQL
@@ -166,39 +286,101 @@ class Portfolio(object):
             raise ValueError ("Должен быть передан только один из параматеров: path или df")
 
         if path is not None:
-            df = self.excel_to_df(path=path)
+            return self.import_operations(path=path, operation=operation)
 
 
         # Проверка файла на соответствие нужной структуре
         df = self.excel_check(df=df)
 
+        self.ensure_schema()
+
+        with self.DatabaseManager.transaction():
+            if operation == 'replace':
+                # Логика обработки при замене существующей таблицы
+                self.create_operations_table(replace=True)
+                self.DatabaseManager.add_dataframe_to_table(df=df,
+                                                            table_name='operations_history',
+                                                            if_exists='append')
+                self.rebuild_positions()
+            elif operation == 'append':
+                # Логика обработки при добавлении в таблицу
+                self.DatabaseManager.add_dataframe_to_table(df=df,
+                                                            table_name='operations_history',
+                                                            if_exists='append')
+                self.apply_position_deltas(operations=df)
+
+    def import_operations(self, path: str, operation: str = 'append',
+                          chunk_size: int = config.import_chunk_size, date_format: str = None) -> int:
+        """
+        Потоковая загрузка истории операций из выгрузки брокера (.xlsx, .csv, .parquet)
+
+        Файл читается порциями по chunk_size строк (см. iter_operation_chunks), каждая порция
+        проверяется и типизируется (см. excel_check) и сразу записывается в SQL, поэтому
+        пиковая память не зависит от размера файла. Вся загрузка - одна транзакция:
+        ошибка в любой порции откатывает файл целиком.
+
+        :param path: путь до файла
+        :param operation: 'replace' - заменить историю операций, 'append' - добавить к ней
+        :param chunk_size: количество строк в одной порции
+        :param date_format: str: формат текстовой даты в файле (по умолчанию определяется
+            по config.operation_date_formats, см. typization)
+        :return: int: количество загруженных операций
+        """
+
+        if operation not in ('replace', 'append'):
+            logger.error(f"Неизвестный тип действия {operation}")
+            raise ValueError(f"Неизвестный тип действия {operation}. Доступны: 'replace', 'append'")
 
-        if operation == 'replace':
-            # Логика обработки при замене существующей таблицы
-            self.DatabaseManager.add_dataframe_to_table(df=df,
-                                                        table_name='operations_history',
-                                                        if_exists='replace')
-        elif operation == 'append':
-            # Логика обработки при добавлении в таблицу
-            self.DatabaseManager.add_dataframe_to_table(df=df,
-                                                        table_name='operations_history',
-                                                        if_exists='append')
+        self.ensure_schema()
+        rows = 0
 
-    @staticmethod
-    def quantity_for_active(data: pl.DataFrame, target_date: date = date.today()):
+        with self.DatabaseManager.transaction():
+            if operation == 'replace':
+                self.create_operations_table(replace=True)
+
+            for chunk in self.iter_operation_chunks(path=path, chunk_size=chunk_size):
+                chunk = self.excel_check(df=chunk, date_format=date_format)
+                self.DatabaseManager.add_dataframe_to_table(df=chunk,
+                                                            table_name='operations_history',
+                                                            if_exists='append')
+                if operation == 'append':
+                    self.apply_position_deltas(operations=chunk)
+                rows += chunk.height
+
+            if operation == 'replace':
+                self.rebuild_positions()
+
+        logger.info(f"Из файла {path} загружено {rows} операций")
+        return rows
+
+    def quantity_for_active(self, data: pl.DataFrame = None, target_date: Optional[date] = None,
+                            account: str = None):
         """
         Определяем количество бумаг в портфеле на текущий момент
 
-        :param target_date: Дата на которую считается количество бумаг
-        :param data: DataFrame с историей операций
-        :return: DataFrame с количеством каждого актива на дату
+        :param target_date: Дата на которую считается количество бумаг (по умолчанию - сегодня)
+        :param data: DataFrame с историей операций. Если не передан, количество берется
+            из таблицы позиций (см. positions_on_date) без пересчета всей истории
+        :param account: счет, по которому считается количество (по умолчанию - все счета)
+        :return: DataFrame с количеством каждого актива на дату (по каждому счету, если в данных есть счета)
         """
 
+        if target_date is None:
+            target_date = date.today()
+
+        if data is None:
+            return self.positions_on_date(target_date=target_date, account=account)
+
+        if account is not None and 'Account' in data.columns:
+            data = data.filter(pl.col('Account') == account)
+
+        data = self.adjust_operations(data=data)
+
         # Преобразование даты в "понятный" для Polars тип
         target_date = target_date.strftime('%Y-%m-%d')
 
         # Определение количества каждого актива на дату
-        t_data = data.filter(pl.col("Date") <= target_date).group_by("SECID").agg(pl.col('Quantity').sum())
+        t_data = data.filter(pl.col("Date") <= target_date).group_by(position_keys(data)).agg(pl.col('Quantity').sum())
 
         # Удаление активов где Quantity = 0
         t_data = t_data.filter(pl.col('Quantity') != 0)
@@ -209,44 +391,153 @@ class Portfolio(object):
                           operation_type : str,
                           quantity : int,
                           price : float,
-                          operation_date: date = date.today()):
+                          operation_date: Optional[date] = None,
+                          account: str = None):
         """
         Добавление единичной операции в историю операций
 
         :param secid: униальный id актива
         :param operation_type: тип оперции (buy / sell)
-        :param quantity: количество активов
+        :param quantity: количество активов (целое, знак задается типом операции, см. signed_quantity)
         :param price: цена единицы актива
         :param operation_date: дата операции (по умолчанию - сегодня)
-        :return:
+        :param account: счет (по умолчанию - config.default_account)
+        :return: int: id добавленной операции
+        """
+
+        return self.add_operations([{'Date': operation_date,
+                                     'SECID': secid,
+                                     'Operation': operation_type,
+                                     'Quantity': quantity,
+                                     'Price': price,
+                                     'Account': account}])[0]
+
+    def operation_record(self, record: dict) -> dict:
         """
+        Проверка и приведение к формату таблицы одной операции
+
+        :param record: dict: SECID, Operation, Quantity, Price, Date (по умолчанию - сегодня,
+            date или строка YYYY-MM-DD), Account (по умолчанию - config.default_account)
+        :return: dict: Date, SECID, Operation, Quantity, Price, Account
+        """
+
+        missing = {'SECID', 'Operation', 'Quantity', 'Price'} - set(record)
+        if missing:
+            logger.error(f"В операции {record} не указаны {missing}")
+            raise ValueError(f"В операции {record} не указаны {missing}")
 
-        operation_type = operation_type.lower().strip()
+        unknown = set(record) - set(self.operations_columns) - {'id'}
+        if unknown:
+            logger.error(f"Неизвестные поля {unknown} в операции {record}")
+            raise ValueError(f"Неизвестные поля {unknown} в операции {record}")
+
+        operation_type = str(record['Operation']).lower().strip()
 
         # Проверка типа операции
         if operation_type not in (self.available_sell_operations + self.available_buy_operations):
             logger.error(f"Неопознанный тип операции {operation_type}")
             raise ValueError (f"Неопознанный тип операции {operation_type}")
 
-        add_row = pl.DataFrame({
-           'Date' : operation_date,
-            'SECID' : secid,
-            'Operation' : operation_type,
-            'Quantity' : quantity,
-            'Price' : price
-        })
+        operation_date = record.get('Date')
+        if operation_date is None:
+            operation_date = date.today()
+        elif isinstance(operation_date, str):
+            operation_date = date.fromisoformat(operation_date)
+
+        account = record.get('Account')
+
+        try:
+            price = float(record['Price'])
+            if isinstance(record['Price'], bool) or not math.isfinite(price):
+                raise ValueError(f"неверная цена {record['Price']!r}")
+            return {'Date': operation_date.strftime('%Y-%m-%d'),
+                    'SECID': str(record['SECID']),
+                    'Operation': operation_type,
+                    'Quantity': self.signed_quantity(operation_type, record['Quantity']),
+                    'Price': price,
+                    'Account': account if account is not None else self.default_account}
+        except (TypeError, ValueError) as e:
+            logger.error(f"Неверный формат операции {record}: {e}")
+            raise ValueError(f"Неверный формат операции {record}: {e}")
+
+    def signed_quantity(self, operation_type: str, quantity) -> int:
+        """
+        Количество бумаг со знаком операции, как при загрузке из файла (см. excel_check):
+        для продажи - отрицательное, для покупки - положительное
+
+        Знак переданного количества не важен: 10 и -10 для sell дают -10.
+        :param operation_type: тип операции (уже приведенный к нижнему регистру)
+        :param quantity: целое число (int, целое float или строка с целым числом)
+        :return: int
+        :raises ValueError: если количество не число или не целое
+        """
+
+        if isinstance(quantity, bool):
+            raise ValueError(f"неверное количество {quantity!r}")
+        if isinstance(quantity, str):
+            try:
+                quantity = float(quantity) if any(c in quantity for c in '.eE') else int(quantity)
+            except ValueError:
+                raise ValueError(f"неверное количество {quantity!r}")
+        if not isinstance(quantity, numbers.Real) or not math.isfinite(quantity) or quantity != int(quantity):
+            raise ValueError(f"количество должно быть целым числом, передано {quantity!r}")
+
+        quantity = abs(int(quantity))
+        return -quantity if operation_type in self.available_sell_operations else quantity
+
+    def add_operations(self, records: List[dict]) -> List[int]:
+        """
+        Добавление пачки операций в историю операций одной транзакцией
 
-        # Добавление в SQL
-        self.DatabaseManager.add_dataframe_to_table(df=add_row,
-                                                    table_name='operations_history',
-                                                    if_exists='append')
+        Все операции проверяются до записи (см. operation_record): если хотя бы одна
+        не проходит проверку, не записывается ни одна. Количество продаж записывается
+        отрицательным, как при загрузке из файла (см. signed_quantity). Позиции обновляются
+        один раз на всю пачку (см. apply_position_deltas).
 
-    def operations_history_by_period(self, start_date: date, end_date: date = None) -> pl.DataFrame:
+        :param records: список операций в формате dict (см. operation_record)
+        :return: List[int]: id добавленных операций в порядке records
+        """
+
+        rows = [self.operation_record(record) for record in records]
+        if not rows:
+            return []
+
+        self.ensure_schema()
+        columns = list(rows[0])
+
+        with self.DatabaseManager.transaction() as conn:
+            conn.executemany(f"INSERT INTO operations_history ({', '.join(columns)}) "
+                             f"VALUES ({', '.join(['?'] * len(columns))})",
+                             [tuple(row.values()) for row in rows])
+            # Транзакция держит блокировку записи, поэтому id пачки идут подряд
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self.apply_position_deltas(operations=pl.DataFrame(rows))
+
+        logger.info(f"В историю операций добавлено {len(rows)} операций")
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def operations_buffer(self, max_size: int = config.operations_buffer_size,
+                          max_delay: float = config.operations_buffer_delay) -> OperationsBuffer:
+        """
+        Буфер записи операций: операции копятся в памяти и записываются пачками
+        через add_operations (см. OperationsBuffer)
+
+        :param max_size: количество операций, при котором буфер записывается
+        :param max_delay: сколько секунд операция может ждать записи (None - без ограничения)
+        :return: OperationsBuffer
+        """
+
+        return OperationsBuffer(self, max_size=max_size, max_delay=max_delay)
+
+    def operations_history_by_period(self, start_date: date, end_date: date = None,
+                                     account: str = None) -> pl.DataFrame:
         """
         Выгружает историю операций за выбранный период
         :param start_date: Начальная дата (формат date)
         :param end_date: Конечная дата (по умолчанию = начальная) (формат date)
-        :return: DataFrame Polars с историей операций
+        :param account: Счет (по умолчанию - все счета)
+        :return: DataFrame Polars с историей операций (id - постоянный номер операции,
+            по нему операции редактируются и удаляются, см. edit_operations / delete_operations)
         """
 
 
@@ -257,10 +548,16 @@ class Portfolio(object):
             logger.error(f"Передана end_date меньше чем start_date: end_date: {end_date} vs start_date {start_date}")
             raise ValueError (f"Передана end_date меньше чем start_date: end_date: {end_date} vs start_date {start_date}")
 
+        sql_query = "SELECT * FROM operations_history WHERE Date >= ? AND Date <= ?"
+        params = (str(start_date), str(end_date))
+        if account is not None:
+            sql_query += " AND Account = ?"
+            params += (account,)
+
+        self.ensure_schema()
+
         # Выгрузка
-        df = self.DatabaseManager.read_table_to_dataframe(
-            sql_query=f"SELECT * FROM operations_history WHERE Date >= '{start_date}' AND Date <= '{end_date}'"
-        )
+        df = self.DatabaseManager.read_table_to_dataframe(sql_query=sql_query, params=params)
 
         df = df.with_row_index(name='№', offset=1)
 
@@ -290,6 +587,36 @@ class Portfolio(object):
 
         return row_dict
 
+    def operation_id(self, row: dict) -> int:
+        """
+        id операции по строке истории операций
+
+        Для строки из operations_history_by_period id берется из самой строки, для строки
+        без id ищется первая операция с такими же значениями всех столбцов.
+        :param row: Строка в формате dict
+        :return: int: id операции
+        """
+
+        if row.get("id") is not None:
+            return int(row["id"])
+
+        where_sql, params = self.DatabaseManager.build_where_clause({
+            "Date": str(row["Date"]),
+            "SECID": row["SECID"],
+            "Operation": row["Operation"],
+            "Quantity": row["Quantity"],
+            "Price": row["Price"],
+            "Account": row.get("Account", self.default_account)
+        })
+        found = self.DatabaseManager.execute_safe(
+            f"SELECT id FROM operations_history WHERE {where_sql} LIMIT 1", params
+        )
+        if not found:
+            logger.error(f"Операция {row} не найдена в истории операций")
+            raise ValueError(f"Операция {row} не найдена в истории операций")
+
+        return found[0][0]
+
     def delete_row(self, row: dict):
         """
         Удаление строки из истории операций
@@ -298,16 +625,8 @@ class Portfolio(object):
         """
 
         try:
-            self.DatabaseManager.delete_row(
-                table_name="operations_history",
-                where_conditions= {
-                    "Date" : row["Date"],
-                    "SECID" : row["SECID"],
-                    "Operation" : row["Operation"],
-                    "Quantity" : row["Quantity"],
-                    "Price" : row["Price"]
-                }
-            )
+            self.ensure_schema()
+            self.delete_operations([self.operation_id(row)])
             logger.info(f"Из базы данных удалена операция: {row}")
         except Exception as e:
             logger.error(f"Возникла ошибка при удалении строки {row}")
@@ -317,31 +636,15 @@ class Portfolio(object):
         """
         Редактирование строки в истории операций
         :param old_row: dict, старая строка
-        :param new_row: dict, новая строка
+        :param new_row: dict, новая строка (id и служебные столбцы не меняются)
         :return: bool, успешно ли прошло редактирование
         """
 
-        # Нужно добавить проверку вводимых данных в new_row
-
         try:
-
-            self.DatabaseManager.update_row(
-                table_name="operations_history",
-                update_data={
-                    "Date" : new_row["Date"],
-                    "SECID" : new_row["SECID"],
-                    "Operation" : new_row["Operation"],
-                    "Quantity" : new_row["Quantity"],
-                    "Price" : new_row["Price"]
-                },
-                where_conditions={
-                    "Date": old_row["Date"],
-                    "SECID": old_row["SECID"],
-                    "Operation": old_row["Operation"],
-                    "Quantity": old_row["Quantity"],
-                    "Price": old_row["Price"]
-                }
-            )
+            self.ensure_schema()
+            changes = {col: value for col, value in new_row.items()
+                       if col in self.operations_columns and col != 'id'}
+            self.edit_operations({self.operation_id(old_row): changes})
             logger.info(f"Успшено редактирована строка {old_row}")
             return True
 
@@ -349,88 +652,668 @@ class Portfolio(object):
             logger.error(f"Ошибка при редактировании строки {e}")
             return False
 
-    # TODO: стоимости на дату + сейчас нет обработки фьючерсов
-    # Примерно правильно считает стоимость активов в валюте
-    def portfolio_value(self, df: pl.DataFrame, target_date: date = date.today()):
+    def operations_by_id(self, ids: List[int]) -> pl.DataFrame:
         """
-        Получение стоимости портфеля
+        Операции по списку id (поиск по первичному ключу)
 
-        :param df: Polars DataFrame: SECID и количество на дату
-        :param target_date: date: целевая дата стоимости портфеля
+        Список передается одним параметром (json_each), поэтому его длина не ограничена
+        количеством плейсхолдеров SQLite.
+        :param ids: список id операций
+        :return: DataFrame с операциями
+        """
+
+        return self.DatabaseManager.read_table_to_dataframe(
+            sql_query="SELECT * FROM operations_history WHERE id IN (SELECT value FROM json_each(?))",
+            params=(json.dumps([int(i) for i in ids]),)
+        )
+
+    def refresh_changed_positions(self, operations: pl.DataFrame):
+        """
+        Пересчет позиций после удаления / редактирования операций
+
+        По каждой паре (счет, бумага) позиции пересчитываются один раз, начиная
+        с самой ранней даты измененных операций (см. refresh_positions).
+        :param operations: DataFrame с операциями до и после изменения (Date, Account, SECID)
         :return:
         """
 
-        temp_df = df.clone()
+        if operations.is_empty():
+            return
+
+        for account, secid, from_date in (operations
+                                          .group_by('Account', 'SECID')
+                                          .agg(pl.col('Date').cast(pl.Utf8).min())
+                                          .iter_rows()):
+            self.refresh_positions(secid=secid, from_date=from_date, account=account)
+
+    def delete_operations(self, ids: List[int]) -> int:
+        """
+        Удаление операций по id одной транзакцией
+
+        :param ids: список id операций
+        :return: int: количество удаленных операций
+        """
+
+        ids = [int(i) for i in ids]
+        self.ensure_schema()
+
+        with self.DatabaseManager.transaction() as conn:
+            deleted = self.operations_by_id(ids)
+            missing = set(ids) - set(deleted['id'].to_list() if 'id' in deleted.columns else [])
+            if missing:
+                logger.warning(f"Не найдены операции с id {sorted(missing)}")
+
+            conn.executemany("DELETE FROM operations_history WHERE id = ?", [(i,) for i in ids])
+            self.refresh_changed_positions(deleted)
+
+        logger.info(f"Из истории операций удалено {deleted.height} операций")
+        return deleted.height
+
+    def edit_operations(self, changes: Dict[int, dict]) -> int:
+        """
+        Редактирование операций по id одной транзакцией
+
+        :param changes: {id операции: {столбец: новое значение}}, можно передавать
+            только изменившиеся столбцы (Date, SECID, Operation, Quantity, Price, Account)
+        :return: int: количество отредактированных операций
 
-        # Данные по акциям
-        df_shares = self.DatabaseManager.read_table_to_dataframe(
-            table_name='current_marketdata_shares',
-            columns=['SECID', 'MARKETPRICE', 'securities_type']
+        Измененная операция проверяется целиком, как новая (см. operation_record): знак
+        количества пересчитывается и при смене только Operation, и при смене только Quantity.
+        Если хотя бы одна операция не проходит проверку, не изменяется ни одна.
+        """
+
+        updates = []
+        for operation_id, new_values in changes.items():
+            unknown = set(new_values) - (set(self.operations_columns) - {'id'})
+            if unknown:
+                logger.error(f"Неизвестные столбцы {unknown} в изменениях операции {operation_id}")
+                raise ValueError(f"Неизвестные столбцы {unknown} в изменениях операции {operation_id}")
+
+            if new_values:
+                updates.append((int(operation_id), dict(new_values)))
+
+        if not updates:
+            return 0
+
+        self.ensure_schema()
+        ids = [operation_id for operation_id, _ in updates]
+
+        with self.DatabaseManager.transaction() as conn:
+            before = self.operations_by_id(ids)
+            stored = {row['id']: row for row in before.iter_rows(named=True)} if not before.is_empty() else {}
+            columns = [col for col in self.operations_columns if col != 'id']
+            rows = []
+            for operation_id, new_values in updates:
+                if operation_id not in stored:
+                    logger.warning(f"Не найдена операция с id {operation_id}")
+                    continue
+                row = self.operation_record({**stored[operation_id], **new_values})
+                rows.append((*(row[col] for col in columns), operation_id))
+
+            conn.executemany(f"UPDATE operations_history SET {', '.join(f'{col} = ?' for col in columns)} "
+                             f"WHERE id = ?", rows)
+            after = self.operations_by_id(ids)
+            if not before.is_empty():
+                self.refresh_changed_positions(pl.concat([before, after], how='vertical_relaxed'))
+
+        logger.info(f"В истории операций отредактировано {before.height} операций")
+        return before.height
+
+    def load_adjustments(self):
+        """
+        Корректировки истории по сплитам и смене торговых кодов (см. Marketdata.build_adjustments)
+
+        :return: (DataFrame: SECID, date, factor; DataFrame: old_secid, new_secid),
+            пустые таблицы, если корректировки еще не загружены
+        """
+
+        factors = pl.DataFrame(schema=adjustments.factors_schema())
+        renames = pl.DataFrame(schema=adjustments.renames_schema())
+
+        if self.DatabaseManager.table_exists(config.factors_table):
+            factors = self.DatabaseManager.read_table_to_dataframe(
+                table_name=config.factors_table
+            ).with_columns(pl.col('date').cast(pl.Date), pl.col('factor').cast(pl.Float64))
+        if self.DatabaseManager.table_exists(config.renames_table):
+            renames = self.DatabaseManager.read_table_to_dataframe(table_name=config.renames_table)
+
+        return factors, renames
+
+    def adjust_operations(self, data: pl.DataFrame) -> pl.DataFrame:
+        """
+        История операций в актуальных кодах и с учетом сплитов (см. adjustments.adjust_operations)
+
+        :param data: DataFrame с историей операций (Date, SECID, Quantity, Price)
+        :return: DataFrame с теми же столбцами
+        """
+
+        factors, renames = self.load_adjustments()
+        return adjustments.adjust_operations(data=data, factors=factors, renames=renames)
+
+    def create_operations_table(self, table_name: str = 'operations_history', replace: bool = False):
+        """
+        Создание пустой таблицы истории операций
+
+        id - INTEGER PRIMARY KEY AUTOINCREMENT: номер операции не меняется и не используется
+        повторно после удаления операции. Индексы создаются вместе с таблицей (см. config.table_indexes).
+        :param table_name: название таблицы
+        :param replace: удалить существующую таблицу
+        :return:
+        """
+
+        with self.DatabaseManager.transaction():
+            if replace and self.DatabaseManager.table_exists(table_name):
+                self.DatabaseManager.drop_table(table_name)
+            if not self.DatabaseManager.table_exists(table_name):
+                self.DatabaseManager.create_table(table_name=table_name,
+                                                  columns=self.operations_columns,
+                                                  primary_key='id')
+
+    def ensure_schema(self):
+        """
+        Приведение таблиц к актуальному формату
+
+        Если истории операций нет, создается пустая таблица (см. create_operations_table).
+        В историю операций, созданную до появления счетов, добавляется столбец Account
+        (все операции относятся к счету по умолчанию). История операций без столбца id
+        переписывается в новую таблицу, id назначаются в порядке добавления операций.
+        Таблица позиций без счетов удаляется и строится заново при следующем обращении
+        (см. positions_on_date). В истории операций досоздаются недостающие индексы
+        (см. config.table_indexes).
+        :return:
+        """
+
+        if self._schema_checked:
+            return
+
+        with self.DatabaseManager.transaction() as conn:
+            if not self.DatabaseManager.table_exists('operations_history'):
+                self.create_operations_table()
+
+            columns = self.DatabaseManager.get_table_columns('operations_history')
+            if 'Account' not in columns:
+                conn.execute(f"ALTER TABLE operations_history "
+                             f"ADD COLUMN Account TEXT NOT NULL DEFAULT '{self.default_account}'")
+                logger.info("В историю операций добавлен столбец Account")
+
+            if 'id' not in columns:
+                # Первичный ключ нельзя добавить через ALTER TABLE: таблица собирается заново
+                self.create_operations_table(table_name='operations_history_migration', replace=True)
+                data_columns = ", ".join(col for col in self.operations_columns if col != 'id')
+                conn.execute(f"INSERT INTO operations_history_migration ({data_columns}) "
+                             f"SELECT {data_columns} FROM operations_history ORDER BY rowid")
+                self.DatabaseManager.drop_table('operations_history')
+                conn.execute("ALTER TABLE operations_history_migration RENAME TO operations_history")
+                logger.info("В историю операций добавлен столбец id")
+
+            self.DatabaseManager.ensure_indexes('operations_history')
+
+            if (self.DatabaseManager.table_exists(self.positions_table)
+                    and 'Account' not in self.DatabaseManager.get_table_columns(self.positions_table)):
+                self.DatabaseManager.drop_table(self.positions_table)
+
+        self._schema_checked = True
+
+    def positions_by_date(self, data: pl.DataFrame) -> pl.DataFrame:
+        """
+        Количество каждой бумаги после всех операций каждой даты
+
+        :param data: DataFrame с историей операций (Date, (Account), SECID, Quantity)
+        :return: DataFrame: (Account), SECID, Date, Quantity (накопленная сумма по счету и бумаге)
+        """
+
+        keys = position_keys(data)
+
+        return (
+            data
+            .select(pl.col('Date').cast(pl.Date), *keys, 'Quantity')
+            .group_by([*keys, 'Date'])
+            .agg(pl.col('Quantity').sum())
+            .sort([*keys, 'Date'])
+            .with_columns(pl.col('Quantity').cum_sum().over(keys))
         )
 
-        # Переименовываем столбцы
-        df_shares = df_shares.rename({
-            'MARKETPRICE': 'MARKETPRICE_SHARES',
-            'securities_type': 'securities_type_SHARES'
-        })
+    def rebuild_positions(self):
+        """
+        Полный пересчет таблицы позиций по истории операций
+
+        В таблице позиций хранится количество каждой бумаги на каждом счете после всех
+        операций каждой даты, на которую были операции по этой бумаге на этом счете.
+        Первичный ключ (Account, SECID, Date).
+        :return:
+        """
+
+        self.ensure_schema()
+
+        with self.DatabaseManager.transaction():
+            if self.DatabaseManager.table_exists(self.positions_table):
+                self.DatabaseManager.drop_table(self.positions_table)
+
+            self.DatabaseManager.create_table(table_name=self.positions_table,
+                                              columns={'Account': 'TEXT NOT NULL',
+                                                       'SECID': 'TEXT NOT NULL',
+                                                       'Date': 'TEXT NOT NULL',
+                                                       'Quantity': 'INTEGER'},
+                                              constraints=['PRIMARY KEY (Account, SECID, Date)'],
+                                              without_rowid=True)
+
+            if self.DatabaseManager.table_exists('operations_history'):
+                data = self.DatabaseManager.read_table_to_dataframe(table_name='operations_history',
+                                                                    columns=['Date', 'Account', 'SECID', 'Quantity'])
+                if not data.is_empty():
+                    data = self.adjust_operations(data=data)
+                    self.DatabaseManager.add_dataframe_to_table(df=self.positions_by_date(data=data),
+                                                                table_name=self.positions_table)
+
+        logger.info("Таблица позиций пересчитана")
+
+    def apply_position_deltas(self, operations: pl.DataFrame):
+        """
+        Учет новых операций в таблице позиций без пересчета всей истории
+
+        Для каждой (счет, бумага, дата) добавляется строка с количеством на предыдущую дату
+        (если ее еще нет), затем изменение количества прибавляется ко всем позициям
+        этой бумаги на этом счете начиная с даты операции.
+
+        :param operations: DataFrame с добавленными операциями (Date, Account, SECID, Quantity)
+        :return:
+        """
+
+        # Таблица позиций строится при первом обращении (см. positions_on_date)
+        if not self.DatabaseManager.table_exists(self.positions_table):
+            return
+
+        if 'Account' not in operations.columns:
+            operations = operations.with_columns(pl.lit(self.default_account).alias('Account'))
+
+        deltas = (self.adjust_operations(data=operations.select('Date', 'Account', 'SECID', 'Quantity'))
+                  .group_by(['Account', 'SECID', pl.col('Date').cast(pl.Date).cast(pl.Utf8)])
+                  .agg(pl.col('Quantity').sum()))
+
+        with self.DatabaseManager.transaction() as conn:
+            conn.executemany(f"""
+                INSERT OR IGNORE INTO {self.positions_table} (Account, SECID, Date, Quantity)
+                VALUES (?1, ?2, ?3, COALESCE((SELECT Quantity FROM {self.positions_table}
+                                              WHERE Account = ?1 AND SECID = ?2 AND Date < ?3
+                                              ORDER BY Date DESC LIMIT 1), 0))
+            """, deltas.select('Account', 'SECID', 'Date').iter_rows())
+            conn.executemany(f"""
+                UPDATE {self.positions_table} SET Quantity = Quantity + ?
+                WHERE Account = ? AND SECID = ? AND Date >= ?
+            """, deltas.select('Quantity', 'Account', 'SECID', 'Date').iter_rows())
+
+    def refresh_positions(self, secid: str, from_date: date, account: str = None):
+        """
+        Пересчет позиций одной бумаги на счете начиная с даты (после удаления / редактирования операций)
+
+        Пересчитываются только операции этой бумаги (под всеми ее прежними кодами) на этом счете
+        не раньше from_date, количество до этой даты берется из таблицы позиций.
+
+        :param secid: код бумаги (если код сменился - любой из кодов)
+        :param from_date: дата, начиная с которой изменилась история операций
+        :param account: счет (по умолчанию - config.default_account)
+        :return:
+        """
+
+        if not self.DatabaseManager.table_exists(self.positions_table):
+            return
+
+        from_date = str(from_date)
+        account = account if account is not None else self.default_account
+        factors, renames = self.load_adjustments()
+        secid = adjustments.apply_renames(pl.DataFrame({'SECID': [secid]}), renames)['SECID'][0]
+        secids = adjustments.secid_aliases([secid], renames)
+        placeholders = ", ".join(["?"] * len(secids))
+
+        with self.DatabaseManager.transaction() as conn:
+            conn.execute(f"DELETE FROM {self.positions_table} WHERE Account = ? AND SECID = ? AND Date >= ?",
+                         (account, secid, from_date))
+
+            previous = conn.execute(f"""
+                SELECT Quantity FROM {self.positions_table} WHERE Account = ? AND SECID = ? AND Date < ?
+                ORDER BY Date DESC LIMIT 1
+            """, (account, secid, from_date)).fetchone()
+            quantity = previous[0] if previous else 0
+
+            operations = self.DatabaseManager.read_table_to_dataframe(
+                sql_query=f"SELECT Date, SECID, Quantity FROM operations_history "
+                          f"WHERE Account = ? AND SECID IN ({placeholders}) AND Date >= ?",
+                params=(account, *secids, from_date)
+            )
+
+            rows = []
+            if not operations.is_empty():
+                operations = adjustments.adjust_operations(data=operations, factors=factors, renames=renames)
+                for operation_date, delta in (operations
+                                              .group_by(pl.col('Date').cast(pl.Date).cast(pl.Utf8))
+                                              .agg(pl.col('Quantity').sum())
+                                              .sort('Date')
+                                              .iter_rows()):
+                    quantity += delta
+                    rows.append((account, secid, operation_date, quantity))
+
+            conn.executemany(f"INSERT INTO {self.positions_table} (Account, SECID, Date, Quantity) "
+                             f"VALUES (?, ?, ?, ?)", rows)
+
+    def ensure_positions(self):
+        """
+        Подготовка таблиц к чтению: актуальная схема (см. ensure_schema) и таблица позиций
+
+        Оценки портфеля читают базу в одном снимке (см. DatabaseManager.snapshot),
+        а записывать внутри снимка нельзя, поэтому все записи выполняются до него.
+        :return:
+        """
 
-        temp_df = temp_df.join(
-            other=df_shares,
-            on='SECID',
-            how='left'
+        self.ensure_schema()
+        if not self.DatabaseManager.table_exists(self.positions_table):
+            self.rebuild_positions()
+
+    def positions_on_date(self, target_date: Optional[date] = None, account: str = None) -> pl.DataFrame:
+        """
+        Количество каждой бумаги на каждом счете на дату по таблице позиций
+
+        По каждой паре (счет, бумага) берется последняя позиция не позже target_date
+        (поиск по первичному ключу), история операций при этом не читается.
+        Все счета выгружаются одним запросом.
+
+        :param target_date: дата, на которую считается количество бумаг (по умолчанию - сегодня)
+        :param account: счет (по умолчанию - все счета)
+        :return: DataFrame: Account, SECID, Quantity (без нулевых позиций)
+        """
+
+        if target_date is None:
+            target_date = date.today()
+
+        self.ensure_positions()
+
+        account_filter = "WHERE Account = ?" if account is not None else ""
+        params = (str(target_date),) + ((account,) if account is not None else ())
+
+        positions = self.DatabaseManager.read_table_to_dataframe(
+            sql_query=f"""
+                SELECT Account, SECID, Quantity FROM (
+                    SELECT s.Account, s.SECID, (SELECT p.Quantity FROM {self.positions_table} AS p
+                                                WHERE p.Account = s.Account AND p.SECID = s.SECID
+                                                  AND p.Date <= ?
+                                                ORDER BY p.Date DESC LIMIT 1) AS Quantity
+                    FROM (SELECT DISTINCT Account, SECID FROM {self.positions_table} {account_filter}) AS s
+                )
+                WHERE Quantity IS NOT NULL AND Quantity != 0
+            """,
+            params=params
         )
 
-        # Данные по ETF
-        df_etf = self.DatabaseManager.read_table_to_dataframe(
-            table_name='current_marketdata_etfs',
-            columns=['SECID', 'MARKETPRICE', 'securities_type']
+        # У пустого результата запроса нет типов столбцов: без них не работают join'ы с ценами
+        if positions.is_empty():
+            return pl.DataFrame(schema={'Account': pl.Utf8, 'SECID': pl.Utf8, 'Quantity': pl.Int64})
+        return positions
+
+    def stored_price_history(self, table_name: str, secids: List[str],
+                             start_date: date, end_date: date) -> pl.DataFrame:
+        """
+        Цены закрытия из таблицы истории цен за период
+
+        Кроме цен за период выгружается последняя цена до start_date, чтобы
+        на начало периода тоже была известна цена. Если включено колоночное хранилище
+        (config.columnar_dir), история читается из Parquet (см. PriceHistoryStore.scan).
+
+        :param table_name: str: таблица истории цен (длинный формат, см. Marketdata.get_price_history)
+        :param secids: List[str]: коды бумаг
+        :param start_date: date: начало периода
+        :param end_date: date: конец периода
+        :return: DataFrame: SECID, Date, MARKETPRICE
+        """
+
+        if not secids or not self.DatabaseManager.table_exists(table_name):
+            return pl.DataFrame(schema={'SECID': pl.Utf8, 'Date': pl.Date, 'MARKETPRICE': pl.Float64})
+
+        if self.price_store is not None and table_name in self.price_history_types:
+            prices = (self.price_store.scan(self.price_history_types[table_name], end_date=end_date)
+                      .filter(pl.col('SECID').is_in(secids) & (pl.col('date') <= str(end_date)))
+                      .select('SECID', 'date', 'close'))
+            # Та же логика, что и в SQL ниже: последняя цена не позже start_date и все цены после нее
+            period_start = (prices
+                            .filter(pl.col('date') <= str(start_date))
+                            .group_by('SECID')
+                            .agg(pl.col('date').max().alias('period_start')))
+            df = (prices
+                  .join(period_start, on='SECID', how='left')
+                  .filter(pl.col('date') >= pl.coalesce('period_start', pl.lit(str(start_date))))
+                  .select('SECID', pl.col('date').alias('Date'), pl.col('close').alias('MARKETPRICE'))
+                  .collect())
+            return df.with_columns(pl.col('Date').cast(pl.Date), pl.col('MARKETPRICE').cast(pl.Float64))
+
+        placeholders = ", ".join(["?"] * len(secids))
+        df = self.DatabaseManager.read_table_to_dataframe(
+            sql_query=f"""
+                SELECT SECID, date AS Date, close AS MARKETPRICE FROM {table_name} AS t
+                WHERE SECID IN ({placeholders}) AND date <= ? AND date >= COALESCE(
+                    (SELECT MAX(date) FROM {table_name} AS p WHERE p.SECID = t.SECID AND p.date <= ?), ?)
+            """,
+            params=(*secids, str(end_date), str(start_date), str(start_date))
         )
 
-        # Переименовываем столбцы
-        df_etf = df_etf.rename({
-            'MARKETPRICE': 'MARKETPRICE_ETF',
-            'securities_type': 'securities_type_ETF'
-        })
+        return df.with_columns(pl.col('Date').cast(pl.Date), pl.col('MARKETPRICE').cast(pl.Float64))
+
+    def currency_rates(self, currencies: List[str], start_date: date, end_date: date) -> pl.DataFrame:
+        """
+        Курсы валют за период из таблицы курсов (см. Marketdata.update_currency_rates)
 
-        temp_df = temp_df.join(
-            other=df_etf,
-            on='SECID',
-            how='left'
+        Кроме курсов за период выгружается последний курс до start_date.
+
+        :param currencies: List[str]: коды валют
+        :param start_date: date: начало периода
+        :param end_date: date: конец периода
+        :return: DataFrame: currency, Date, rate
+        """
+
+        if not currencies or not self.DatabaseManager.table_exists(self.currency_rates_table):
+            return pl.DataFrame(schema={'currency': pl.Utf8, 'Date': pl.Date, 'rate': pl.Float64})
+
+        placeholders = ", ".join(["?"] * len(currencies))
+        df = self.DatabaseManager.read_table_to_dataframe(
+            sql_query=f"""
+                SELECT currency, date AS Date, rate FROM {self.currency_rates_table} AS t
+                WHERE currency IN ({placeholders}) AND date <= ? AND date >= COALESCE(
+                    (SELECT MAX(date) FROM {self.currency_rates_table} AS p
+                     WHERE p.currency = t.currency AND p.date <= ?), ?)
+            """,
+            params=(*currencies, str(end_date), str(start_date), str(start_date))
         )
 
-        temp_df = temp_df.with_columns([
-            pl.coalesce(['MARKETPRICE_SHARES', 'MARKETPRICE_ETF']).alias('MARKETPRICE'),
-            pl.coalesce(['securities_type_SHARES', 'securities_type_ETF']).alias('SECURITY_TYPE')
+        return df.with_columns(pl.col('Date').cast(pl.Date), pl.col('rate').cast(pl.Float64))
+
+    def value_positions(self, positions: pl.DataFrame) -> pl.DataFrame:
+        """
+        Стоимость позиций на даты по сохраненной истории цен и курсов валют
+
+        Цена и курс берутся последние известные на дату позиции (as-of join),
+        поэтому выходные и праздники получают цену последнего торгового дня.
+
+        :param positions: DataFrame: (Account), SECID, Date, Quantity
+        :return: DataFrame: (Account), SECID, Date, Quantity, MARKETPRICE, CURRENCY, Position Value
+        """
+
+        positions = positions.with_columns(pl.col('Date').cast(pl.Date)).sort('Date')
+        secids = positions['SECID'].unique().to_list()
+        start_date = positions['Date'].min()
+        end_date = positions['Date'].max()
+
+        # Цены: бумага ищется во всех таблицах истории цен (в том числе под прежними кодами),
+        # берется первая найденная. Цены до сплитов приводятся к текущим единицам
+        factors, renames = self.load_adjustments()
+        prices = pl.concat([
+            self.stored_price_history(table_name=table_name,
+                                      secids=adjustments.secid_aliases(secids, renames),
+                                      start_date=start_date, end_date=end_date)
+            for table_name in self.price_history_tables
         ])
+        prices = (adjustments.adjust_prices(prices=prices, factors=factors, renames=renames,
+                                            price_columns=['MARKETPRICE'])
+                  .unique(subset=['SECID', 'Date'], keep='first').sort('Date'))
 
-        # Данные по облигациям
-        df_bonds = self.DatabaseManager.read_table_to_dataframe(
-            table_name='current_marketdata_bonds',
-            columns=['SECID', 'MARKETPRICE', 'securities_type', 'CURRENCY']
-        )
+        df = positions.join_asof(prices, on='Date', by='SECID', strategy='backward', check_sortedness=False)
 
-        # Переименовываем столбцы
-        df_bonds = df_bonds.rename({
-            'MARKETPRICE': 'MARKETPRICE_BONDS',
-            'securities_type': 'securities_type_BONDS'
-        })
+        # Валюта номинала облигаций и курсы этих валют на дату
+        if self.DatabaseManager.table_exists('current_marketdata_bonds'):
+            faceunits = self.DatabaseManager.read_table_to_dataframe(
+                table_name='current_marketdata_bonds',
+                columns=['SECID', 'FACEUNIT']
+            )
+            df = df.join(faceunits, on='SECID', how='left')
+
+            currencies = faceunits['FACEUNIT'].drop_nulls().unique().to_list()
+            rates = self.currency_rates(currencies=currencies, start_date=start_date, end_date=end_date)
+            rates = rates.rename({'currency': 'FACEUNIT', 'rate': 'CURRENCY'}).sort('Date')
+
+            df = df.join_asof(rates, on='Date', by='FACEUNIT', strategy='backward',
+                              check_sortedness=False).drop('FACEUNIT')
+        else:
+            df = df.with_columns(pl.lit(None, dtype=pl.Float64).alias('CURRENCY'))
 
-        temp_df = temp_df.join(
-            other=df_bonds,
-            on='SECID',
-            how='left'
+        # Бумаги без курса считаются рублевыми
+        return df.with_columns(
+            pl.col('CURRENCY').fill_null(1)
+        ).with_columns(
+            (pl.col('Quantity') * pl.col('MARKETPRICE') * pl.col('CURRENCY')).alias('Position Value')
         )
 
-        temp_df = temp_df.with_columns([
-            pl.coalesce(['MARKETPRICE', 'MARKETPRICE_BONDS']).alias('MARKETPRICE'),
-            pl.coalesce(['SECURITY_TYPE', 'securities_type_BONDS']).alias('SECURITY_TYPE')
-        ])
+    def portfolio_value_history(self, start_date: date, end_date: Optional[date] = None,
+                                data: pl.DataFrame = None, by_account: bool = False) -> pl.DataFrame:
+        """
+        Ежедневная стоимость портфеля за период
+
+        Позиции на каждый день получаются накопленной суммой истории операций,
+        к ним присоединяются сохраненные цены и курсы валют (см. value_positions).
+        Весь ряд считается за один проход, без расчета стоимости на каждую дату отдельно.
+        Для всех счетов сразу - тоже один проход: цены присоединяются один раз.
+
+        :param start_date: date: начало периода
+        :param end_date: date: конец периода (по умолчанию - сегодня)
+        :param data: DataFrame с историей операций (по умолчанию выгружается из SQL)
+        :param by_account: bool: стоимость по каждому счету (иначе - суммарная по всем счетам)
+        :return: DataFrame: (Account), Date, Portfolio Value
+        """
+
+        if end_date is None:
+            end_date = date.today()
+
+        if start_date > end_date:
+            logger.error(f"Передана end_date меньше чем start_date: end_date: {end_date} vs start_date {start_date}")
+            raise ValueError (f"Передана end_date меньше чем start_date: end_date: {end_date} vs start_date {start_date}")
 
-        df_portfolio = temp_df[['SECID', 'Quantity', 'MARKETPRICE', 'SECURITY_TYPE', 'CURRENCY']]
+        if data is None:
+            self.ensure_schema()
+
+        # Операции, цены и курсы читаются в одном снимке базы: параллельное обновление
+        # цен не попадает в расчет наполовину
+        with self.DatabaseManager.snapshot():
+            if data is None:
+                # Фильтр по дате и выбор столбцов выполняются в SQL (см. DatabaseManager.scan_table)
+                data = (self.DatabaseManager.scan_table('operations_history', date_columns=['Date'])
+                        .filter(pl.col('Date') <= end_date)
+                        .select('Date', 'Account', 'SECID', 'Quantity')
+                        .collect())
+
+            if 'Account' not in data.columns:
+                data = data.with_columns(pl.lit(self.default_account).alias('Account'))
+
+            positions = self.positions_by_date(data=self.adjust_operations(data=data))
+            calendar = pl.DataFrame({'Date': pl.date_range(start_date, end_date, interval='1d', eager=True)})
+
+            # Сетка (счет, бумага) x день, количество на день - последнее известное на эту дату
+            daily_positions = (
+                positions.select('Account', 'SECID').unique()
+                .join(calendar, how='cross')
+                .sort('Date')
+                .join_asof(positions.sort('Date'), on='Date', by=['Account', 'SECID'], strategy='backward',
+                           check_sortedness=False)
+                .filter(pl.col('Quantity').fill_null(0) != 0)
+            )
+
+            values = self.value_positions(positions=daily_positions)
+
+            group = ['Account', 'Date'] if by_account else ['Date']
+            if by_account:
+                calendar = data.select('Account').unique().join(calendar, how='cross')
+
+            return (
+                calendar
+                .join(values.group_by(group).agg(pl.col('Position Value').sum().alias('Portfolio Value')),
+                      on=group, how='left')
+                .with_columns(pl.col('Portfolio Value').fill_null(0))
+                .sort(group)
+            )
+
+    # TODO: сейчас нет обработки фьючерсов
+    # Примерно правильно считает стоимость активов в валюте
+    def portfolio_value(self, df: pl.DataFrame, target_date: Optional[date] = None):
+        """
+        Получение стоимости портфеля
+
+        На сегодняшнюю дату используются текущие данные маркетдаты,
+        на прошедшие даты - сохраненная история цен и курсов (см. value_positions)
+
+        :param df: Polars DataFrame: SECID и количество на дату
+        :param target_date: date: целевая дата стоимости портфеля (по умолчанию - сегодня)
+        :return:
+        """
+
+        df_portfolio = self.positions_value(df=df, target_date=target_date)
+
+        print(self.full_portfolio_values(df=df_portfolio, sum_column='Position Value'))
+
+        print(df_portfolio)
+
+    def accounts_value(self, target_date: Optional[date] = None) -> pl.DataFrame:
+        """
+        Стоимость портфеля каждого счета на дату
+
+        Позиции всех счетов выгружаются одним запросом (см. positions_on_date),
+        цены присоединяются к ним одним join'ом, затем суммируются по счетам.
+
+        :param target_date: date: дата стоимости (по умолчанию - сегодня)
+        :return: DataFrame: Account, Portfolio Value
+        """
+
+        if target_date is None:
+            target_date = date.today()
+
+        self.ensure_positions()
+        # Позиции, снимок рынка и курсы читаются в одном снимке базы
+        with self.DatabaseManager.snapshot():
+            values = self.positions_value(df=self.positions_on_date(target_date=target_date),
+                                          target_date=target_date)
+
+        return (values
+                .group_by('Account')
+                .agg(pl.col('Position Value').sum().alias('Portfolio Value'))
+                .sort('Account'))
+
+    def positions_value(self, df: pl.DataFrame, target_date: Optional[date] = None) -> pl.DataFrame:
+        """
+        Стоимость каждой позиции на дату
+
+        :param df: Polars DataFrame: (Account), SECID и количество на дату
+        :param target_date: date: дата стоимости (по умолчанию - сегодня)
+        :return: DataFrame: (Account), SECID, Quantity, MARKETPRICE, ..., CURRENCY, Position Value
+        """
+
+        if target_date is None:
+            target_date = date.today()
+
+        if target_date < date.today():
+            with self.DatabaseManager.snapshot():
+                return self.value_positions(positions=df.with_columns(pl.lit(target_date).alias('Date')))
+
+        # Текущие цены всех бумаг - одним join'ом со снимком рынка
+        with self.DatabaseManager.snapshot():
+            temp_df = df.join(other=self.market_snapshot(), on='SECID', how='left')
+
+        df_portfolio = temp_df[[*position_keys(df), 'Quantity', 'MARKETPRICE', 'SECURITY_TYPE', 'CURRENCY']]
 
         # Предполагаем, что все бумаги кроме облигаций торгуются только в рублях
         # Поэтому заполняем все оставшиеся 1
-        # TODO: стоимость портфеля на дату
         df_portfolio= df_portfolio.with_columns(
                       pl.col('CURRENCY').fill_null(1)
         )
@@ -444,9 +1327,67 @@ class Portfolio(object):
             logger.error('Возникла ошибка при расчете стоимости каждой позиции в портеле')
             raise e
 
-        print(self.full_portfolio_values(df=df_portfolio, sum_column='Position Value'))
+        return df_portfolio
 
-        print(df_portfolio)
+    def market_snapshot(self) -> pl.DataFrame:
+        """
+        Снимок текущих данных рынка: одна строка на бумагу
+
+        Таблицы current_marketdata_* читаются одним запросом. Снимок кэшируется и
+        перестраивается только после изменения этих таблиц или курсов валют (номера версий
+        таблиц в базе, см. DatabaseManager.touch_tables), поэтому повторные оценки портфелей
+        читают из SQLite только номера версий. Номера общие для всех соединений: снимок,
+        построенный в одном потоке, проверяется в другом так же, как и в своем.
+
+        :return: DataFrame: SECID, MARKETPRICE, SECURITY_TYPE, CURRENCY
+        """
+
+        tables = self.current_marketdata_tables + [self.currency_rates_table]
+        # Версии и таблицы читаются из одного снимка базы, поэтому снимок не получит версию новее своих данных
+        with self.DatabaseManager.snapshot():
+            version = self.DatabaseManager.table_versions(tables)
+            cached = self._market_snapshot
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            snapshot = self.build_market_snapshot()
+
+        # Версия и снимок заменяются одним присваиванием: другой поток не увидит их вразнобой
+        self._market_snapshot = (version, snapshot)
+        return snapshot
+
+    def build_market_snapshot(self) -> pl.DataFrame:
+        """
+        Чтение снимка текущих данных рынка из таблиц current_marketdata_* (без кэша, см. market_snapshot)
+
+        :return: DataFrame: SECID, MARKETPRICE, SECURITY_TYPE, CURRENCY
+        """
+
+        rates_exist = self.DatabaseManager.table_exists(self.currency_rates_table)
+
+        selects = []
+        for table_name in self.current_marketdata_tables:
+            if not self.DatabaseManager.table_exists(table_name):
+                continue
+            # Валюта номинала есть только у облигаций: курс - последний в таблице курсов (поиск по ключу)
+            currency = 'NULL'
+            if rates_exist and 'FACEUNIT' in self.DatabaseManager.get_table_columns(table_name):
+                currency = (f"(SELECT r.rate FROM {self.currency_rates_table} AS r "
+                            f"WHERE r.currency = t.FACEUNIT ORDER BY r.date DESC LIMIT 1)")
+            selects.append(f"SELECT SECID, MARKETPRICE, securities_type AS SECURITY_TYPE, "
+                           f"{currency} AS CURRENCY, {len(selects)} AS priority FROM {table_name} AS t")
+
+        schema = {'SECID': pl.Utf8, 'MARKETPRICE': pl.Float64, 'SECURITY_TYPE': pl.Utf8, 'CURRENCY': pl.Float64}
+        if selects:
+            snapshot = self.DatabaseManager.read_table_to_dataframe(
+                sql_query=" UNION ALL ".join(selects)
+            ).sort('priority').unique(subset='SECID', keep='first', maintain_order=True).select(
+                [pl.col(col).cast(dtype) for col, dtype in schema.items()]
+            )
+        else:
+            snapshot = pl.DataFrame(schema=schema)
+
+        return snapshot
 
     def full_portfolio_values(self, df:pl.DataFrame, sum_column:str) -> str:
         """
@@ -457,19 +1398,41 @@ class Portfolio(object):
         """
         return f"Стоимость портфеля: {int(df[sum_column].sum())} рублей"
 
-    def average_price(self):
+    def average_price(self, method: str = 'average', prices: pl.DataFrame = None,
+                      account: str = None) -> pl.DataFrame:
         """
-        Нахождение средней цены покупки / продажи
-        :param df: pl.DataFrame: история операций
-        :return:
+        Нахождение средней цены покупки / продажи, реализованного и нереализованного результата
+        :param method: str: метод расчета себестоимости: 'average' (средневзвешенная), 'fifo', 'lifo'
+        :param prices: pl.DataFrame: SECID, MARKETPRICE (по умолчанию - последние сохраненные цены закрытия)
+        :param account: str: счет (по умолчанию - все счета, расчет за один проход)
+        :return: pl.DataFrame: по каждому счету и бумаге количество, средняя цена, реализованный
+            и нереализованный результат (см. cost_basis.cost_basis)
         """
-        data = port.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
-        unique_secid = data['SECID'].unique()
+        self.ensure_schema()
+        # Операции и цены читаются в одном снимке базы
+        with self.DatabaseManager.snapshot():
+            data = self.DatabaseManager.read_table_to_dataframe(
+                table_name='operations_history',
+                columns=['Date', 'Account', 'SECID', 'Quantity', 'Price'],
+                where_conditions={'Account': account} if account else None
+            )
+            data = self.adjust_operations(data=data)
+
+            if prices is None:
+                secids = data['SECID'].unique().to_list()
+                prices = pl.concat([
+                    self.stored_price_history(table_name=table_name, secids=secids,
+                                              start_date=date.today(), end_date=date.today())
+                    for table_name in self.price_history_tables
+                ]).sort('Date', descending=True).unique(subset='SECID', keep='first')
+
+        return cost_basis(data=data, method=method, prices=prices)
 
 
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     port = Portfolio()
     # # Подгрузка данных из excel
     # # port.operations_history_to_sql(path='port.xlsx', operation='replace')
@@ -0,0 +1,404 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time as time_module
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import config
+from database import DatabaseManager
+
+
+logger = logging.getLogger(__name__)
+
+
+class Clock(object):
+    """Часы планировщика: текущее время в часовом поясе расписания и ожидание"""
+
+    def __init__(self, timezone: str = config.scheduler_timezone):
+        self.tz = ZoneInfo(timezone)
+
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
+
+    def sleep(self, seconds: float, stop: threading.Event) -> bool:
+        """
+        Ожидание seconds секунд или до остановки планировщика
+
+        :return: bool: был ли запрошен останов
+        """
+        return stop.wait(seconds)
+
+
+class FakeClock(Clock):
+    """
+    Часы для проверки расписания: время меняется только через advance и sleep
+
+    Использование:
+        clock = FakeClock(datetime(2024, 1, 15, 10, 0))
+        scheduler = RefreshScheduler(db, jobs, clock=clock)
+        scheduler.run_pending()
+        clock.advance(minutes=5)
+    """
+
+    def __init__(self, start: datetime, timezone: str = config.scheduler_timezone):
+        super().__init__(timezone)
+        self.current = start if start.tzinfo else start.replace(tzinfo=self.tz)
+
+    def now(self) -> datetime:
+        return self.current
+
+    def advance(self, **kwargs):
+        """Сдвиг времени (аргументы как у timedelta)"""
+        self.current += timedelta(**kwargs)
+
+    def sleep(self, seconds: float, stop: threading.Event) -> bool:
+        self.current += timedelta(seconds=seconds)
+        return stop.is_set()
+
+
+def trading_time(moment: datetime, hours: Tuple[str, str] = config.trading_hours) -> datetime:
+    """
+    Ближайший к moment момент в торговые часы (по будням), не раньше moment
+
+    Праздничные дни биржи не учитываются: в них снимок просто не меняется.
+
+    :param moment: datetime: момент времени
+    :param hours: Tuple[str, str]: начало и конец торговых часов ('ЧЧ:ММ')
+    :return: datetime
+    """
+    opening, closing = time.fromisoformat(hours[0]), time.fromisoformat(hours[1])
+    while True:
+        if moment.weekday() < 5:
+            day_opening = datetime.combine(moment.date(), opening, tzinfo=moment.tzinfo)
+            if moment < day_opening:
+                return day_opening
+            if moment <= datetime.combine(moment.date(), closing, tzinfo=moment.tzinfo):
+                return moment
+        moment = datetime.combine(moment.date() + timedelta(days=1), time(), tzinfo=moment.tzinfo)
+
+
+class Job(object):
+    """
+    Задача планировщика
+
+    Задача запускается либо каждые every секунд (при trading_hours - только в торговые часы),
+    либо раз в сутки в момент at ('ЧЧ:ММ'). К моменту запуска добавляется случайная
+    задержка до jitter секунд. Задача из depends_on запускается только после успешного
+    выполнения всех зависимостей, причем более позднего, чем ее собственный прошлый запуск.
+
+    Задача считается выполненной с ошибкой, если func выбросила исключение или вернула False
+    (так сообщают об ошибке методы Marketdata).
+    """
+
+    def __init__(self, name: str, func: Callable, every: Optional[float] = None, at: Optional[str] = None,
+                 trading_hours: bool = False, depends_on: Iterable[str] = (), jitter: float = 0,
+                 retry_delay: float = config.scheduler_retry_delay):
+        if (every is None) == (at is None):
+            raise ValueError(f"У задачи '{name}' должно быть задано либо every, либо at")
+        self.name = name
+        self.func = func
+        self.every = every
+        self.at = time.fromisoformat(at) if at is not None else None
+        self.trading_hours = trading_hours
+        self.depends_on = list(depends_on)
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+
+    def next_run(self, last_run: Optional[datetime], now: datetime) -> datetime:
+        """
+        Следующий плановый запуск (без случайной задержки)
+
+        Задача, пропустившая запуск (например, планировщик был остановлен), выполняется сразу.
+
+        :param last_run: datetime: время прошлого запуска (None - задача еще не запускалась)
+        :param now: datetime: текущее время
+        :return: datetime
+        """
+        if self.every is not None:
+            run = now if last_run is None else last_run + timedelta(seconds=self.every)
+        else:
+            base = last_run or now
+            run = datetime.combine(base.date(), self.at, tzinfo=base.tzinfo)
+            if run <= base:
+                run += timedelta(days=1)
+
+        if self.trading_hours:
+            run = trading_time(run)
+        return run
+
+
+class RefreshScheduler(object):
+    """
+    Планировщик фонового обновления данных Мосбиржи
+
+    Задачи выполняются в пуле из max_workers потоков, результат каждого запуска сохраняется
+    в таблицу config.scheduler_state_table (время запуска и последнего успешного запуска,
+    статус, ошибка). После перезапуска расписание продолжается от сохраненных запусков:
+    ночная синхронизация не повторяется, а пропущенная - выполняется сразу.
+    После ошибки задача повторяется через retry_delay секунд.
+
+    Время берется из clock, поэтому расписание проверяется с FakeClock без ожидания:
+    run_pending запускает все задачи, которым пора, и ждет их завершения.
+    """
+
+    def __init__(self, db: DatabaseManager, jobs: Iterable[Job], max_workers: int = config.scheduler_workers,
+                 clock: Optional[Clock] = None, rng: Optional[random.Random] = None,
+                 state_table: str = config.scheduler_state_table,
+                 poll_interval: float = config.scheduler_poll_interval):
+        self.db = db
+        self.jobs = self.order_jobs(jobs)
+        self.clock = clock or Clock()
+        self.rng = rng or random.Random()
+        self.state_table = state_table
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='refresh')
+        # Выполняющиеся задачи: имя -> (Future, время запуска)
+        self.running: Dict[str, Tuple[Future, datetime]] = {}
+        # Результаты последних запусков: имя -> {last_run, last_success, status, error}
+        self.state: Dict[str, dict] = {}
+        self.next_runs: Dict[str, datetime] = {}
+        self.load_state()
+
+    @staticmethod
+    def order_jobs(jobs: Iterable[Job]) -> Dict[str, Job]:
+        """
+        Задачи в порядке зависимостей: каждая задача идет после всех своих зависимостей
+
+        :raises ValueError: неизвестная зависимость или цикл зависимостей
+        """
+        jobs = {job.name: job for job in jobs}
+        ordered = {}
+        visiting = set()
+
+        def visit(job: Job):
+            if job.name in ordered:
+                return
+            if job.name in visiting:
+                raise ValueError(f"Цикл в зависимостях задачи '{job.name}'")
+            visiting.add(job.name)
+            for dependency in job.depends_on:
+                if dependency not in jobs:
+                    raise ValueError(f"Задача '{job.name}' зависит от неизвестной задачи '{dependency}'")
+                visit(jobs[dependency])
+            ordered[job.name] = job
+
+        for job in jobs.values():
+            visit(job)
+        return ordered
+
+    def ensure_state_table(self):
+        """Создание таблицы результатов запусков, если ее еще нет"""
+        if not self.db.table_exists(self.state_table):
+            self.db.create_table(table_name=self.state_table,
+                                 columns={'job': 'TEXT NOT NULL', 'last_run': 'TEXT', 'last_success': 'TEXT',
+                                          'status': 'TEXT', 'error': 'TEXT', 'duration': 'REAL'},
+                                 constraints=['PRIMARY KEY (job)'])
+
+    def load_state(self):
+        """Чтение результатов прошлых запусков и расчет следующих запусков"""
+        self.ensure_state_table()
+        rows = self.db.execute_safe(f"SELECT job, last_run, last_success, status, error FROM {self.state_table}")
+        for job_name, last_run, last_success, status, error in rows or []:
+            if job_name in self.jobs:
+                self.state[job_name] = {
+                    'last_run': datetime.fromisoformat(last_run) if last_run else None,
+                    'last_success': datetime.fromisoformat(last_success) if last_success else None,
+                    'status': status,
+                    'error': error,
+                }
+
+        now = self.clock.now()
+        for job in self.jobs.values():
+            state = self.state.setdefault(job.name, {'last_run': None, 'last_success': None,
+                                                     'status': None, 'error': None})
+            self.next_runs[job.name] = self.schedule(job, state, now)
+
+    def schedule(self, job: Job, state: dict, now: datetime) -> datetime:
+        """Следующий запуск задачи со случайной задержкой (после ошибки - повтор через retry_delay)"""
+        if state['status'] == 'error':
+            run = state['last_run'] + timedelta(seconds=job.retry_delay)
+            return trading_time(run) if job.trading_hours else run
+        return job.next_run(state['last_run'], now) + timedelta(seconds=self.rng.uniform(0, job.jitter))
+
+    def dependencies_ready(self, job: Job) -> bool:
+        """Все зависимости не выполняются сейчас и успешно выполнены после прошлого запуска задачи"""
+        last_run = self.state[job.name]['last_run']
+        for dependency in job.depends_on:
+            last_success = self.state[dependency]['last_success']
+            if dependency in self.running or last_success is None:
+                return False
+            if last_run is not None and last_success < last_run:
+                return False
+        return True
+
+    def tick(self) -> List[str]:
+        """
+        Одна проверка расписания: учет завершившихся задач и запуск задач, которым пора
+
+        :return: List[str]: имена запущенных задач
+        """
+        self.collect()
+        now = self.clock.now()
+        started = []
+        for name, job in self.jobs.items():
+            if name in self.running or self.next_runs[name] > now:
+                continue
+            if not self.dependencies_ready(job):
+                continue
+            self.running[name] = (self.executor.submit(self.execute, job), now)
+            started.append(name)
+        return started
+
+    @staticmethod
+    def execute(job: Job) -> Tuple[bool, Optional[str], float]:
+        """
+        Выполнение задачи в потоке пула
+
+        :return: Tuple[bool, str, float]: успешно ли, текст ошибки, длительность в секундах
+        """
+        start = time_module.monotonic()
+        try:
+            result = job.func()
+        except Exception as e:
+            logger.exception(f"Ошибка в задаче '{job.name}'")
+            return False, f"{type(e).__name__}: {e}", time_module.monotonic() - start
+
+        if result is False:
+            return False, 'Задача завершилась с ошибкой', time_module.monotonic() - start
+        return True, None, time_module.monotonic() - start
+
+    def collect(self, wait: bool = False):
+        """
+        Учет завершившихся задач: сохранение результата и расчет следующего запуска
+
+        :param wait: bool: дождаться завершения всех выполняющихся задач
+        """
+        for name, (future, started_at) in list(self.running.items()):
+            if not wait and not future.done():
+                continue
+            ok, error, duration = future.result()
+            del self.running[name]
+            self.record(self.jobs[name], started_at, ok, error, duration)
+
+    def record(self, job: Job, started_at: datetime, ok: bool, error: Optional[str], duration: float):
+        """Сохранение результата запуска задачи"""
+        state = self.state[job.name]
+        state['last_run'] = started_at
+        state['status'] = 'ok' if ok else 'error'
+        state['error'] = error
+        if ok:
+            state['last_success'] = started_at
+
+        self.db.execute_safe(
+            f"INSERT OR REPLACE INTO {self.state_table} (job, last_run, last_success, status, error, duration) "
+            f"VALUES (?, ?, ?, ?, ?, ?)",
+            (job.name, started_at.isoformat(),
+             state['last_success'].isoformat() if state['last_success'] else None,
+             state['status'], error, duration)
+        )
+
+        self.next_runs[job.name] = self.schedule(job, state, self.clock.now())
+        if ok:
+            logger.info(f"Задача '{job.name}' выполнена за {duration:.1f} c, "
+                        f"следующий запуск {self.next_runs[job.name]:%Y-%m-%d %H:%M:%S}")
+        else:
+            logger.error(f"Задача '{job.name}' завершилась с ошибкой ({error}), "
+                         f"повтор {self.next_runs[job.name]:%Y-%m-%d %H:%M:%S}")
+
+    def run_pending(self) -> List[str]:
+        """
+        Запуск всех задач, которым пора, с ожиданием их завершения
+
+        Задачи, зависимости которых выполнились в этом же вызове, тоже запускаются.
+
+        :return: List[str]: имена выполненных задач в порядке запуска
+        """
+        executed = []
+        while True:
+            started = self.tick()
+            if not started:
+                return executed
+            executed += started
+            self.collect(wait=True)
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """
+        Основной цикл: проверка расписания раз в poll_interval секунд до установки stop
+
+        При остановке выполняющиеся задачи дожидаются завершения.
+        """
+        stop = stop or threading.Event()
+        logger.info(f"Планировщик запущен, задач: {len(self.jobs)}")
+        try:
+            while True:
+                self.tick()
+                if self.clock.sleep(self.poll_interval, stop):
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        """Ожидание выполняющихся задач и остановка пула потоков"""
+        self.collect(wait=True)
+        self.executor.shutdown(wait=True)
+
+
+def default_jobs(marketdata) -> List[Job]:
+    """
+    Задачи обновления данных Marketdata по расписанию из config
+
+    В торговые часы обновляются снимки торгов (акции, фонды, облигации, валюты) и курсы валют,
+    курсы - только после снимка валют. Ночью синхронизируются история цен, сплиты и смена кодов.
+    Курсы за прошедшие дни отдельной задачей не обновляются: их копирует синхронизация
+    истории валют (см. Marketdata.sync_price_history).
+
+    :param marketdata: Marketdata
+    :return: List[Job]
+    """
+    jobs = []
+    for active_type in ('currency', 'shares', 'bonds'):
+        jobs.append(Job(name=f'snapshot_{active_type}',
+                        func=partial(marketdata.update_current_marketdata, active_type=active_type),
+                        every=config.snapshot_interval, trading_hours=True, jitter=config.snapshot_jitter))
+        jobs.append(Job(name=f'history_{active_type}',
+                        func=partial(marketdata.get_price_history, active_type=active_type, operation='sync'),
+                        at=config.nightly_sync_at, jitter=config.nightly_jitter))
+
+    jobs += [
+        # Курсы для пересчета облигаций в рубли - после свежего снимка валют
+        Job(name='fx_rates', func=marketdata.translate_to_rub, every=config.fx_interval,
+            trading_hours=True, depends_on=['snapshot_currency'], jitter=config.snapshot_jitter),
+        # Сплиты и смена кодов пересчитывают одни и те же таблицы корректировок, поэтому по очереди
+        Job(name='splits', func=marketdata.get_splits_history, at=config.nightly_sync_at,
+            jitter=config.nightly_jitter),
+        Job(name='changeovers', func=marketdata.get_changeover_history, at=config.nightly_sync_at,
+            depends_on=['splits']),
+    ]
+    return jobs
+
+
+if __name__ == '__main__':
+    import argparse
+    from market import Marketdata
+
+    parser = argparse.ArgumentParser(description='Фоновое обновление данных Мосбиржи')
+    parser.add_argument('--once', action='store_true', help='Выполнить задачи, которым пора, и завершиться')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    marketdata = Marketdata()
+    scheduler = RefreshScheduler(db=marketdata.DBS, jobs=default_jobs(marketdata))
+    if args.once:
+        scheduler.run_pending()
+        scheduler.close()
+    else:
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            logger.info('Планировщик остановлен')
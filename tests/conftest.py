@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+# Модули проекта лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Временный рабочий каталог: база database.db, кэш ISS и Parquet создаются в нем"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'iss')
+
+
+@pytest.fixture
+def iss_stub():
+    """Локальная замена ISS, отдающая записанные ответы из tests/fixtures/iss"""
+    from iss_stub import IssStub
+
+    with IssStub(page_size=10, fixtures_dir=FIXTURES_DIR) as stub:
+        yield stub
+
+
+@pytest.fixture
+def make_marketdata(iss_stub, tmp_path):
+    """
+    Фабрика Marketdata, которая обращается к iss_stub, а базу и Parquet держит в своем каталоге
+
+    Ссылки из config строятся от ISS_URL при импорте, поэтому здесь они переводятся на адрес заглушки.
+    """
+    import config
+    from columnar import PriceHistoryStore
+    from fetcher import IssFetcher
+    from market import Marketdata
+
+    created = []
+
+    def make(name: str = 'md', **fetcher_kwargs) -> Marketdata:
+        directory = tmp_path / name
+        directory.mkdir()
+        md = Marketdata(db_path=str(directory / 'database.db'))
+        md.urls_settings = {active_type: [*settings[:5], settings[5].replace(config.iss_url, iss_stub.url)]
+                            for active_type, settings in md.urls_settings.items()}
+        md.candles_url = md.candles_url.replace(config.iss_url, iss_stub.url)
+        md.split_url = md.split_url.replace(config.iss_url, iss_stub.url)
+        md.rename_url = md.rename_url.replace(config.iss_url, iss_stub.url)
+        md.candles_page_size = iss_stub.page_size
+        md.price_store = PriceHistoryStore(md.DBS, root=str(directory / 'columnar'))
+
+        md.fetcher.close()
+        md.fetcher = IssFetcher(**{'cache_dir': None, 'requests_per_second': 0, **fetcher_kwargs})
+        md.fetcher.sleep = lambda seconds: None
+        created.append(md)
+        return md
+
+    yield make
+
+    for md in created:
+        md.fetcher.close()
+        md.DBS.close()
@@ -0,0 +1,312 @@
+import sqlite3
+import threading
+from datetime import date, datetime
+
+import polars as pl
+import pytest
+
+import database
+from benchmark import legacy_row_insert
+from database import DatabaseManager
+
+
+def table_rows(db_path: str, table_name: str, columns: list) -> list:
+    """Значения и типы хранения SQLite (typeof) всех строк таблицы в порядке вставки"""
+    select = ", ".join(f"{col}, typeof({col})" for col in columns)
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f"SELECT {select} FROM {table_name} ORDER BY rowid").fetchall()
+
+
+def test_columnar_insert_matches_row_insert(tmp_path):
+    """Столбцовая вставка пишет те же значения тех же типов, что и прежняя построчная"""
+    df = pl.DataFrame({
+        'date': [date(2024, 1, 5), None, date(1999, 12, 31), date(2024, 2, 29)],
+        'moment': [datetime(2024, 1, 5, 10, 30), datetime(2024, 1, 5, 0, 0), None, datetime(2000, 1, 1, 23, 59, 59)],
+        'SECID': ['SBER', None, 'BB-B', ''],
+        'quantity': pl.Series([10, None, -3, 0], dtype=pl.Int64),
+        'small': pl.Series([1, 2, None, 255], dtype=pl.UInt8),
+        'price': [1.5, None, 2.0, -0.1],
+        'ratio': pl.Series([0.1, 1.0, None, 3.25], dtype=pl.Float32),
+        # Целые в REAL и дробные в INTEGER: SQLite приводит значения по типу столбца
+        'int_as_real': pl.Series([1, 2, None, 4], dtype=pl.Int64),
+        'float_as_int': [1.0, 2.5, None, -4.0],
+        'traded': [True, False, None, True],
+    })
+    columns = {'date': 'TEXT', 'moment': 'TEXT', 'SECID': 'TEXT', 'quantity': 'INTEGER', 'small': 'INTEGER',
+               'price': 'REAL', 'ratio': 'REAL', 'int_as_real': 'REAL', 'float_as_int': 'INTEGER',
+               'traded': 'INTEGER'}
+
+    legacy_path = str(tmp_path / 'legacy.db')
+    legacy_row_insert(legacy_path, df, 'prices', batch_size=3, columns=columns)
+
+    for bulk_load in (False, True):
+        db_path = str(tmp_path / f'columnar_{bulk_load}.db')
+        db = DatabaseManager(db_path=db_path)
+        assert db.create_table('prices', columns)
+        assert db.add_dataframe_to_table(df=df, table_name='prices', batch_size=3, bulk_load=bulk_load)
+        db.close()
+
+        assert table_rows(db_path, 'prices', df.columns) == table_rows(legacy_path, 'prices', df.columns)
+
+
+def test_columnar_insert_creates_table_from_frame(tmp_path):
+    """Таблица, созданная по типам DataFrame, читается обратно без потерь"""
+    df = pl.DataFrame({
+        'date': [date(2024, 1, 5), None],
+        'SECID': ['SBER', None],
+        'quantity': pl.Series([10, None], dtype=pl.Int64),
+        'price': [None, 2.5],
+    })
+    db = DatabaseManager(db_path=str(tmp_path / 'db.db'))
+    assert db.add_dataframe_to_table(df=df, table_name='prices')
+
+    result = db.read_table_to_dataframe('prices').with_columns(pl.col('date').str.to_date())
+    assert result.equals(df)
+    db.close()
+
+
+@pytest.fixture
+def operations_db(tmp_path):
+    db = DatabaseManager(db_path=str(tmp_path / 'scan.db'))
+    db.create_table('operations_history', columns={'Date': 'TEXT', 'SECID': 'TEXT', 'Quantity': 'INTEGER',
+                                                   'Price': 'REAL'})
+    db.add_dataframe_to_table(pl.DataFrame({
+        'Date': [date(2023, 12, 29), date(2024, 1, 5), date(2024, 2, 1), date(2024, 3, 1)],
+        'SECID': ['SBER', 'GAZP', 'SBER', 'LKOH'],
+        'Quantity': [10, 5, -4, 1],
+        'Price': [250.0, 160.5, 270.0, 7000.0],
+    }), table_name='operations_history')
+    yield db
+    db.close()
+
+
+def scan(db: DatabaseManager, query) -> tuple:
+    """Результат ленивого запроса к operations_history и SQL, который для него выполнен"""
+    statements = []
+    with db.snapshot() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            result = query(db.scan_table('operations_history', date_columns=['Date'])).collect()
+        finally:
+            conn.set_trace_callback(None)
+    return result, [sql for sql in statements if 'FROM operations_history' in sql]
+
+
+def expected(db: DatabaseManager, query) -> pl.DataFrame:
+    eager = db.read_table_to_dataframe(table_name='operations_history')
+    return query(eager.with_columns(pl.col('Date').str.to_date()).lazy()).collect()
+
+
+@pytest.mark.parametrize('query, where', [
+    (lambda lf: lf.filter(pl.col('Date') >= date(2024, 1, 1)), "WHERE Date >= '2024-01-01'"),
+    (lambda lf: lf.filter(date(2024, 2, 1) > pl.col('Date')), "WHERE Date < '2024-02-01'"),
+    (lambda lf: lf.filter((pl.col('SECID') == 'SBER') & (pl.col('Quantity') < 0)).select('Date', 'Price'),
+     "WHERE"),
+    (lambda lf: lf.select('SECID', 'Date').head(2), "LIMIT 2"),
+])
+def test_scan_table_pushes_filters_to_sql(operations_db, query, where):
+    """Сравнения столбца с литералом (в т.ч. с датой) выполняются в SQL"""
+    result, statements = scan(operations_db, query)
+    assert result.equals(expected(operations_db, query))
+    assert len(statements) == 1 and where in statements[0]
+    assert result.schema.get('Date') in (pl.Date, None)
+
+
+@pytest.mark.parametrize('query', [
+    lambda lf: lf.filter(pl.col('Date').is_between(date(2024, 1, 1), date(2024, 2, 1))),
+    lambda lf: lf.filter((pl.col('SECID') == 'SBER') | (pl.col('Quantity') > 4)),
+    lambda lf: lf.filter(pl.col('SECID').str.starts_with('S')).select('Quantity'),
+    lambda lf: lf.filter((pl.col('Price') * pl.col('Quantity')) > 1000),
+    lambda lf: lf.filter((pl.col('Date') >= date(2024, 1, 1)) & pl.col('SECID').is_in(['SBER', 'LKOH'])).head(1),
+])
+def test_scan_table_filters_in_polars_when_not_translatable(operations_db, query):
+    """Фильтры, которые не переводятся в SQL, дают тот же результат (фильтрация в Polars)"""
+    result, statements = scan(operations_db, query)
+    assert result.equals(expected(operations_db, query))
+    assert len(statements) == 1 and 'LIMIT' not in statements[0]
+
+
+def test_scan_table_without_pushdown_on_unknown_polars(operations_db, monkeypatch):
+    """На непроверенной версии Polars фильтр не переносится в SQL, а результат тот же"""
+    monkeypatch.setattr(database, '_PUSHDOWN_POLARS_VERSIONS', ('0.0.',))
+    query = lambda lf: lf.filter(pl.col('Date') >= date(2024, 1, 1))
+    result, statements = scan(operations_db, query)
+    assert result.equals(expected(operations_db, query))
+    assert 'WHERE' not in statements[0]
+
+
+def test_scan_table_date_columns(operations_db):
+    """Без date_columns даты выдаются текстом, нетекстовый столбец датой быть не может"""
+    assert operations_db.scan_table('operations_history').collect_schema()['Date'] == pl.Utf8
+    with pytest.raises(ValueError):
+        operations_db.scan_table('operations_history', date_columns=['Quantity'])
+
+
+def test_read_table_keeps_non_integer_values_of_integer_columns(tmp_path):
+    """Дробное число в столбце INTEGER читается как есть, а не обрезается по объявленному типу"""
+    db = DatabaseManager(db_path=str(tmp_path / 'types.db'))
+    db.create_table('operations_history', columns={'SECID': 'TEXT', 'Quantity': 'INTEGER', 'Price': 'REAL'})
+    db.insert_row('operations_history', {'SECID': 'SBER', 'Quantity': 10, 'Price': 250})
+    db.insert_row('operations_history', {'SECID': 'GAZP', 'Quantity': 1.5, 'Price': 160.5})
+
+    by_table = db.read_table_to_dataframe(table_name='operations_history')
+    by_query = db.read_table_to_dataframe(sql_query='SELECT * FROM operations_history')
+    assert by_table['Quantity'].to_list() == [10, 1.5]
+    assert by_table.equals(by_query)
+
+    # Строки без нецелых значений по-прежнему читаются по объявленным типам
+    clean = db.read_table_to_dataframe(table_name='operations_history', where_conditions={'SECID': 'SBER'})
+    assert clean.schema == {'SECID': pl.Utf8, 'Quantity': pl.Int64, 'Price': pl.Float64}
+
+    db.insert_row('operations_history', {'SECID': 'LKOH', 'Quantity': 'many', 'Price': 7000})
+    assert db.read_table_to_dataframe(table_name='operations_history', columns=['SECID', 'Quantity']).height == 3
+    db.close()
+
+
+def test_non_integer_check_runs_again_only_after_write(tmp_path):
+    """Проверка типов хранения повторяется только после записи, в том числе напрямую через соединение"""
+    db_path = str(tmp_path / 'types.db')
+    db = DatabaseManager(db_path=db_path)
+    db.create_table('operations_history', columns={'SECID': 'TEXT', 'Quantity': 'INTEGER'})
+    db.insert_row('operations_history', {'SECID': 'SBER', 'Quantity': 10})
+
+    statements = []
+    db.get_connection().set_trace_callback(statements.append)
+
+    def read(**kwargs) -> tuple:
+        """Прочитанная таблица и количество запросов проверки типов хранения"""
+        statements.clear()
+        df = db.read_table_to_dataframe(table_name='operations_history', **kwargs)
+        checks = [sql for sql in statements if 'typeof' in sql]
+        return df, len(checks)
+
+    df, checks = read()
+    assert checks == 1 and df.schema['Quantity'] == pl.Int64
+    assert read()[1] == 0
+    assert read(where_conditions={'SECID': 'SBER'})[1] == 1
+
+    # Запись без touch_tables (как в Portfolio.add_operations)
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO operations_history (SECID, Quantity) VALUES ('GAZP', 1.5)")
+    df, checks = read()
+    assert checks == 1 and df['Quantity'].to_list() == [10, 1.5]
+    # Проверяются только читаемые строки
+    conn = db.get_connection()
+    assert db.has_non_integer_values(conn, 'operations_history', ['Quantity'])
+    assert not db.has_non_integer_values(conn, 'operations_history', ['Quantity'], limit=1)
+
+    # Запись из другого соединения
+    assert read()[1] == 0
+    with sqlite3.connect(db_path) as other:
+        other.execute("UPDATE operations_history SET Quantity = 2 WHERE SECID = 'GAZP'")
+    df, checks = read()
+    assert checks == 1 and df.schema['Quantity'] == pl.Int64 and df['Quantity'].to_list() == [10, 2]
+    db.close()
+
+
+def test_declared_indexes_are_created_with_table(tmp_path):
+    """Объявленные индексы создаются вместе с таблицей, после замены таблицы и для уже существующей таблицы"""
+    db = DatabaseManager(db_path=str(tmp_path / 'db.db'),
+                         indexes={'prices': {'idx_prices_date': ['date'], 'idx_prices_volume': ['volume']}})
+    prices = pl.DataFrame({'SECID': ['SBER', 'GAZP'], 'date': ['2024-01-05', '2024-01-05'], 'close': [250.0, 160.0]})
+
+    assert db.add_dataframe_to_table(df=prices, table_name='prices')
+    # Индекс по столбцу, которого в таблице нет, пропускается
+    assert db.get_indexes('prices') == {'idx_prices_date': ['date']}
+    assert db.add_dataframe_to_table(df=prices, table_name='prices', if_exists='replace')
+    assert db.get_indexes('prices') == {'idx_prices_date': ['date']}
+
+    db.declare_indexes('prices', {'idx_prices_secid_date': ['SECID', 'date']})
+    assert db.get_indexes('prices') == {'idx_prices_date': ['date'], 'idx_prices_secid_date': ['SECID', 'date']}
+
+    assert db.check_query_plan("SELECT close FROM prices WHERE SECID = ? AND date >= ?", ('SBER', '2024-01-01')) == []
+    assert db.check_query_plan("SELECT close FROM prices WHERE date = ?", ('2024-01-05',)) == []
+    scans = db.check_query_plan("SELECT SECID FROM prices WHERE close > ?", (200,))
+    assert len(scans) == 1 and scans[0].startswith('SCAN prices')
+    db.close()
+
+
+def test_explain_queries_checks_every_read(tmp_path, monkeypatch):
+    """В режиме explain_queries план проверяется перед каждым чтением, результат запроса не меняется"""
+    db = DatabaseManager(db_path=str(tmp_path / 'db.db'), explain_queries=True,
+                         indexes={'prices': {'idx_prices_date': ['date']}})
+    db.add_dataframe_to_table(df=pl.DataFrame({'SECID': ['SBER'], 'date': ['2024-01-05'], 'close': [250.0]}),
+                              table_name='prices')
+    checked = []
+    check_query_plan = db.check_query_plan
+
+    def recorded_check(sql, params=()):
+        checked.append(check_query_plan(sql, params))
+        return checked[-1]
+
+    monkeypatch.setattr(db, 'check_query_plan', recorded_check)
+
+    assert db.read_table_to_dataframe(table_name='prices', where_conditions={'date': '2024-01-05'}).height == 1
+    assert db.execute_safe("SELECT close FROM prices WHERE close > ?", (0,)) == [(250.0,)]
+    assert checked == [[], ['SCAN prices']]
+    db.close()
+
+
+def versioned_prices(version: int, rows: int = 500) -> pl.DataFrame:
+    return pl.DataFrame({'SECID': [f'S{i}' for i in range(rows)], 'close': [float(i) for i in range(rows)],
+                         'version': [version] * rows})
+
+
+def test_readers_never_see_replaced_table_missing_or_partial(tmp_path):
+    """Во время замены таблицы читатели видят либо старую, либо новую таблицу целиком"""
+    db = DatabaseManager(db_path=str(tmp_path / 'db.db'), wal=True,
+                         indexes={'prices': {'idx_prices_version': ['version']}})
+    assert db.add_dataframe_to_table(df=versioned_prices(0), table_name='prices')
+
+    stop = threading.Event()
+    seen, errors = [], []
+
+    def read():
+        while not stop.is_set():
+            rows = db.execute_safe("SELECT COUNT(*), MIN(version), MAX(version) FROM prices")
+            if rows is None:
+                errors.append('prices')
+            else:
+                seen.append(rows[0])
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    try:
+        for version in range(1, 21):
+            # Маленькие батчи: теневая таблица заполняется за несколько шагов
+            assert db.add_dataframe_to_table(df=versioned_prices(version), table_name='prices',
+                                             if_exists='replace', batch_size=50)
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+    assert errors == []
+    assert seen and all(count == 500 and low == high for count, low, high in seen)
+    assert db.execute_safe("SELECT MIN(version) FROM prices") == [(20,)]
+    assert 'idx_prices_version' in db.get_indexes('prices')
+    # Теневых таблиц не остается
+    assert set(db.get_schema()) == {'prices', db.versions_table}
+    db.close()
+
+
+def test_snapshot_reads_one_moment_without_blocking_writers(tmp_path):
+    """Снимок видит базу на момент первого чтения, запись из другого потока его не ждет"""
+    db = DatabaseManager(db_path=str(tmp_path / 'db.db'), wal=True)
+    assert db.add_dataframe_to_table(df=versioned_prices(0, rows=3), table_name='prices')
+
+    with db.snapshot():
+        assert db.execute_safe("SELECT MAX(version) FROM prices") == [(0,)]
+        writer = threading.Thread(target=lambda: db.add_dataframe_to_table(
+            df=versioned_prices(1, rows=3), table_name='prices', if_exists='replace'))
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+
+        assert db.execute_safe("SELECT MAX(version) FROM prices") == [(0,)]
+        assert db.read_table_to_dataframe(table_name='prices')['version'].to_list() == [0, 0, 0]
+        assert db.scan_table('prices').select('version').collect()['version'].to_list() == [0, 0, 0]
+
+    assert db.execute_safe("SELECT MAX(version) FROM prices") == [(1,)]
+    db.close()
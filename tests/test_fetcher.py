@@ -0,0 +1,111 @@
+from datetime import date, timedelta
+
+import pytest
+
+from fetcher import IssFetcher, IssFetchError
+
+
+CANDLES_PATH = '/engines/stock/markets/shares/securities/SBER/candles.json'
+
+
+@pytest.fixture
+def make_fetcher(tmp_path):
+    """Фабрика IssFetcher без пауз между попытками: паузы записываются в fetcher.sleeps"""
+    created = []
+
+    def make(**kwargs) -> IssFetcher:
+        fetcher = IssFetcher(**{'cache_dir': None, 'requests_per_second': 0, **kwargs})
+        fetcher.sleeps = []
+        fetcher.sleep = fetcher.sleeps.append
+        created.append(fetcher)
+        return fetcher
+
+    yield make
+
+    for fetcher in created:
+        fetcher.close()
+
+
+def candles_url(stub, date_from: date, date_till: date) -> str:
+    return f"{stub.url}{CANDLES_PATH}?from={date_from}&till={date_till}&interval=24"
+
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_retries_transient_errors(iss_stub, make_fetcher, status):
+    """429 и 5xx повторяются с паузой, после восстановления отдается ответ"""
+    fetcher = make_fetcher()
+    iss_stub.fail(CANDLES_PATH, status=status, times=2)
+
+    data = fetcher.get_json(candles_url(iss_stub, date(2023, 1, 9), date(2023, 1, 13)), try_count=3)
+
+    assert len(data['candles']['data']) == 5
+    assert iss_stub.requests[f'/iss{CANDLES_PATH}'] == 3
+    assert len(fetcher.sleeps) == 2
+
+
+def test_raises_after_all_attempts(iss_stub, make_fetcher):
+    """Если все попытки неудачны, выбрасывается IssFetchError"""
+    fetcher = make_fetcher()
+    iss_stub.fail(CANDLES_PATH, status=503)
+
+    with pytest.raises(IssFetchError):
+        fetcher.get_json(candles_url(iss_stub, date(2023, 1, 9), date(2023, 1, 13)), try_count=4)
+
+    assert iss_stub.requests[f'/iss{CANDLES_PATH}'] == 4
+    assert len(fetcher.sleeps) == 3
+
+
+def test_client_errors_are_not_retried(iss_stub, make_fetcher):
+    """Ошибка 404 не повторяется"""
+    fetcher = make_fetcher()
+
+    with pytest.raises(IssFetchError):
+        fetcher.get_json(f"{iss_stub.url}/unknown.json", try_count=5)
+
+    assert iss_stub.requests['/iss/unknown.json'] == 1
+    assert fetcher.sleeps == []
+
+
+def test_connection_errors_are_retried(make_fetcher):
+    """Ошибки соединения повторяются и в конце дают IssFetchError"""
+    fetcher = make_fetcher(timeout=(0.5, 0.5))
+
+    with pytest.raises(IssFetchError):
+        fetcher.get_json('http://127.0.0.1:9/iss/securities.json', try_count=3)
+
+    assert len(fetcher.sleeps) == 2
+
+
+def test_closed_year_is_served_from_cache(iss_stub, make_fetcher, tmp_path):
+    """Свечи закрытого года берутся из кэша без запроса, даже после перезапуска и с нулевым сроком свежести"""
+    url = candles_url(iss_stub, date(2020, 1, 1), date(2020, 12, 31))
+    first = make_fetcher(cache_dir=str(tmp_path / 'cache'), cache_ttl=0).get_json(url)
+    restarted = make_fetcher(cache_dir=str(tmp_path / 'cache'), cache_ttl=0)
+
+    assert restarted.get_json(url) == first
+    assert iss_stub.requests[f'/iss{CANDLES_PATH}'] == 1
+
+
+def test_stale_response_is_revalidated_with_etag(iss_stub, make_fetcher, tmp_path):
+    """Устаревший ответ за текущий период проверяется по ETag: на 304 отдается кэш"""
+    fetcher = make_fetcher(cache_dir=str(tmp_path / 'cache'), cache_ttl=0)
+    url = candles_url(iss_stub, date.today() - timedelta(days=10), date.today())
+
+    first = fetcher.get_json(url)
+    second = fetcher.get_json(url)
+
+    assert second == first
+    assert iss_stub.requests[f'/iss{CANDLES_PATH}'] == 2
+    assert iss_stub.statuses[304] == 1
+    assert fetcher.ttl_for(url) == 0
+
+
+def test_fresh_response_is_not_requested(iss_stub, make_fetcher, tmp_path):
+    """Пока ответ свежий (cache_ttl), запрос к серверу не отправляется"""
+    fetcher = make_fetcher(cache_dir=str(tmp_path / 'cache'), cache_ttl=60)
+    url = candles_url(iss_stub, date.today() - timedelta(days=10), date.today())
+
+    fetcher.get_json(url)
+    fetcher.get_json(url)
+
+    assert iss_stub.requests[f'/iss{CANDLES_PATH}'] == 1
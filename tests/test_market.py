@@ -0,0 +1,351 @@
+import json
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+import polars as pl
+import pytest
+
+import adjustments
+from conftest import FIXTURES_DIR
+from fetcher import IssFetcher, IssFetchError
+from portfolio import Portfolio
+
+
+SHARES_DIR = os.path.join(FIXTURES_DIR, 'engines', 'stock', 'markets', 'shares')
+
+
+def recorded_candles(secids: list, date_from: date) -> pl.DataFrame:
+    """Ожидаемая история цен: записанные свечи бумаг начиная с date_from, в формате таблицы SQL"""
+    frames = []
+    for secid in secids:
+        with open(os.path.join(SHARES_DIR, 'securities', secid, 'candles.json'), encoding='utf-8') as f:
+            block = json.load(f)['candles']
+        frames.append(pl.DataFrame(block['data'], schema=block['columns'], orient='row').select(
+            pl.lit(secid).alias('SECID'),
+            pl.col('end').str.slice(0, 10).alias('date'),
+            *[pl.col(col).cast(pl.Float64) for col in ['open', 'high', 'low', 'close', 'volume', 'value']],
+        ))
+    return pl.concat(frames).filter(pl.col('date') >= str(date_from)).sort('SECID', 'date')
+
+
+def price_history(md) -> pl.DataFrame:
+    return md.DBS.read_table_to_dataframe('marketdata_shares').sort('SECID', 'date')
+
+
+def test_price_history_matches_sequential_fetch(make_marketdata, iss_stub):
+    """Параллельная загрузка дает ту же таблицу, что и последовательная, и ту же, что в записанных ответах"""
+    start_date = date(2022, 12, 5)
+
+    sequential = make_marketdata('sequential', max_workers=1)
+    sequential.get_price_history(active_type='shares', operation='replace', start_date=start_date, end_year=2023)
+    parallel = make_marketdata('parallel', max_workers=8)
+    parallel.get_price_history(active_type='shares', operation='replace', start_date=start_date, end_year=2023)
+
+    expected = recorded_candles(['GAZP', 'LKOH', 'SBER'], start_date)
+    assert price_history(sequential).equals(expected)
+    assert price_history(parallel).equals(expected)
+    # Записанные свечи не помещаются в одну страницу: следующие страницы запрашивались через start=
+    assert any('start=10' in url for url in iss_stub.urls)
+
+
+def test_fetch_many_keeps_order_and_bounded_window(iss_stub):
+    """fetch_many отдает ответы по порядку и запрашивает вперед не больше max_workers * prefetch_per_worker"""
+    urls = [f"{iss_stub.url}/engines/stock/markets/shares/securities/SEC{i}/candles.json"
+            f"?from=2023-01-01&till=2023-01-10&interval=24" for i in range(40)]
+    fetcher = IssFetcher(max_workers=2, prefetch_per_worker=2, requests_per_second=0, cache_dir=None)
+
+    responses = fetcher.fetch_many(urls)
+    first = next(responses)
+    time.sleep(0.3)
+    # Выдан один ответ: отправлены окно из 4 запросов и один на его место
+    assert sum(iss_stub.requests.values()) <= 5
+
+    pages = [first, *responses]
+    assert pages == [fetcher.get_json(url) for url in urls]
+    fetcher.close()
+
+
+def test_price_history_download_does_not_hold_write_lock(make_marketdata):
+    """Пока идут запросы к ISS, другое соединение может писать в базу"""
+    from database import DatabaseManager
+
+    md = make_marketdata()
+    other = DatabaseManager(md.DBS.db_path, wal=True, busy_timeout=0.05)
+    writes = []
+    get_json = md.fetcher.get_json
+
+    def get_json_and_write(url, *args, **kwargs):
+        writes.append(other.insert_row('probe', {'url': url}) is not None)
+        return get_json(url, *args, **kwargs)
+
+    other.create_table('probe', {'url': 'TEXT'})
+    md.fetcher.get_json = get_json_and_write
+    md.get_price_history(active_type='shares', operation='replace', start_date=date(2022, 12, 5), end_year=2023)
+
+    assert writes and all(writes)
+    assert price_history(md).equals(recorded_candles(['GAZP', 'LKOH', 'SBER'], date(2022, 12, 5)))
+    other.close()
+
+
+def test_price_history_append_and_failed_replace(make_marketdata, iss_stub):
+    """append дописывает свечи к таблице, прерванная замена оставляет прежнюю таблицу целиком"""
+    md = make_marketdata()
+    md.get_price_history(active_type='shares', operation='replace', start_date=date(2023, 1, 1), end_year=2023)
+    md.get_price_history(active_type='shares', operation='append', start_date=date(2022, 12, 5), end_year=2022)
+    expected = recorded_candles(['GAZP', 'LKOH', 'SBER'], date(2022, 12, 5))
+    assert price_history(md).equals(expected)
+
+    iss_stub.fail('/securities/LKOH/candles.json')
+    with pytest.raises(IssFetchError):
+        md.get_price_history(active_type='shares', operation='replace', start_date=date(2023, 1, 20), end_year=2023)
+    assert price_history(md).equals(expected)
+    assert 'idx_marketdata_shares_date' in md.DBS.get_indexes('marketdata_shares')
+
+
+def record_inserts(md, monkeypatch) -> list:
+    """Размеры DataFrame, записанных в SQL через add_dataframe_to_table: [(таблица, строк)]"""
+    inserts = []
+    add_dataframe_to_table = md.DBS.add_dataframe_to_table
+
+    def recording(df, table_name, **kwargs):
+        inserts.append((table_name, df.height))
+        return add_dataframe_to_table(df=df, table_name=table_name, **kwargs)
+
+    monkeypatch.setattr(md.DBS, 'add_dataframe_to_table', recording)
+    return inserts
+
+
+def test_price_history_is_written_in_bounded_batches(make_marketdata, iss_stub, monkeypatch):
+    """Свечи бумаги пишутся порциями не больше candles_batch_rows + страница, а не одной вставкой"""
+    md = make_marketdata()
+    md.candles_batch_rows = 15
+    inserts = record_inserts(md, monkeypatch)
+
+    md.get_price_history(active_type='shares', operation='replace', start_date=date(2022, 12, 1), end_year=2023)
+
+    assert price_history(md).equals(recorded_candles(['GAZP', 'LKOH', 'SBER'], date(2022, 12, 1)))
+    sizes = [rows for table, rows in inserts if table == 'marketdata_shares__shadow']
+    assert len(sizes) > 3
+    assert max(sizes) < md.candles_batch_rows + iss_stub.page_size
+    assert sum(sizes) == price_history(md).height
+
+
+def test_interrupted_sync_keeps_written_batches(make_marketdata, monkeypatch):
+    """Прерванная синхронизация сохраняет записанные порции и продолжается с последней свечи"""
+    md = make_marketdata()
+    md.candles_batch_rows = 15
+    get_conn = md.get_conn
+
+    def failing_get_conn(url, **kwargs):
+        # Вторая страница 2023 года по SBER: первая порция SBER уже записана
+        if '/SBER/' in url and 'from=2023' in url and 'start=10' in url:
+            raise IssFetchError(url)
+        return get_conn(url=url, **kwargs)
+
+    monkeypatch.setattr(md, 'get_conn', failing_get_conn)
+    with pytest.raises(IssFetchError):
+        md.sync_price_history(active_type='shares', start_date=date(2022, 12, 1))
+
+    state = {secid: (last_date, synced_till) for secid, last_date, synced_till in md.DBS.execute_safe(
+        f"SELECT SECID, last_date, synced_till FROM {md.sync_state_table}")}
+    assert state['GAZP'][1] == str(date.today())
+    # По SBER записана только первая порция: последняя свеча сохранена, дата окончания запроса - нет
+    sber = price_history(md).filter(pl.col('SECID') == 'SBER')
+    assert 0 < sber.height < 44
+    assert state['SBER'] == (sber['date'].max(), None)
+
+    monkeypatch.setattr(md, 'get_conn', get_conn)
+    md.sync_price_history(active_type='shares', start_date=date(2022, 12, 1))
+    assert price_history(md).equals(recorded_candles(['GAZP', 'LKOH', 'SBER'], date(2022, 12, 1)))
+
+
+def test_resolve_renames_and_split_factors():
+    """Цепочки смены кодов сворачиваются до актуального кода, коэффициенты сплитов накапливаются"""
+    changeovers = pl.DataFrame({'date': [date(2024, 5, 1), date(2024, 2, 1), date(2024, 8, 1), date(2024, 3, 1)],
+                                'old_secid': ['B', 'A', 'C', 'X'], 'new_secid': ['C', 'B', 'D', 'X']})
+    renames = adjustments.resolve_renames(changeovers)
+    assert dict(renames.iter_rows()) == {'A': 'D', 'B': 'D', 'C': 'D'}
+
+    # Сплит 1:10, затем 1:2 под прежним кодом: до первого сплита коэффициент 20, между сплитами - 2
+    splits = pl.DataFrame({'date': [date(2024, 6, 1), date(2024, 3, 1)], 'secid': ['C', 'B'],
+                           'quantity_before': [1, 1], 'quantity_after': [2, 10]})
+    factors = adjustments.split_factors(splits, renames)
+    operations = pl.DataFrame({'Date': ['2024-01-10', '2024-03-01', '2024-04-01', '2024-06-01'],
+                               'SECID': ['A', 'B', 'C', 'D'], 'Quantity': [1, 1, 1, 1], 'Price': [40.0] * 4})
+    adjusted = adjustments.adjust_operations(operations, factors, renames)
+    assert adjusted['SECID'].to_list() == ['D'] * 4
+    assert adjusted['Quantity'].to_list() == [20, 2, 2, 1]
+    assert adjusted['Price'].to_list() == [2.0, 20.0, 20.0, 40.0]
+
+
+def test_splits_and_changeovers_adjust_positions_and_prices(make_marketdata, iss_stub):
+    """Операции и цены до сплита и под прежними кодами приводятся к текущим кодам и единицам"""
+    md = make_marketdata()
+    md.ensure_price_history_table('shares')
+    md.DBS.add_dataframe_to_table(df=pl.DataFrame({
+        'SECID': ['SBER', 'SBER', 'OLDA', 'NEWA'],
+        'date': ['2024-02-14', '2024-03-04', '2024-01-31', '2024-06-03'],
+        'close': [310.0, 32.0, 100.0, 120.0],
+    }), table_name='marketdata_shares')
+
+    portfolio = Portfolio(db_path=md.DBS.db_path)
+    portfolio.add_operations([
+        {'Date': '2024-01-10', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 300.0},
+        # В день сплита операция уже в новых единицах
+        {'Date': '2024-03-01', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 5, 'Price': 35.0},
+        {'Date': '2024-01-15', 'SECID': 'OLDA', 'Operation': 'buy', 'Quantity': 7, 'Price': 100.0},
+        {'Date': '2024-03-15', 'SECID': 'MIDA', 'Operation': 'sell', 'Quantity': 2, 'Price': 110.0},
+        {'Date': '2024-06-01', 'SECID': 'NEWA', 'Operation': 'buy', 'Quantity': 1, 'Price': 120.0},
+    ])
+
+    def positions(target_date: date) -> dict:
+        return dict(portfolio.positions_on_date(target_date=target_date).select('SECID', 'Quantity').iter_rows())
+
+    # Таблица позиций построена до загрузки сплитов и смены кодов
+    assert positions(date(2024, 2, 15)) == {'SBER': 10, 'OLDA': 7}
+
+    # Сплит 1:10 и цепочка OLDA -> MIDA -> NEWA
+    iss_stub.splits = [['2024-03-01', 'SBER', 1, 10]]
+    iss_stub.changeovers = [['2024-05-01', 'MIDA', 'NEWA'], ['2024-02-01', 'OLDA', 'MIDA']]
+    assert md.get_splits_history() and md.get_changeover_history()
+
+    assert positions(date(2024, 2, 15)) == {'SBER': 100, 'NEWA': 7}
+    assert positions(date(2024, 2, 29)) == {'SBER': 100, 'NEWA': 7}
+    assert positions(date(2024, 12, 31)) == {'SBER': 105, 'NEWA': 6}
+
+    # Цена до сплита делится на коэффициент, цена под прежним кодом берется для нового кода
+    values = portfolio.value_positions(
+        portfolio.positions_on_date(target_date=date(2024, 2, 15)).with_columns(pl.lit(date(2024, 2, 15)).alias('Date')))
+    assert dict(values.select('SECID', 'MARKETPRICE').iter_rows()) == {'SBER': 31.0, 'NEWA': 100.0}
+    assert dict(values.select('SECID', 'Position Value').iter_rows()) == {'SBER': 3100.0, 'NEWA': 700.0}
+
+    costs = portfolio.average_price(method='fifo').filter(pl.col('SECID') == 'SBER').row(0, named=True)
+    assert costs['Quantity'] == 105
+    assert costs['Average Price'] == pytest.approx((100 * 30.0 + 5 * 35.0) / 105)
+    portfolio.DatabaseManager.close()
+
+
+def test_update_currency_rates(make_marketdata):
+    """Курсы копируются из истории цен валют, сегодняшний курс - из снимка, последние дни - повторно"""
+    md = make_marketdata()
+    today = date.today()
+    days = [today - timedelta(days=n) for n in (20, 12, 3)]
+    md.DBS.add_dataframe_to_table(df=pl.DataFrame({'SECID': ['USD'] * 3, 'date': [str(day) for day in days],
+                                                   'close': [90.0, 91.0, 92.0]}),
+                                  table_name='marketdata_currency')
+    md.DBS.add_dataframe_to_table(df=pl.DataFrame({'SECID': ['USD'], 'LASTVALUE': [93.0]}),
+                                  table_name='current_marketdata_currency')
+
+    def rates() -> dict:
+        return dict(md.DBS.execute_safe(f"SELECT date, rate FROM {md.currency_rates_table} ORDER BY date"))
+
+    md.update_currency_rates()
+    assert rates() == {str(days[0]): 90.0, str(days[1]): 91.0, str(days[2]): 92.0, str(today): 93.0}
+
+    # Поправка биржи за последние дни попадает в курсы, более ранние даты повторно не копируются
+    md.DBS.execute_safe("UPDATE marketdata_currency SET close = close + 1")
+    md.update_currency_rates()
+    assert rates() == {str(days[0]): 90.0, str(days[1]): 91.0, str(days[2]): 93.0, str(today): 93.0}
+
+
+def columnar_history(md, end_date: date = None) -> pl.DataFrame:
+    return md.price_store.scan('shares', end_date=end_date).collect().sort('SECID', 'date')
+
+
+def test_parquet_tier_matches_sql(make_marketdata):
+    """История цен из Parquet и SQL совпадает после выгрузки, изменения и выгрузки только части годов"""
+    md = make_marketdata()
+    md.get_price_history(active_type='shares', operation='replace', start_date=date(2022, 12, 1), end_year=2023)
+    assert md.price_store.fresh_years('shares') == {2022, 2023}
+    assert all(os.path.exists(md.price_store.partition_path('shares', year)) for year in (2022, 2023))
+    assert columnar_history(md).equals(price_history(md))
+
+    # Новые цены SBER за оба года: годы устаревают вместе с записью в SQL
+    changed = (price_history(md)
+               .filter((pl.col('SECID') == 'SBER') & pl.col('date').is_in(['2022-12-30', '2023-01-03']))
+               .with_columns(pl.col('close') + 1))
+    assert changed.height == 2
+    md.upsert_secid_prices(active_type='shares', secid='SBER', candles=[changed])
+    assert md.price_store.fresh_years('shares') == set()
+    assert columnar_history(md).equals(price_history(md))
+
+    # Выгружен только 2022 год: 2023 читается из SQL
+    md.price_store.export('shares', [2022])
+    assert md.price_store.fresh_years('shares') == {2022}
+    assert columnar_history(md).equals(price_history(md))
+    assert columnar_history(md, end_date=date(2022, 12, 31)).equals(
+        price_history(md).filter(pl.col('date') < '2023-01-01'))
+
+    # Оценка портфеля читает те же цены, что и без колоночного хранилища
+    portfolio = Portfolio(db_path=md.DBS.db_path)
+    portfolio.price_store = md.price_store
+    with_store = portfolio.stored_price_history('marketdata_shares', ['SBER', 'GAZP'],
+                                                start_date=date(2022, 12, 20), end_date=date(2023, 1, 10))
+    portfolio.price_store = None
+    without_store = portfolio.stored_price_history('marketdata_shares', ['SBER', 'GAZP'],
+                                                   start_date=date(2022, 12, 20), end_date=date(2023, 1, 10))
+    assert with_store.sort('SECID', 'Date').equals(without_store.sort('SECID', 'Date'))
+    assert with_store.filter(pl.col('SECID') == 'SBER')['MARKETPRICE'].to_list() == (
+        price_history(md).filter((pl.col('SECID') == 'SBER') & (pl.col('date') >= '2022-12-20')
+                                 & (pl.col('date') <= '2023-01-10'))['close'].to_list())
+    portfolio.DatabaseManager.close()
+
+
+def test_get_price_defaults_to_today_at_call_time(make_marketdata, monkeypatch):
+    """Цена по умолчанию - последняя не позже сегодняшней даты на момент вызова"""
+    md = make_marketdata()
+    md.ensure_price_history_table('shares')
+    md.DBS.add_dataframe_to_table(df=pl.DataFrame({'SECID': ['SBER', 'SBER'], 'date': ['2024-01-12', '2024-01-16'],
+                                                   'close': [270.0, 280.0]}), table_name='marketdata_shares')
+
+    class Today(date):
+        @classmethod
+        def today(cls):
+            return cls(2024, 1, 15)
+
+    monkeypatch.setattr('market.date', Today)
+    assert md.get_price('shares', 'SBER') == 270.0
+    assert md.get_price('shares', 'SBER', target_date=date(2024, 1, 16)) == 280.0
+
+
+def test_parquet_export_does_not_hold_write_lock(make_marketdata, monkeypatch):
+    """Файл года пишется без блокировки записи, год, прочитанный до изменения таблицы, остается в SQL"""
+    md = make_marketdata()
+    md.get_price_history(active_type='shares', operation='replace', start_date=date(2022, 12, 1), end_year=2023)
+    changed = (price_history(md)
+               .filter((pl.col('SECID') == 'SBER') & (pl.col('date') == '2022-12-30'))
+               .with_columns(pl.col('close') + 1))
+    write_temporary = md.price_store.write_temporary
+    written = []
+
+    def upsert():
+        md.upsert_secid_prices(active_type='shares', secid='SBER', candles=[changed])
+        md.DBS.close()
+
+    def write_during_export(path, df):
+        # Пока пишется файл 2022 года, другой поток меняет историю цен за этот год
+        if not written:
+            writer = threading.Thread(target=upsert)
+            writer.start()
+            writer.join(timeout=5)
+            assert not writer.is_alive()
+        written.append(path)
+        return write_temporary(path, df)
+
+    monkeypatch.setattr(md.price_store, 'write_temporary', write_during_export)
+    md.price_store.export('shares')
+
+    assert len(written) == 2
+    assert md.price_store.fresh_years('shares') == {2023}
+    assert columnar_history(md).equals(price_history(md))
+    assert price_history(md).filter((pl.col('SECID') == 'SBER') & (pl.col('date') == '2022-12-30'))['close'].equals(
+        changed['close'])
+    # Отброшенный временный файл не остается рядом с файлами годов
+    assert all(name == 'data.parquet' for year in (2022, 2023)
+               for name in os.listdir(os.path.dirname(md.price_store.partition_path('shares', year))))
+
+    md.price_store.export('shares')
+    assert md.price_store.fresh_years('shares') == {2022, 2023}
+    assert columnar_history(md).equals(price_history(md))
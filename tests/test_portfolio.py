@@ -0,0 +1,526 @@
+import random
+import sqlite3
+import threading
+from datetime import date
+
+import polars as pl
+import pytest
+
+from cost_basis import cost_basis
+from portfolio import Portfolio
+
+
+def in_thread(func):
+    """Результат func, выполненной в отдельном потоке (со своим соединением SQLite)"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def set_share_price(db, price: float):
+    db.add_dataframe_to_table(df=pl.DataFrame({'SECID': ['SBER'], 'MARKETPRICE': [price],
+                                               'securities_type': ['share']}),
+                              table_name='current_marketdata_shares', if_exists='replace')
+
+
+def market_price(portfolio: Portfolio) -> float:
+    return portfolio.market_snapshot().filter(pl.col('SECID') == 'SBER')['MARKETPRICE'][0]
+
+
+def test_market_snapshot_cache_is_checked_across_threads(tmp_path):
+    """Кэш снимка рынка, построенный в одном потоке, устаревает после записи из другого потока"""
+    portfolio = Portfolio(db_path=str(tmp_path / 'database.db'))
+    db = portfolio.DatabaseManager
+    # Пишут только другие потоки (как задачи планировщика): у соединения основного потока нет своих изменений
+    in_thread(lambda: set_share_price(db, 100.0))
+    assert market_price(portfolio) == 100.0
+
+    # Запись из другого потока и чтение из третьего, только что открытого: счетчики его соединения
+    # совпадают с теми, что были у основного потока при построении кэша
+    in_thread(lambda: set_share_price(db, 101.0))
+    assert in_thread(lambda: market_price(portfolio)) == 101.0
+    assert market_price(portfolio) == 101.0
+
+    # Без изменений снимок берется из кэша в любом потоке
+    cached = portfolio.market_snapshot()
+    assert in_thread(portfolio.market_snapshot) is cached
+
+    # Запись курсов валют напрямую через соединение отмечается в Marketdata.update_currency_rates
+    db.touch_tables(portfolio.currency_rates_table)
+    assert in_thread(portfolio.market_snapshot) is not cached
+    db.close()
+
+
+def imported_operations(portfolio: Portfolio) -> pl.DataFrame:
+    return portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history').sort('Date')
+
+
+@pytest.mark.parametrize('dates, date_format', [
+    (['2024-01-05', '2024-02-10'], None),
+    (['2024-01-05 10:30:00', '2024-02-10 18:45:00'], None),
+    (['05.01.2024', '10.02.2024'], None),
+    (['01-05-24', '02-10-24'], None),
+    (['05/01/2024', '10/02/2024'], '%d/%m/%Y'),
+])
+def test_import_operations_parses_text_dates(tmp_path, dates, date_format):
+    """Текстовые даты брокерских выгрузок (в т.ч. ISO) разбираются при потоковой загрузке"""
+    path = tmp_path / 'operations.csv'
+    pl.DataFrame({'Date': dates, 'SECID': ['SBER', 'SBER'], 'Operation': ['buy', 'sell'],
+                  'Quantity': ['10', '4'], 'Price': ['250.5', '270']}).write_csv(path)
+    portfolio = Portfolio(db_path=str(tmp_path / 'database.db'))
+
+    assert portfolio.import_operations(path=str(path), chunk_size=1, date_format=date_format) == 2
+
+    operations = imported_operations(portfolio)
+    assert operations['Date'].cast(pl.Utf8).to_list() == ['2024-01-05', '2024-02-10']
+    assert operations['Quantity'].to_list() == [10, -4]
+    portfolio.DatabaseManager.close()
+
+
+def test_import_operations_parquet_dates(tmp_path):
+    """Parquet с типизированной и со строковой ISO-датой загружается одинаково"""
+    frame = pl.DataFrame({'Date': [date(2024, 1, 5)], 'SECID': ['SBER'], 'Operation': ['buy'],
+                          'Quantity': [10], 'Price': [250.5]})
+    frame.write_parquet(tmp_path / 'typed.parquet')
+    frame.with_columns(pl.col('Date').cast(pl.Utf8)).write_parquet(tmp_path / 'text.parquet')
+    portfolio = Portfolio(db_path=str(tmp_path / 'database.db'))
+
+    portfolio.import_operations(path=str(tmp_path / 'typed.parquet'), operation='replace')
+    typed = imported_operations(portfolio)
+    portfolio.import_operations(path=str(tmp_path / 'text.parquet'), operation='replace')
+    assert imported_operations(portfolio).equals(typed)
+    assert typed['Date'].cast(pl.Utf8).to_list() == ['2024-01-05']
+    portfolio.DatabaseManager.close()
+
+
+def test_import_operations_rejects_unknown_date_format(tmp_path):
+    """Нераспознанные даты не загружаются, файл откатывается целиком"""
+    path = tmp_path / 'operations.csv'
+    pl.DataFrame({'Date': ['2024-01-05', '5 Jan 2024'], 'SECID': ['SBER', 'SBER'],
+                  'Operation': ['buy', 'buy'], 'Quantity': ['10', '1'], 'Price': ['250', '251']}).write_csv(path)
+    portfolio = Portfolio(db_path=str(tmp_path / 'database.db'))
+
+    with pytest.raises(ValueError):
+        portfolio.import_operations(path=str(path))
+    assert imported_operations(portfolio).is_empty()
+    portfolio.DatabaseManager.close()
+
+
+@pytest.fixture
+def portfolio(tmp_path):
+    portfolio = Portfolio(db_path=str(tmp_path / 'database.db'))
+    yield portfolio
+    portfolio.DatabaseManager.close()
+
+
+def stored_quantities(portfolio: Portfolio) -> dict:
+    operations = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+    return dict(zip(operations['id'].to_list(), operations['Quantity'].to_list()))
+
+
+def position(portfolio: Portfolio, secid: str = 'SBER') -> int:
+    positions = portfolio.positions_on_date(target_date=date(2024, 12, 31)).filter(pl.col('SECID') == secid)
+    return positions['Quantity'].sum()
+
+
+def test_edit_operations_keeps_sign_of_operation(portfolio):
+    """Знак количества после редактирования задается операцией, как при загрузке из файла"""
+    buy, sell = portfolio.add_operations([
+        {'Date': '2024-01-05', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 250.0},
+        {'Date': '2024-02-05', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 4, 'Price': 270.0},
+    ])
+
+    # Меняется только тип операции: количество становится отрицательным
+    portfolio.edit_operations({sell: {'Operation': ' SELL '}})
+    assert stored_quantities(portfolio) == {buy: 10, sell: -4}
+    assert position(portfolio) == 6
+
+    # Меняется только количество продажи: знак сохраняется
+    portfolio.edit_operations({sell: {'Quantity': '3'}})
+    assert stored_quantities(portfolio) == {buy: 10, sell: -3}
+    portfolio.edit_operations({sell: {'Operation': 'buy', 'Quantity': -5.0}})
+    assert stored_quantities(portfolio) == {buy: 10, sell: 5}
+    assert position(portfolio) == 15
+
+
+@pytest.mark.parametrize('changes', [
+    {'Quantity': 2.5},
+    {'Quantity': '2.5'},
+    {'Quantity': 'ten'},
+    {'Quantity': None},
+    {'Quantity': True},
+    {'Quantity': float('nan')},
+    {'Price': 'free'},
+    {'Price': float('inf')},
+    {'Operation': 'hold'},
+    {'Date': '05.01.2024'},
+])
+def test_edit_operations_rejects_invalid_values(portfolio, changes):
+    """Неверные значения не записываются, и другие операции пачки тоже не меняются"""
+    first, second = portfolio.add_operations([
+        {'Date': '2024-01-05', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 250.0},
+        {'Date': '2024-02-05', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 4, 'Price': 270.0},
+    ])
+    before = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+
+    with pytest.raises(ValueError):
+        portfolio.edit_operations({first: {'Quantity': 20}, second: changes})
+
+    assert portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history').equals(before)
+    assert position(portfolio) == 6
+
+
+def test_import_operations_rejects_fractional_quantity(tmp_path, portfolio):
+    """Дробное количество в файле не округляется до целого"""
+    path = tmp_path / 'operations.parquet'
+    pl.DataFrame({'Date': [date(2024, 1, 5)], 'SECID': ['SBER'], 'Operation': ['buy'],
+                  'Quantity': [2.5], 'Price': [250.0]}).write_parquet(path)
+
+    with pytest.raises(ValueError):
+        portfolio.import_operations(path=str(path))
+
+
+def test_add_operations_stores_sells_negative(portfolio):
+    """Добавленные вручную и через буфер продажи хранятся так же, как загруженные из файла"""
+    buy, sell = portfolio.add_operations([
+        {'Date': date(2024, 1, 5), 'SECID': 'SBER', 'Operation': 'Buy', 'Quantity': '10', 'Price': '250.5'},
+        {'Date': '2024-02-05', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 4.0, 'Price': 270},
+    ])
+    single = portfolio.add_new_operation('SBER', 'sell', -1, 280.0, operation_date=date(2024, 3, 5))
+    with portfolio.operations_buffer(max_size=10, max_delay=None) as buffer:
+        buffer.add({'Date': '2024-04-05', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 2, 'Price': 290.0})
+
+    quantities = stored_quantities(portfolio)
+    assert [quantities[i] for i in (buy, sell, single)] == [10, -4, -1]
+    assert sorted(quantities.values()) == [-4, -2, -1, 10]
+    assert position(portfolio) == 3
+
+
+@pytest.mark.parametrize('record', [
+    {'Quantity': 1.5},
+    {'Quantity': '1,5'},
+    {'Quantity': [1]},
+    {'Quantity': False},
+    {'Price': None},
+    {'Price': float('nan')},
+])
+def test_add_operations_rejects_invalid_values(portfolio, record):
+    """Пачка с неверным количеством или ценой не записывается целиком"""
+    valid = {'Date': '2024-01-05', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 250.0}
+
+    with pytest.raises(ValueError):
+        portfolio.add_operations([valid, {**valid, **record}])
+    with pytest.raises(ValueError):
+        portfolio.operations_buffer(max_size=10, max_delay=None).add({**valid, **record})
+
+    assert portfolio.add_operations([valid]) == [1]
+
+
+def reference_cost_basis(operations: list, method: str) -> dict:
+    """
+    Себестоимость по лотам, операция за операцией (для сверки с cost_basis)
+
+    :param operations: [(дата, бумага, количество со знаком, цена)] в любом порядке
+    :return: {бумага: (количество, средняя цена или None, реализованный результат)}
+    """
+    result = {}
+    for secid in sorted({operation[1] for operation in operations}):
+        # Операции одного дня - в порядке ввода (sorted устойчив)
+        lots, realized = [], 0.0
+        for _, _, quantity, price in sorted((op for op in operations if op[1] == secid), key=lambda op: op[0]):
+            while quantity and lots and (lots[0][0] > 0) != (quantity > 0):
+                lot = lots[-1] if method == 'lifo' else lots[0]
+                side = 1 if lot[0] > 0 else -1
+                taken = min(abs(quantity), abs(lot[0]))
+                realized += taken * (price - lot[1]) * side
+                lot[0] -= taken * side
+                quantity += taken * side
+                if lot[0] == 0:
+                    lots.remove(lot)
+            if quantity and method == 'average' and lots:
+                total = lots[0][0] + quantity
+                lots[0] = [total, (lots[0][0] * lots[0][1] + quantity * price) / total]
+            elif quantity:
+                lots.append([quantity, price])
+
+        position = sum(lot[0] for lot in lots)
+        average = sum(lot[0] * lot[1] for lot in lots) / position if position else None
+        result[secid] = (position, average, realized)
+    return result
+
+
+def computed_cost_basis(operations: list, method: str) -> dict:
+    data = pl.DataFrame(operations, schema=['Date', 'SECID', 'Quantity', 'Price'], orient='row')
+    return {secid: (quantity, average, realized) for secid, quantity, average, realized in
+            cost_basis(data, method=method).select('SECID', 'Quantity', 'Average Price', 'Realized P&L').iter_rows()}
+
+
+@pytest.mark.parametrize('method, expected', [
+    # Куплено 10 по 100 и 10 по 120, продано 15 по 130
+    ('fifo', (5, 120.0, 15 * 130 - (10 * 100 + 5 * 120))),
+    ('lifo', (5, 100.0, 15 * 130 - (10 * 120 + 5 * 100))),
+    ('average', (5, 110.0, 15 * (130 - 110))),
+])
+def test_cost_basis_methods_by_hand(method, expected):
+    """Себестоимость в порядке дат, даже если операции сохранены в другом порядке"""
+    operations = [(date(2024, 1, 3), 'SBER', -15, 130.0),
+                  (date(2024, 1, 2), 'SBER', 10, 120.0),
+                  (date(2024, 1, 1), 'SBER', 10, 100.0)]
+    quantity, average, realized = computed_cost_basis(operations, method)['SBER']
+    assert (quantity, average, realized) == pytest.approx(expected)
+    assert reference_cost_basis(operations, method)['SBER'] == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('method', ['average', 'fifo', 'lifo'])
+@pytest.mark.parametrize('seed', range(5))
+def test_cost_basis_matches_reference_on_unsorted_history(method, seed):
+    """Случайная история (с шортами и переходами через ноль) в случайном порядке хранения"""
+    rng = random.Random(seed)
+    operations = [(date(2024, 1, rng.randint(1, 20)), rng.choice(['SBER', 'GAZP', 'LKOH']),
+                   rng.choice([-1, 1]) * rng.randint(1, 10), float(rng.randint(50, 150)))
+                  for _ in range(60)]
+    rng.shuffle(operations)
+
+    computed = computed_cost_basis(operations, method)
+    expected = reference_cost_basis(operations, method)
+    assert computed.keys() == expected.keys()
+    for secid, (quantity, average, realized) in expected.items():
+        assert computed[secid][0] == quantity
+        assert computed[secid][1] == (None if average is None else pytest.approx(average))
+        assert computed[secid][2] == pytest.approx(realized)
+
+
+def test_average_price_orders_operations_by_date(portfolio):
+    """Операция, введенная задним числом, учитывается в порядке дат"""
+    portfolio.add_operations([
+        {'Date': '2024-01-08', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 7, 'Price': 62.0},
+        {'Date': '2024-01-01', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 8, 'Price': 125.0},
+        {'Date': '2024-01-02', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 1, 'Price': 53.0},
+    ])
+    for method in ('average', 'fifo', 'lifo'):
+        row = portfolio.average_price(method=method).row(0, named=True)
+        assert (row['Quantity'], row['Average Price'], row['Realized P&L']) == pytest.approx((14, 93.5, -72.0))
+
+
+def write_table(portfolio: Portfolio, table_name: str, **columns):
+    portfolio.DatabaseManager.add_dataframe_to_table(df=pl.DataFrame(columns), table_name=table_name,
+                                                     if_exists='replace')
+
+
+def add_account_operations(portfolio: Portfolio):
+    portfolio.add_operations([
+        {'Date': '2024-01-10', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 250.0},
+        {'Date': '2024-01-11', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 5, 'Price': 255.0, 'Account': 'iis'},
+        {'Date': '2024-01-12', 'SECID': 'GAZP', 'Operation': 'buy', 'Quantity': 3, 'Price': 160.0, 'Account': 'iis'},
+        {'Date': '2024-01-15', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 2, 'Price': 260.0},
+        {'Date': '2024-01-16', 'SECID': 'GAZP', 'Operation': 'sell', 'Quantity': 3, 'Price': 165.0, 'Account': 'iis'},
+    ])
+
+
+def account_positions(positions: pl.DataFrame) -> dict:
+    return {(account, secid): quantity for account, secid, quantity in
+            positions.select('Account', 'SECID', 'Quantity').iter_rows()}
+
+
+def test_positions_by_account(portfolio):
+    """Позиции считаются по каждому счету отдельно, из таблицы позиций и по истории операций одинаково"""
+    add_account_operations(portfolio)
+    history = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+
+    for target_date, expected in [
+        (date(2024, 1, 9), {}),
+        (date(2024, 1, 13), {('main', 'SBER'): 10, ('iis', 'SBER'): 5, ('iis', 'GAZP'): 3}),
+        (date(2024, 1, 16), {('main', 'SBER'): 8, ('iis', 'SBER'): 5}),
+    ]:
+        assert account_positions(portfolio.positions_on_date(target_date=target_date)) == expected
+        assert account_positions(portfolio.quantity_for_active(data=history, target_date=target_date)) == expected
+        iis = {key: quantity for key, quantity in expected.items() if key[0] == 'iis'}
+        assert account_positions(portfolio.positions_on_date(target_date=target_date, account='iis')) == iis
+        assert account_positions(portfolio.quantity_for_active(data=history, target_date=target_date,
+                                                               account='iis')) == iis
+
+
+def test_accounts_value(portfolio):
+    """Стоимость каждого счета: на прошедшую дату - по истории цен, на сегодня - по снимку рынка"""
+    add_account_operations(portfolio)
+    write_table(portfolio, 'marketdata_shares', SECID=['SBER', 'GAZP', 'SBER'],
+                date=['2024-01-10', '2024-01-10', '2024-01-12'], close=[250.0, 160.0, 270.0])
+    write_table(portfolio, 'current_marketdata_shares', SECID=['SBER', 'GAZP'], MARKETPRICE=[300.0, 170.0],
+                securities_type=['share', 'share'])
+
+    # 13 января: цена SBER - закрытие 12 января, GAZP - 10 января
+    past = portfolio.accounts_value(target_date=date(2024, 1, 13))
+    assert dict(past.iter_rows()) == {'iis': 5 * 270.0 + 3 * 160.0, 'main': 10 * 270.0}
+    today = portfolio.accounts_value()
+    assert dict(today.iter_rows()) == {'iis': 5 * 300.0, 'main': 8 * 300.0}
+
+
+def test_currency_rate_as_of_date_without_rate(portfolio):
+    """Облигация в валюте оценивается по последнему курсу не позже даты позиции"""
+    write_table(portfolio, 'current_marketdata_bonds', SECID=['USBOND'], FACEUNIT=['USD'], MARKETPRICE=[1000.0],
+                securities_type=['bond'])
+    write_table(portfolio, 'marketdata_bonds', SECID=['USBOND'], date=['2024-01-09'], close=[1000.0])
+    # Курсы по рабочим дням: в выходные 13 и 14 января курса нет
+    write_table(portfolio, portfolio.currency_rates_table, currency=['USD', 'USD', 'USD', 'CNY'],
+                date=['2024-01-10', '2024-01-12', '2024-01-15', '2024-01-13'], rate=[90.0, 91.0, 92.0, 12.5])
+
+    rates = portfolio.currency_rates(['USD'], start_date=date(2024, 1, 13), end_date=date(2024, 1, 15))
+    assert rates.select(pl.col('Date').cast(pl.Utf8), 'rate').rows() == [('2024-01-12', 91.0), ('2024-01-15', 92.0)]
+
+    positions = pl.DataFrame({'SECID': ['USBOND'] * 4, 'Quantity': [2] * 4,
+                              'Date': [date(2024, 1, 12), date(2024, 1, 14), date(2024, 1, 11), date(2024, 1, 9)]})
+    values = portfolio.value_positions(positions).sort('Date')
+    # До первого курса бумага считается рублевой
+    assert values['CURRENCY'].to_list() == [1.0, 90.0, 91.0, 91.0]
+    assert values['Position Value'].to_list() == [2000.0, 2 * 1000.0 * 90, 2 * 1000.0 * 91, 2 * 1000.0 * 91]
+
+
+def test_portfolio_value_history(portfolio):
+    """Ежедневная стоимость совпадает с оценкой на каждую дату, в выходные - по цене последних торгов"""
+    portfolio.add_operations([
+        {'Date': '2024-01-10', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 100.0},
+        {'Date': '2024-01-15', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 4, 'Price': 110.0},
+    ])
+    write_table(portfolio, 'marketdata_shares', SECID=['SBER'] * 3,
+                date=['2024-01-09', '2024-01-12', '2024-01-16'], close=[100.0, 110.0, 120.0])
+
+    history = portfolio.portfolio_value_history(start_date=date(2024, 1, 8), end_date=date(2024, 1, 17))
+    assert history['Date'].to_list() == [date(2024, 1, day) for day in range(8, 18)]
+    assert history['Portfolio Value'].to_list() == [0.0, 0.0, 1000.0, 1000.0, 1100.0, 1100.0, 1100.0,
+                                                    660.0, 720.0, 720.0]
+
+    for day, value in history.iter_rows():
+        positions = portfolio.positions_on_date(target_date=day)
+        single = portfolio.positions_value(df=positions, target_date=day)['Position Value'].sum()
+        assert single == value
+
+    # История операций, переданная явно, дает тот же ряд
+    data = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+    assert portfolio.portfolio_value_history(start_date=date(2024, 1, 8), end_date=date(2024, 1, 17),
+                                             data=data).equals(history)
+
+    with pytest.raises(ValueError):
+        portfolio.portfolio_value_history(start_date=date(2024, 1, 17), end_date=date(2024, 1, 8))
+
+
+def stored_positions(portfolio: Portfolio) -> pl.DataFrame:
+    return (portfolio.DatabaseManager.read_table_to_dataframe(table_name=portfolio.positions_table)
+            .select('Account', 'SECID', pl.col('Date').cast(pl.Utf8), 'Quantity')
+            .sort('Account', 'SECID', 'Date'))
+
+
+def recomputed_positions(portfolio: Portfolio) -> pl.DataFrame:
+    history = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+    if history.is_empty():
+        return stored_positions(portfolio).head(0)
+    return (portfolio.positions_by_date(data=history)
+            .select('Account', 'SECID', pl.col('Date').cast(pl.Utf8), 'Quantity')
+            .sort('Account', 'SECID', 'Date'))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_positions_table_follows_operation_changes(tmp_path, portfolio, seed):
+    """Таблица позиций после добавления, правки, удаления и загрузки операций совпадает с полным пересчетом"""
+    rng = random.Random(seed)
+
+    def record() -> dict:
+        return {'Date': date(2024, rng.randint(1, 3), rng.randint(1, 28)), 'SECID': rng.choice(['SBER', 'GAZP']),
+                'Operation': rng.choice(['buy', 'buy', 'sell']), 'Quantity': rng.randint(1, 10),
+                'Price': 100.0, 'Account': rng.choice(['main', 'iis'])}
+
+    ids = portfolio.add_operations([record() for _ in range(10)])
+    # Таблица позиций строится при первом обращении, дальше обновляется по изменениям
+    portfolio.positions_on_date(target_date=date(2024, 12, 31))
+
+    for step in range(30):
+        action = rng.choice(['add', 'edit', 'delete', 'import'])
+        if action == 'add':
+            ids += portfolio.add_operations([record() for _ in range(rng.randint(1, 3))])
+        elif action == 'edit' and ids:
+            # Меняется дата, бумага, счет или количество: позиции пересчитываются и по старой, и по новой паре
+            field = rng.choice(['Date', 'SECID', 'Account', 'Quantity'])
+            portfolio.edit_operations({rng.choice(ids): {field: record()[field]}})
+        elif action == 'delete' and ids:
+            deleted = rng.sample(ids, k=min(len(ids), rng.randint(1, 2)))
+            portfolio.delete_operations(deleted)
+            ids = [i for i in ids if i not in deleted]
+        elif action == 'import':
+            path = tmp_path / f'operations_{step}.csv'
+            pl.DataFrame([record() for _ in range(3)]).write_csv(path)
+            portfolio.import_operations(path=str(path))
+            ids = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')['id'].to_list()
+
+        assert stored_positions(portfolio).equals(recomputed_positions(portfolio)), (step, action)
+
+
+def test_operation_queries_use_indexes(portfolio, monkeypatch):
+    """Выборки операций за период, по id и по бумаге с даты идут по индексам, а не полным просмотром"""
+    portfolio.add_operations([{'Date': f'2024-01-{day:02d}', 'SECID': secid, 'Operation': 'buy',
+                               'Quantity': 1, 'Price': 100.0} for day in range(1, 29) for secid in ('SBER', 'GAZP')])
+    portfolio.positions_on_date(target_date=date(2024, 12, 31))
+    db = portfolio.DatabaseManager
+    assert set(db.get_indexes('operations_history')) >= {'idx_operations_history_secid_date',
+                                                         'idx_operations_history_date'}
+
+    plans = []
+    check_query_plan = db.check_query_plan
+
+    def recorded_check(sql, params=()):
+        plans.append((sql, check_query_plan(sql, params)))
+        return plans[-1][1]
+
+    monkeypatch.setattr(db, 'check_query_plan', recorded_check)
+    monkeypatch.setattr(db, 'explain_queries', True)
+
+    assert portfolio.operations_history_by_period(start_date=date(2024, 1, 3), end_date=date(2024, 1, 5)).height == 6
+    portfolio.edit_operations({5: {'Quantity': 3}})
+    portfolio.delete_operations([7])
+
+    operations_queries = [(sql, scans) for sql, scans in plans if 'operations_history' in sql]
+    assert operations_queries
+    assert all(scans == [] for _, scans in operations_queries), operations_queries
+
+
+def test_ensure_schema_adds_missing_indexes(tmp_path):
+    """В историю операций, созданную без индексов, индексы досоздаются при первом обращении"""
+    db_path = tmp_path / 'database.db'
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE operations_history (Date TEXT, SECID TEXT, Operation TEXT, "
+                     "Quantity INTEGER, Price REAL)")
+    portfolio = Portfolio(db_path=str(db_path))
+    portfolio.ensure_schema()
+    assert set(portfolio.DatabaseManager.get_indexes('operations_history')) >= {
+        'idx_operations_history_secid_date', 'idx_operations_history_date'}
+    portfolio.DatabaseManager.close()
+
+
+def test_default_dates_are_today_at_call_time(portfolio, monkeypatch):
+    """Дата по умолчанию - сегодняшняя на момент вызова, а не на момент импорта модуля"""
+    portfolio.add_operations([
+        {'Date': '2024-01-10', 'SECID': 'SBER', 'Operation': 'buy', 'Quantity': 10, 'Price': 100.0},
+        {'Date': '2024-01-20', 'SECID': 'SBER', 'Operation': 'sell', 'Quantity': 4, 'Price': 110.0},
+    ])
+    write_table(portfolio, 'marketdata_shares', SECID=['SBER'], date=['2024-01-09'], close=[100.0])
+    set_share_price(portfolio.DatabaseManager, 120.0)
+
+    class Today(date):
+        @classmethod
+        def today(cls):
+            return cls(2024, 1, 16)
+
+    monkeypatch.setattr('portfolio.date', Today)
+
+    assert account_positions(portfolio.positions_on_date()) == {('main', 'SBER'): 10}
+    operations = portfolio.DatabaseManager.read_table_to_dataframe(table_name='operations_history')
+    assert account_positions(portfolio.quantity_for_active(data=operations)) == {('main', 'SBER'): 10}
+    history = portfolio.portfolio_value_history(start_date=date(2024, 1, 14))
+    assert history['Date'].to_list() == [date(2024, 1, 14), date(2024, 1, 15), date(2024, 1, 16)]
+    # На сегодня стоимость считается по снимку рынка
+    assert portfolio.positions_value(df=portfolio.positions_on_date())['Position Value'].to_list() == [1200.0]
+
+    assert dict(portfolio.accounts_value().iter_rows()) == {'main': 1200.0}
+
+    operation_id = portfolio.add_new_operation('SBER', 'buy', 1, 120.0)
+    assert portfolio.operations_by_id([operation_id])['Date'].cast(pl.Utf8).to_list() == ['2024-01-16']
@@ -0,0 +1,172 @@
+import random
+from datetime import date, datetime, timedelta
+from functools import partial
+
+import pytest
+
+import config
+from scheduler import FakeClock, RefreshScheduler, default_jobs
+
+
+BONDS_PATH = '/iss/engines/stock/markets/bonds/securities.json'
+
+
+@pytest.fixture
+def scheduled(make_marketdata):
+    """
+    Marketdata на заглушке ISS, задачи default_jobs, часы FakeClock с понедельника 09:00,
+    журнал запусков [(задача, время часов)] (в нем же вызовы update_currency_rates из любой задачи)
+    и журнал начала и конца выполнения [(задача, 'start' / 'end')]
+    """
+    md = make_marketdata()
+    clock = FakeClock(datetime(2024, 1, 15, 9, 0))
+    runs = []
+    events = []
+
+    update_currency_rates = md.update_currency_rates
+
+    def recorded_rates_update(*args, **kwargs):
+        runs.append(('update_currency_rates', clock.now()))
+        return update_currency_rates(*args, **kwargs)
+
+    md.update_currency_rates = recorded_rates_update
+
+    def recorded(name, func):
+        def run():
+            runs.append((name, clock.now()))
+            events.append((name, 'start'))
+            try:
+                return func()
+            finally:
+                events.append((name, 'end'))
+        return run
+
+    jobs = default_jobs(md)
+    for job in jobs:
+        if job.name.startswith('history_'):
+            # Ночная синхронизация - за последний месяц, а не с 2000 года
+            job.func = partial(job.func, start_date=date.today() - timedelta(days=30))
+        job.func = recorded(job.name, job.func)
+
+    scheduler = RefreshScheduler(md.DBS, jobs, clock=clock, rng=random.Random(7))
+    yield md, clock, scheduler, runs, events
+    scheduler.close()
+
+
+def times(runs: list, name: str) -> list:
+    return [moment for job, moment in runs if job == name]
+
+
+def step(clock: FakeClock, scheduler: RefreshScheduler, until: datetime, on_run=None):
+    """Поминутная проверка расписания до момента until (как основной цикл с опросом раз в минуту)"""
+    while clock.now() < until:
+        clock.advance(minutes=1)
+        for name in scheduler.run_pending():
+            if on_run is not None:
+                on_run(name)
+
+
+def test_trading_day_and_night(scheduled, iss_stub):
+    """День торгов и ночь: порядок зависимостей, случайная задержка, повтор после сбоя, таблица состояния"""
+    md, clock, scheduler, runs, events = scheduled
+    tz = clock.now().tzinfo
+    moment = lambda day, hour, minute=0: datetime(2024, 1, day, hour, minute, tzinfo=tz)
+
+    # Случайная задержка: каждый запуск назначается в пределах [план, план + jitter]
+    offsets = {}
+
+    def check_jitter(name):
+        job, state = scheduler.jobs[name], scheduler.state[name]
+        if state['status'] != 'ok':
+            return
+        planned = job.next_run(state['last_run'], clock.now())
+        offset = (scheduler.next_runs[name] - planned).total_seconds()
+        assert 0 <= offset <= job.jitter
+        offsets.setdefault(name, set()).add(offset)
+
+    # До открытия торгов ничего не запускается
+    assert scheduler.run_pending() == []
+    step(clock, scheduler, moment(15, 9, 49))
+    assert runs == []
+
+    step(clock, scheduler, moment(15, 10, 30), on_run=check_jitter)
+    first_snapshot = min(moment for _, moment in runs)
+    assert moment(15, 9, 50) <= first_snapshot <= moment(15, 9, 50) + timedelta(seconds=config.snapshot_jitter + 60)
+
+    # Снимок облигаций недоступен восемь минут: задача повторяется через retry_delay, а не через snapshot_interval
+    iss_stub.fail(BONDS_PATH)
+    failed_at = clock.now()
+    step(clock, scheduler, failed_at + timedelta(minutes=8), on_run=check_jitter)
+    failures = [t for t in times(runs, 'snapshot_bonds') if t > failed_at]
+    assert scheduler.state['snapshot_bonds']['status'] == 'error'
+    row = md.DBS.execute_safe("SELECT status, error FROM scheduler_state WHERE job = 'snapshot_bonds'")[0]
+    assert row[0] == 'error' and 'ошибкой' in row[1]
+    assert len(failures) >= 3
+    assert all(later - earlier <= timedelta(seconds=config.scheduler_retry_delay + 60)
+               for earlier, later in zip(failures, failures[1:]))
+
+    iss_stub.recover()
+    step(clock, scheduler, moment(16, 3, 0), on_run=check_jitter)
+    assert scheduler.state['snapshot_bonds']['status'] == 'ok'
+
+    # Снимки - только в торговые часы, ночные задачи - один раз после 02:00 (с задержкой до nightly_jitter)
+    for name in ('snapshot_currency', 'snapshot_shares', 'snapshot_bonds', 'fx_rates'):
+        assert times(runs, name)
+        assert all(moment(15, 9, 50) <= t <= moment(15, 18, 51) for t in times(runs, name))
+    for name in ('history_currency', 'history_shares', 'history_bonds', 'splits', 'changeovers'):
+        assert len(times(runs, name)) == 1
+        assert moment(16, 2, 0) <= times(runs, name)[0] <= moment(16, 2, 0) + timedelta(
+            seconds=config.nightly_jitter + 60)
+    # Торги 09:50 - 18:50, проверка раз в минуту: запуск не позже интервала + jitter + минута после прошлого
+    assert len(times(runs, 'snapshot_shares')) >= 9 * 3600 // (config.snapshot_interval + config.snapshot_jitter + 60)
+
+    # Пересчет валют начинается только после завершения свежего снимка валют, ночные задачи -
+    # после своих зависимостей; зависимость в это время не выполняется
+    for job, dependency in (('fx_rates', 'snapshot_currency'), ('changeovers', 'splits')):
+        finished_since_last_run = False
+        running = 0
+        for name, event in events:
+            if name == dependency:
+                running += 1 if event == 'start' else -1
+                finished_since_last_run |= event == 'end'
+            elif name == job and event == 'start':
+                assert finished_since_last_run and running == 0
+                finished_since_last_run = False
+    # Курсы для облигаций в валюте взяты из снимка валют
+    rates = md.DBS.execute_safe(f"SELECT r.currency FROM {md.currency_rates_table} r "
+                                f"JOIN current_marketdata_currency c ON c.SECID = r.currency AND c.LASTVALUE = r.rate")
+    assert {'USD', 'CNY'} <= {currency for currency, in rates}
+    # Курсы за прошедшие дни копирует ночная синхронизация истории валют, один раз за ночь
+    past_rates = md.DBS.execute_safe(f"SELECT DISTINCT currency FROM {md.currency_rates_table} WHERE date < ?",
+                                     (str(date.today()),))
+    assert {'USD', 'CNY'} <= {currency for currency, in past_rates}
+    assert len([t for t in times(runs, 'update_currency_rates') if t >= moment(16, 0)]) == 1
+
+    # Задержка действительно случайная
+    assert len(offsets['snapshot_shares']) > 1
+
+    # Таблица состояния: последний запуск и последний успешный запуск каждой задачи
+    state = {job: (last_run, last_success, status) for job, last_run, last_success, status in
+             md.DBS.execute_safe("SELECT job, last_run, last_success, status FROM scheduler_state")}
+    assert set(state) == set(scheduler.jobs)
+    for name in scheduler.jobs:
+        assert state[name] == (times(runs, name)[-1].isoformat(), times(runs, name)[-1].isoformat(), 'ok')
+
+
+def test_restart_continues_from_saved_state(scheduled):
+    """После перезапуска ночные задачи не повторяются, а пропущенные запуски выполняются сразу"""
+    md, clock, scheduler, runs, events = scheduled
+    clock.advance(hours=17, minutes=30)  # вторник 02:30: ночная синхронизация пропущена
+    executed = scheduler.run_pending()
+    assert {'history_currency', 'history_shares', 'history_bonds', 'splits', 'changeovers'} <= set(executed)
+    scheduler.close()
+
+    restarted = RefreshScheduler(md.DBS, scheduler.jobs.values(), clock=clock, rng=random.Random(8))
+    try:
+        assert restarted.run_pending() == []
+        tomorrow = clock.now().replace(hour=2, minute=0) + timedelta(days=1)
+        for name in ('history_shares', 'splits', 'changeovers'):
+            assert restarted.state[name]['status'] == 'ok'
+            assert tomorrow <= restarted.next_runs[name] <= tomorrow + timedelta(seconds=config.nightly_jitter)
+    finally:
+        restarted.close()